@@ -1,6 +1,6 @@
 import os
 from flask import Flask
-from . import db
+from . import db, cli
 
 def create_app(test_config=None):
     # create and configure the app
@@ -8,6 +8,35 @@ def create_app(test_config=None):
     app.config.from_mapping(
         SECRET_KEY='dev',
         DATABASE=os.path.join(app.instance_path, 'flaskr.sqlite'),
+        # sqlite connection pragmas (see `db.connect_db`)
+        SQLITE_JOURNAL_MODE='WAL',
+        SQLITE_SYNCHRONOUS='NORMAL',
+        SQLITE_MMAP_SIZE=256 * 1024 * 1024, # bytes
+        SQLITE_CACHE_SIZE=-64 * 1024, # negative: KiB
+        SQLITE_BUSY_TIMEOUT=30, # seconds
+        # hn ingest
+        HN_API_URL='https://hacker-news.firebaseio.com/v0',
+        INGEST_MAX_WORKERS=16,
+        INGEST_RATE_LIMIT=50, # requests per second per host
+        INGEST_BATCH_SIZE=500, # items per db transaction
+        # rest api
+        API_WRITE_BATCH_SIZE=500, # items per db transaction for bulk posts
+        API_PAGE_SIZE=100, # default number of items per page of list routes
+        API_MAX_PAGE_SIZE=1000, # max number of items per page (ndjson streams are not limited)
+        # clustering
+        EMBEDDING_CACHE_SIZE=200000, # max number of cached story embeddings (all models)
+        EMBEDDER_REGISTRY_SIZE=2, # max number of transformers kept loaded (see `EmbedderRegistry`)
+        PRELOAD_EMBEDDERS=[], # transformer names loaded at app start
+        EMBEDDING_WORKERS=0, # embedding processes, each loads a transformer (0: embed in job thread)
+        TOKENIZER_WORKERS=0, # wordcloud tokenizer processes (0: tokenize in job thread)
+        # similar stories (see `StoryIndex`)
+        STORY_INDEX_MIN_IVF_SIZE=50000, # exact search below this number of stories
+        STORY_INDEX_NPROBE=8, # number of inverted lists searched per query
+        # background jobs
+        JOB_WORKERS=1, # max number of jobs running at once (jobs writing to `data` still run one at a time)
+        JOB_HISTORY_SIZE=100, # number of finished jobs kept for `/jobs`
+        # dash dashboard at `/dashapp/` (plain api workers can go without it and start faster)
+        DASHBOARD=True,
     )
     
     if test_config is None:
@@ -29,11 +58,15 @@ def create_app(test_config=None):
     # register db with the app
     db.init_app(app)
 
+    # register cli commands
+    cli.init_app(app)
+
     with app.app_context():
         from flaskr.routes import (
             page_routes,
             io_routes,
-            cluster_routes
+            cluster_routes,
+            job_routes
         )
         from flaskr.routes.api import (
             general_routes,
@@ -41,6 +74,13 @@ def create_app(test_config=None):
             comment_routes,
             item_routes
         )
-        from flaskr.dashapp import init_dashboard
-        app = init_dashboard(app)
+        from flaskr.utils.nlp_utils import EmbedderRegistry
+        EmbedderRegistry.configure(
+            max_size=app.config['EMBEDDER_REGISTRY_SIZE'],
+            preload=app.config['PRELOAD_EMBEDDERS']
+        )
+
+        if app.config['DASHBOARD']:
+            from flaskr.dashapp import init_dashboard
+            app = init_dashboard(app)
         return app
@@ -0,0 +1,45 @@
+from flask.cli import with_appcontext
+
+import click
+
+from flaskr.utils.hn_utils import query_hn_and_add_result_to_db
+from flaskr.models.story import StoryList
+from flaskr.models.thread import StoryThreadList
+from flaskr.utils.io_utils import ClusteringResult
+
+@click.command('fetch-items')
+@click.argument('begin_id', type=int)
+@click.argument('end_id', type=int)
+@with_appcontext
+def fetch_items_command(begin_id, end_id):
+    """Fetch items with ids in [BEGIN_ID, END_ID] from HN and add them to db"""
+    stats = query_hn_and_add_result_to_db({'begin_id': begin_id, 'end_id': end_id})
+    click.echo(f'Done: {stats}')
+
+@click.command('backfill-threads')
+@with_appcontext
+def backfill_threads_command():
+    """Rebuild `story_thread` table (concatenated comments) for all stories"""
+    num = StoryThreadList.backfill()
+    click.echo(f'Rebuilt threads for {num} stories.')
+
+@click.command('migrate-embeddings')
+@with_appcontext
+def migrate_embeddings_command():
+    """Convert comment embeddings stored as text to float32 blobs"""
+    num = StoryList.migrate_text_embeddings()
+    click.echo(f'Converted {num} embeddings.')
+
+@click.command('convert-result')
+@click.argument('csv_fname', type=click.Path(exists=True))
+@click.argument('npz_fname', type=click.Path())
+def convert_result_command(csv_fname, npz_fname):
+    """Convert clustering result from tsv (CSV_FNAME) to columnar npz (NPZ_FNAME)"""
+    num = ClusteringResult.from_csv(csv_fname, npz_fname)
+    click.echo(f'Converted {num} stories.')
+
+def init_app(app):
+    app.cli.add_command(fetch_items_command)
+    app.cli.add_command(backfill_threads_command)
+    app.cli.add_command(migrate_embeddings_command)
+    app.cli.add_command(convert_result_command)
@@ -10,7 +10,6 @@ from dash import dcc
 import plotly.express as px
 from plotly.subplots import make_subplots
 import plotly.graph_objects as go
-from wordcloud import WordCloud, STOPWORDS, ImageColorGenerator
 
 from flaskr.utils.dash_utils import (
     DataHelper as data,
@@ -4,13 +4,43 @@ from flask.cli import with_appcontext
 import sqlite3
 import click
 
+def connect_db(config) -> sqlite3.Connection:
+    """
+    opens new connection to the db specified in app config
+    and tunes it with the following pragmas (also taken from app config):
+        SQLITE_JOURNAL_MODE: e.g., `WAL` - readers don't block writers and vice versa
+        SQLITE_SYNCHRONOUS: e.g., `NORMAL` - safe in WAL mode, fewer fsyncs than `FULL`
+        SQLITE_MMAP_SIZE: max number of bytes of db file to memory-map
+        SQLITE_CACHE_SIZE: page cache size (in pages if positive, in KiB if negative)
+        SQLITE_BUSY_TIMEOUT: how long (in seconds) to wait for a lock
+    """
+    db = sqlite3.connect(
+        config['DATABASE'],
+        detect_types=sqlite3.PARSE_DECLTYPES,
+        timeout=config.get('SQLITE_BUSY_TIMEOUT', 30)
+    )
+    db.row_factory = sqlite3.Row
+
+    if config.get('SQLITE_JOURNAL_MODE'):
+        db.execute(f"PRAGMA journal_mode = {config['SQLITE_JOURNAL_MODE']};")
+    if config.get('SQLITE_SYNCHRONOUS'):
+        db.execute(f"PRAGMA synchronous = {config['SQLITE_SYNCHRONOUS']};")
+    if config.get('SQLITE_MMAP_SIZE') is not None:
+        db.execute(f"PRAGMA mmap_size = {int(config['SQLITE_MMAP_SIZE'])};")
+    if config.get('SQLITE_CACHE_SIZE') is not None:
+        db.execute(f"PRAGMA cache_size = {int(config['SQLITE_CACHE_SIZE'])};")
+
+    return db
+
 def get_db():
+    """
+    returns connection to the db; connection is opened on first use
+    and reused by all the queries within the same app context
+    (i.e., for the whole request or job - each of them runs in its own thread);
+    connection is closed when app context is torn down
+    """
     if 'db' not in g:
-        g.db = sqlite3.connect(
-            current_app.config['DATABASE'],
-            detect_types=sqlite3.PARSE_DECLTYPES
-        )
-        g.db.row_factory = sqlite3.Row
+        g.db = connect_db(current_app.config)
 
     return g.db
 
@@ -36,4 +66,4 @@ def init_db_command():
 
 def init_app(app):
     app.teardown_appcontext(close_db)
-    app.cli.add_command(init_db_command)
\ No newline at end of file
+    app.cli.add_command(init_db_command)
@@ -2,6 +2,7 @@ from typing import Any, Dict, List, Tuple, Set, Optional, Generator, Union
 
 from flaskr.utils.db_utils import DBHelper
 from flaskr.models.story import Story
+from flaskr.models.thread import StoryThreadList
 
 class Comment:
     SCHEMA = [
@@ -41,23 +42,8 @@ class Comment:
             return cls(**DBHelper.rows2dicts(rows)[0])
 
     def add(self) -> None:
-        # add to comment table
-        add_query = f"""
-            INSERT INTO comment
-            ({', '.join(self.SCHEMA)})
-            VALUES ({', '.join(['?' for _ in self.SCHEMA])});
-        """
-        params = [getattr(self, field) for field in self.SCHEMA]
-        DBHelper.mod_query(add_query, params)
-
-        # add to parent table
-        add_parent_query = """
-            INSERT INTO parent
-            (parent_id, parent_type)
-            VALUES (?, ?)
-        """
-        parent_params = (self.comment_id, 'comment')
-        DBHelper.mod_query(add_parent_query, parent_params)
+        # add to comment and parent tables
+        CommentList.add_many([self])
 
     def update(self) -> None:
         update_query = f"""
@@ -77,7 +63,14 @@ class Comment:
             self.comment_id
         ]
         # TODO: update parent table???
-        DBHelper.mod_query(update_query, params)
+
+        # rebuild threads of both old and new root stories (parent might have changed)
+        roots = set(StoryThreadList.find_roots([self.comment_id]).values())
+        roots.update(StoryThreadList.resolve_roots([self]).values())
+        DBHelper.mod_many([
+            (update_query, [params]),
+            *StoryThreadList.get_rebuild_queries(list(roots)),
+        ])
 
     def delete(self) -> None:
         delete_comment_query = """
@@ -86,10 +79,26 @@ class Comment:
         delete_parent_query = """
             DELETE FROM parent WHERE parent_id = ?;
         """
-        DBHelper.mod_query(delete_comment_query, [self.comment_id])
-        DBHelper.mod_query(delete_parent_query, [self.comment_id])
+        roots = list(StoryThreadList.find_roots([self.comment_id]).values())
+        DBHelper.mod_many([
+            (delete_comment_query, [[self.comment_id]]),
+            (delete_parent_query, [[self.comment_id]]),
+            *StoryThreadList.get_rebuild_queries(roots),
+        ])
 
 class CommentList:
+    ADD_COMMENT_QUERY = f"""
+        INSERT INTO comment
+        ({', '.join(Comment.SCHEMA)})
+        VALUES ({', '.join(['?' for _ in Comment.SCHEMA])});
+    """
+
+    ADD_PARENT_QUERY = """
+        INSERT INTO parent
+        (parent_id, parent_type)
+        VALUES (?, ?)
+    """
+
     @classmethod
     def stats(cls) -> Dict:
         num_query = "SELECT COUNT(*) as num FROM comment;"
@@ -111,3 +120,71 @@ class CommentList:
         rows = DBHelper.get_query(get_query, id_list)
         comments = DBHelper.rows2dicts(rows)
         return [Comment(**comment) for comment in comments]
+
+    @staticmethod
+    def _page_query(
+        after_id: int = 0, 
+        limit: Optional[int] = None, 
+        begin_ts: Optional[int] = None, 
+        end_ts: Optional[int] = None
+    ) -> Tuple[str, List]:
+        """
+        keyset pagination: comments with id above `after_id` (ordered by id),
+        so each page is a range scan of the primary key, however deep it is
+        (`+unix_time` keeps sqlite from using timestamp index instead - 
+        that would sort all matching rows before returning the first one)
+        """
+        conditions, params = ["comment_id > ?"], [after_id]
+        if begin_ts is not None:
+            conditions.append("+unix_time >= ?")
+            params.append(begin_ts)
+        if end_ts is not None:
+            conditions.append("+unix_time <= ?")
+            params.append(end_ts)
+
+        get_query = f"""
+            SELECT * FROM comment
+            WHERE {' AND '.join(conditions)}
+            ORDER BY comment_id
+            {f'LIMIT {int(limit)}' if limit is not None else ''}
+        """
+        return get_query, params
+
+    @classmethod
+    def find_page(cls, after_id: int = 0, limit: int = 100, **filters) -> List[Comment]:
+        """
+        returns up to `limit` comments with id above `after_id` (ordered by id);
+        `filters` can have `begin_ts` and `end_ts`
+        """
+        rows = DBHelper.get_query(*cls._page_query(after_id, limit, **filters))
+        return [Comment(**row) for row in rows]
+
+    @classmethod
+    def iter_page(cls, after_id: int = 0, limit: Optional[int] = None, **filters) -> Generator[Comment, None, None]:
+        """
+        same as `find_page` but yields comments one by one straight from db cursor
+        (`limit` can be None to read all comments with id above `after_id`)
+        """
+        for row in DBHelper.iter_query(*cls._page_query(after_id, limit, **filters)):
+            yield Comment(**row)
+
+    @classmethod
+    def add_many(cls, comments: List[Comment]) -> None:
+        """
+        adds all comments to comment and parent tables 
+        and appends them to their story threads in a single transaction
+        """
+        if not comments:
+            return
+
+        DBHelper.mod_many([
+            (
+                cls.ADD_COMMENT_QUERY, 
+                [[getattr(comment, field) for field in Comment.SCHEMA] for comment in comments]
+            ),
+            (
+                cls.ADD_PARENT_QUERY, 
+                [(comment.comment_id, 'comment') for comment in comments]
+            ),
+            *StoryThreadList.get_append_queries(comments),
+        ])
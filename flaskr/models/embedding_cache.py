@@ -0,0 +1,140 @@
+from typing import Any, Dict, List, Tuple, Set, Optional, Generator, Union
+
+import time
+import hashlib
+import numpy as np
+
+from flaskr.utils.db_utils import DBHelper
+from flaskr.utils.embedding_utils import embedding2blob, blob2embedding
+
+class EmbeddingCache:
+    """
+    story embeddings cached in `embedding_cache` table for a single model;
+    each entry is keyed by (story_id, model_name) and stores the hash
+    of the story thread it was calculated from: the entry is only used
+    while the hash matches the current thread, so stories that got
+    new comments are re-embedded (and their entries overwritten);
+    when the table grows beyond `max_entries` least recently used
+    entries (of all models) are evicted;
+    the table is counted once, after that the number of entries
+    is tracked as an upper bound (puts can overwrite entries) 
+    and the table is only recounted when the bound exceeds `max_entries`
+    (entries written by other caches meanwhile are picked up on recount)
+    """
+    # ids per query (sqlite limits the number of query params)
+    CHUNK_SIZE = 500
+
+    PUT_QUERY = """
+        INSERT OR REPLACE INTO embedding_cache
+        (story_id, model_name, content_hash, embedding, last_used)
+        VALUES (?, ?, ?, ?, ?)
+    """
+
+    TOUCH_QUERY = """
+        UPDATE embedding_cache
+        SET last_used = ?
+        WHERE story_id = ? AND model_name = ?
+    """
+
+    EVICT_QUERY = """
+        DELETE FROM embedding_cache
+        WHERE rowid IN (
+            SELECT rowid FROM embedding_cache
+            ORDER BY last_used
+            LIMIT ?
+        )
+    """
+
+    def __init__(self, model_name: str, max_entries: Optional[int] = None):
+        self.model_name = model_name
+        self.max_entries = max_entries
+        self.stats = {'hits': 0, 'misses': 0, 'evicted': 0}
+        self._num_entries = None # upper bound of the number of entries (see `evict`)
+
+    @property
+    def hit_rate(self) -> float:
+        num = self.stats['hits'] + self.stats['misses']
+        return self.stats['hits'] / num if num else 0.
+
+    @staticmethod
+    def hash_content(text: Optional[str]) -> str:
+        return hashlib.blake2b((text or '').encode('utf-8'), digest_size=16).hexdigest()
+
+    def get_many(self, story_ids: List[int], hashes: List[str]) -> Dict[int, np.ndarray]:
+        """
+        returns {story_id: embedding} for the stories
+        that have a valid cached embedding (hash matches);
+        marks returned entries as recently used
+        """
+        expected = dict(zip(story_ids, hashes))
+        found = dict()
+        for i in range(0, len(story_ids), self.CHUNK_SIZE):
+            chunk = story_ids[i:i+self.CHUNK_SIZE]
+            get_query = f"""
+                SELECT story_id, content_hash, embedding FROM embedding_cache
+                WHERE
+                    model_name = ? AND
+                    story_id IN ({', '.join('?' for _ in chunk)})
+            """
+            for row in DBHelper.get_query(get_query, [self.model_name, *chunk]):
+                if row['content_hash'] == expected[row['story_id']]:
+                    found[row['story_id']] = blob2embedding(row['embedding'])
+
+        self.stats['hits'] += len(found)
+        self.stats['misses'] += len(expected) - len(found)
+
+        if found:
+            now = time.time_ns()
+            DBHelper.mod_many([(self.TOUCH_QUERY, [
+                (now, story_id, self.model_name) for story_id in found
+            ])])
+
+        return found
+
+    def get_put_queries(
+        self,
+        story_ids: List[int],
+        hashes: List[str],
+        embeddings: List[np.ndarray]
+    ) -> List[Tuple[str, List]]:
+        """
+        queries that add/overwrite cache entries (see `DBHelper.mod_many`)
+        """
+        now = time.time_ns()
+        return [(self.PUT_QUERY, [
+            (story_id, self.model_name, content_hash, embedding2blob(embedding), now)
+            for story_id, content_hash, embedding in zip(story_ids, hashes, embeddings)
+        ])]
+
+    def put_many(
+        self,
+        story_ids: List[int],
+        hashes: List[str],
+        embeddings: List[np.ndarray]
+    ) -> None:
+        DBHelper.mod_many(self.get_put_queries(story_ids, hashes, embeddings))
+        if self._num_entries is not None:
+            self._num_entries += len(story_ids)
+        self.evict()
+
+    def evict(self) -> int:
+        """
+        removes least recently used entries until the cache
+        has at most `max_entries` entries;
+        returns the number of removed entries
+        """
+        if self.max_entries is None:
+            return 0
+        if self._num_entries is not None and self._num_entries <= self.max_entries:
+            return 0
+
+        num = DBHelper.get_query("SELECT COUNT(*) AS num FROM embedding_cache", [])[0]['num']
+        excess = max(num - self.max_entries, 0)
+        self._num_entries = num - excess
+        if not excess:
+            return 0
+
+        DBHelper.mod_many([(self.EVICT_QUERY, [(excess,)])])
+        self.stats['evicted'] += excess
+        return excess
+
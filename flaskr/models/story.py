@@ -1,6 +1,16 @@
 from typing import Any, Dict, List, Tuple, Set, Optional, Generator, Union
 
+import numpy as np
+
 from flaskr.utils.db_utils import DBHelper
+from flaskr.utils.embedding_utils import (
+    embedding2blob,
+    embedding2str,
+    blob2embedding,
+    blobs2matrix,
+)
+from flaskr.utils.index_utils import StoryIndex
+from flaskr.models.thread import StoryThreadList
 
 class Story:
     SCHEMA = [
@@ -15,29 +25,9 @@ class Story:
         "comment_embedding"
     ]
 
-    RECURSIVE_CTE_WITHOUT_WHERE = """
-        WITH RECURSIVE tab(id, parent_id, root_id, level, title, body) AS (
-            SELECT 
-                s.story_id, 
-                s.story_id,
-                s.story_id,
-                1,
-                s.title,
-                s.title
-            FROM story AS s
-
-            UNION
-
-            SELECT
-                c.comment_id, 
-                c.parent_id,
-                tab.root_id,
-                tab.level + 1,
-                c.author,
-                c.body
-            FROM tab, comment as c WHERE c.parent_id = tab.id
-        ) 
-
+    # story fields + all story comments concatenated into a single html
+    # (read from `story_thread` table, see `flaskr.models.thread`)
+    SELECT_WITH_CHILDREN = """
         SELECT 
             s.story_id,
             s.author, 
@@ -47,15 +37,19 @@ class Story:
             s.url,
             s.num_comments,
             s.comment_embedding,
-            (
-                SELECT COALESCE(GROUP_CONCAT(body, "<br><br>"), " ")
-                FROM tab
-                WHERE root_id = s.story_id
-                GROUP BY root_id
-            ) AS children
+            COALESCE(t.children, " ") AS children
         FROM story AS s
+        LEFT JOIN story_thread AS t ON t.story_id = s.story_id
         """
 
+    # filters used to select stories for clustering
+    FILTER_WHERE = """
+        WHERE 
+            s.unix_time BETWEEN ? AND ? AND
+            s.num_comments BETWEEN ? AND ? AND
+            s.score BETWEEN ? AND ?
+    """
+
     def __init__(self, 
         story_id=None, author=None, unix_time=None, 
         title=None, score=None, num_comments=None,
@@ -83,10 +77,18 @@ class Story:
             "num_comments": self.num_comments,
             "body": self.body,
             "url": self.url,
-            "comment_embedding": self.comment_embedding,
+            "comment_embedding": embedding2str(self.comment_embedding),
             "children": self.children
         }
 
+    def params(self) -> List:
+        """values of schema fields in the form they are stored in db"""
+        return [
+            embedding2blob(self.comment_embedding) if field == 'comment_embedding' 
+            else getattr(self, field)
+            for field in self.SCHEMA
+        ]
+
     @classmethod
     def find_by_id(cls, story_id: int) -> Optional['Story']:
         get_query = """
@@ -99,7 +101,7 @@ class Story:
     @classmethod
     def find_by_id_with_children(cls, story_id: int) -> Optional['Story']:
         get_query = f"""
-            {cls.RECURSIVE_CTE_WITHOUT_WHERE}
+            {cls.SELECT_WITH_CHILDREN}
             WHERE s.story_id = ?
         """
         rows = DBHelper.get_query(get_query, [story_id])
@@ -107,50 +109,11 @@ class Story:
             return cls(**DBHelper.rows2dicts(rows)[0])
 
     def add(self) -> None:
-        # add to story table
-        add_story_query = f"""
-            INSERT INTO story
-            ({', '.join(self.SCHEMA)})
-            VALUES ({', '.join(['?' for _ in self.SCHEMA])});
-        """
-        story_params = [getattr(self, field) for field in self.SCHEMA]
-        DBHelper.mod_query(add_story_query, story_params)
-
-        # add to parent table
-        add_parent_query = """
-            INSERT INTO parent
-            (parent_id, parent_type)
-            VALUES (?, ?)
-        """
-        parent_params = (self.story_id, 'story')
-        DBHelper.mod_query(add_parent_query, parent_params)
+        # add to story and parent tables
+        StoryList.add_many([self])
 
     def update(self) -> None:
-        update_query = f"""
-            UPDATE story
-            SET 
-                author = ?, 
-                unix_time = ?, 
-                body = ?, 
-                url = ?, 
-                score = ?, 
-                title = ?, 
-                num_comments = ?,
-                comment_embedding = ?
-            WHERE story_id = ?;
-        """
-        params = [
-            self.author,
-            self.unix_time,
-            self.body,
-            self.url,
-            self.score,
-            self.title,
-            self.num_comments,
-            self.comment_embedding,
-            self.story_id
-        ]
-        DBHelper.mod_query(update_query, params)
+        StoryList.update_many([self])
 
     def delete(self) -> None:
         delete_story_query = """
@@ -159,10 +122,40 @@ class Story:
         delete_parent_query = """
             DELETE FROM parent WHERE parent_id = ?;
         """
-        DBHelper.mod_query(delete_story_query, [self.story_id])
-        DBHelper.mod_query(delete_parent_query, [self.story_id])
+        DBHelper.mod_many([
+            (delete_story_query, [[self.story_id]]),
+            (delete_parent_query, [[self.story_id]]),
+            *StoryThreadList.get_delete_queries([self.story_id]),
+        ])
+        StoryIndex.remove_shared([self.story_id])
 
 class StoryList:
+    ADD_STORY_QUERY = f"""
+        INSERT INTO story
+        ({', '.join(Story.SCHEMA)})
+        VALUES ({', '.join(['?' for _ in Story.SCHEMA])});
+    """
+
+    ADD_PARENT_QUERY = """
+        INSERT INTO parent
+        (parent_id, parent_type)
+        VALUES (?, ?)
+    """
+
+    UPDATE_STORY_QUERY = """
+        UPDATE story
+        SET 
+            author = ?, 
+            unix_time = ?, 
+            body = ?, 
+            url = ?, 
+            score = ?, 
+            title = ?, 
+            num_comments = ?,
+            comment_embedding = ?
+        WHERE story_id = ?;
+    """
+
     @classmethod
     def stats(cls) -> Dict:
         num_query = "SELECT COUNT(*) as num FROM story;"
@@ -185,12 +178,210 @@ class StoryList:
         stories = DBHelper.rows2dicts(rows)
         return [Story(**story) for story in stories]
 
+    @staticmethod
+    def _page_query(
+        after_id: int = 0, 
+        limit: Optional[int] = None, 
+        begin_ts: Optional[int] = None, 
+        end_ts: Optional[int] = None
+    ) -> Tuple[str, List]:
+        """
+        keyset pagination: stories with id above `after_id` (ordered by id),
+        so each page is a range scan of the primary key, however deep it is
+        (`+unix_time` keeps sqlite from using timestamp index instead - 
+        that would sort all matching rows before returning the first one)
+        """
+        conditions, params = ["story_id > ?"], [after_id]
+        if begin_ts is not None:
+            conditions.append("+unix_time >= ?")
+            params.append(begin_ts)
+        if end_ts is not None:
+            conditions.append("+unix_time <= ?")
+            params.append(end_ts)
+
+        get_query = f"""
+            SELECT * FROM story
+            WHERE {' AND '.join(conditions)}
+            ORDER BY story_id
+            {f'LIMIT {int(limit)}' if limit is not None else ''}
+        """
+        return get_query, params
+
+    @classmethod
+    def find_page(cls, after_id: int = 0, limit: int = 100, **filters) -> List[Story]:
+        """
+        returns up to `limit` stories with id above `after_id` (ordered by id);
+        `filters` can have `begin_ts` and `end_ts`
+        """
+        rows = DBHelper.get_query(*cls._page_query(after_id, limit, **filters))
+        return [Story(**row) for row in rows]
+
+    @classmethod
+    def iter_page(cls, after_id: int = 0, limit: Optional[int] = None, **filters) -> Generator[Story, None, None]:
+        """
+        same as `find_page` but yields stories one by one straight from db cursor
+        (`limit` can be None to read all stories with id above `after_id`)
+        """
+        for row in DBHelper.iter_query(*cls._page_query(after_id, limit, **filters)):
+            yield Story(**row)
+
     @classmethod
     def find_by_ids_with_children(cls, id_list: List[int]) -> List[Story]:
         get_query = f"""
-            {Story.RECURSIVE_CTE_WITHOUT_WHERE} 
-            WHERE story_id IN ({', '.join('?' for _ in id_list)})
+            {Story.SELECT_WITH_CHILDREN}
+            WHERE s.story_id IN ({', '.join('?' for _ in id_list)})
         """
         rows = DBHelper.get_query(get_query, id_list)
         stories = DBHelper.rows2dicts(rows)
-        return [Story(**story) for story in stories]
\ No newline at end of file
+        return [Story(**story) for story in stories]
+
+    @classmethod
+    def add_many(cls, stories: List[Story]) -> None:
+        """
+        adds all stories to story and parent tables 
+        and creates their threads in a single transaction
+        """
+        if not stories:
+            return
+
+        DBHelper.mod_many([
+            (
+                cls.ADD_STORY_QUERY, 
+                [story.params() for story in stories]
+            ),
+            (
+                cls.ADD_PARENT_QUERY, 
+                [(story.story_id, 'story') for story in stories]
+            ),
+            *StoryThreadList.get_add_queries(stories),
+        ])
+        cls._update_index(stories)
+
+    @classmethod
+    def update_many(cls, stories: List[Story]) -> None:
+        """
+        updates all stories and rebuilds their threads 
+        (title might have changed) in a single transaction
+        """
+        if not stories:
+            return
+
+        DBHelper.mod_many([
+            (
+                cls.UPDATE_STORY_QUERY, 
+                [
+                    [
+                        story.author,
+                        story.unix_time,
+                        story.body,
+                        story.url,
+                        story.score,
+                        story.title,
+                        story.num_comments,
+                        embedding2blob(story.comment_embedding),
+                        story.story_id
+                    ] for story in stories
+                ]
+            ),
+            *StoryThreadList.get_rebuild_queries([story.story_id for story in stories]),
+        ])
+        cls._update_index(stories)
+
+    @staticmethod
+    def _update_index(stories: List[Story]) -> None:
+        """
+        keeps similar story index (see `StoryIndex`) up to date with written embeddings
+        (stories without embeddings are removed from it)
+        """
+        StoryIndex.update_shared(
+            [story.story_id for story in stories],
+            [story.comment_embedding for story in stories]
+        )
+
+    @classmethod
+    def find_embeddings_by_ids(cls, id_list: List[int], chunk_size: int = 500) -> Tuple[List[int], np.ndarray]:
+        """
+        bulk reader for stored comment embeddings;
+        returns (ids, embeddings), where `ids` are the ids from `id_list` 
+        that have an embedding (in the same order as in `id_list`)
+        and `embeddings` is a contiguous float32 array of shape (len(ids), dim)
+        """
+        blobs = dict()
+        for i in range(0, len(id_list), chunk_size):
+            chunk = id_list[i:i+chunk_size]
+            get_query = f"""
+                SELECT story_id, comment_embedding FROM story
+                WHERE 
+                    story_id IN ({', '.join('?' for _ in chunk)}) AND
+                    comment_embedding IS NOT NULL
+            """
+            for row in DBHelper.get_query(get_query, chunk):
+                blobs[row['story_id']] = row['comment_embedding']
+
+        ids = [story_id for story_id in id_list if story_id in blobs]
+        return ids, blobs2matrix([blobs[story_id] for story_id in ids])
+
+    @classmethod
+    def update_embeddings(cls, id_list: List[int], embeddings: List[np.ndarray]) -> None:
+        """
+        writes comment embeddings of the specified stories in a single transaction
+        """
+        update_query = """
+            UPDATE story
+            SET comment_embedding = ?
+            WHERE story_id = ?
+        """
+        DBHelper.mod_many([(update_query, [
+            (embedding2blob(embedding), story_id) 
+            for story_id, embedding in zip(id_list, embeddings)
+        ])])
+        StoryIndex.update_shared(id_list, embeddings)
+
+    @classmethod
+    def iter_embeddings(cls, chunk_size: int = 10000) -> Generator[Tuple[List[int], np.ndarray], None, None]:
+        """
+        yields (ids, embeddings) of all stories with stored comment embeddings
+        in chunks of at most `chunk_size` stories (ordered by id)
+        """
+        get_query = f"""
+            SELECT story_id, comment_embedding FROM story
+            WHERE 
+                story_id > ? AND
+                comment_embedding IS NOT NULL
+            ORDER BY story_id
+            LIMIT {int(chunk_size)}
+        """
+        last_id = -1
+        while True:
+            rows = DBHelper.get_query(get_query, [last_id])
+            if not rows:
+                break
+            last_id = rows[-1]['story_id']
+            yield [row['story_id'] for row in rows], blobs2matrix([row['comment_embedding'] for row in rows])
+
+    @classmethod
+    def migrate_text_embeddings(cls, chunk_size: int = 1000) -> int:
+        """
+        converts comment embeddings stored as comma-joined text
+        (legacy format) to float32 blobs, one transaction per `chunk_size` stories;
+        returns the number of converted embeddings
+        """
+        get_query = f"""
+            SELECT story_id, comment_embedding FROM story
+            WHERE typeof(comment_embedding) = 'text'
+            LIMIT {int(chunk_size)}
+        """
+        num = 0
+        while True:
+            rows = DBHelper.get_query(get_query, [])
+            if not rows:
+                break
+
+            cls.update_embeddings(
+                [row['story_id'] for row in rows],
+                [blob2embedding(row['comment_embedding']) for row in rows]
+            )
+            num += len(rows)
+            print(f'[INFO] converted {num} embeddings')
+
+        return num
@@ -0,0 +1,256 @@
+from typing import Any, Dict, List, Tuple, Set, Optional, Generator, Union
+
+from flaskr.utils.db_utils import DBHelper
+
+class StoryThread:
+    """
+    all comments of a story concatenated into a single html
+    (`children`, starts with story title) + number of comments;
+    rows of `story_thread` table are kept up to date by
+    `StoryList` and `CommentList` write methods
+    """
+    SCHEMA = [
+        "story_id",
+        "children",
+        "num_comments"
+    ]
+
+    SEPARATOR = "<br><br>"
+
+    def __init__(self,
+        story_id=None, children=None, num_comments=None,
+        **kwargs
+    ):
+        self.story_id = story_id
+        self.children = children
+        self.num_comments = num_comments
+
+    def json(self) -> Dict:
+        return {
+            "story_id": self.story_id,
+            "children": self.children,
+            "num_comments": self.num_comments
+        }
+
+    @classmethod
+    def find_by_id(cls, story_id: int) -> Optional['StoryThread']:
+        get_query = """
+            SELECT * FROM story_thread WHERE story_id = ?
+        """
+        rows = DBHelper.get_query(get_query, [story_id])
+        if rows:
+            return cls(**rows[0])
+
+class StoryThreadList:
+    # tree is collected top-down from the selected stories;
+    # `UNION ALL` is safe: each comment has a single parent,
+    # so a comment can't be reached twice from a story
+    REBUILD_QUERY_TEMPLATE = f"""
+        INSERT OR REPLACE INTO story_thread
+        (story_id, children, num_comments)
+        WITH RECURSIVE tab(id, root_id, body) AS (
+            SELECT s.story_id, s.story_id, s.title
+            FROM story AS s
+            {{where}}
+
+            UNION ALL
+
+            SELECT c.comment_id, tab.root_id, c.body
+            FROM tab JOIN comment AS c ON c.parent_id = tab.id
+        )
+        SELECT
+            root_id,
+            COALESCE(GROUP_CONCAT(body, "{StoryThread.SEPARATOR}"), " "),
+            COUNT(*) - 1
+        FROM tab
+        GROUP BY root_id
+    """
+
+    REBUILD_QUERY = REBUILD_QUERY_TEMPLATE.replace("{where}", "WHERE s.story_id = ?")
+
+    APPEND_QUERY = f"""
+        UPDATE story_thread
+        SET
+            children = COALESCE(children || "{StoryThread.SEPARATOR}" || ?, children, ?),
+            num_comments = num_comments + 1
+        WHERE story_id = ?
+    """
+
+    DELETE_QUERY = """
+        DELETE FROM story_thread WHERE story_id = ?
+    """
+
+    # ids per query (sqlite limits the number of query params)
+    CHUNK_SIZE = 500
+
+    @classmethod
+    def find_by_ids(cls, id_list: List[int]) -> List[StoryThread]:
+        get_query = f"""
+            SELECT * FROM story_thread
+            WHERE story_id IN ({', '.join('?' for _ in id_list)})
+        """
+        rows = DBHelper.get_query(get_query, id_list)
+        return [StoryThread(**row) for row in rows]
+
+    @classmethod
+    def iter_children_by_ids(
+        cls, 
+        id_list: List[int], 
+        chunk_size: int = CHUNK_SIZE
+    ) -> Generator[List[Tuple[int, str]], None, None]:
+        """
+        yields lists of (story_id, children) for the specified stories,
+        one indexed query per `chunk_size` ids
+        (stories without a thread are omitted)
+        """
+        for i in range(0, len(id_list), chunk_size):
+            chunk = id_list[i:i+chunk_size]
+            get_query = f"""
+                SELECT story_id, children FROM story_thread
+                WHERE story_id IN ({', '.join('?' for _ in chunk)})
+            """
+            yield [
+                (row['story_id'], row['children']) 
+                for row in DBHelper.get_query(get_query, chunk)
+            ]
+
+    @classmethod
+    def find_roots(cls, comment_ids: List[int]) -> Dict[int, int]:
+        """
+        walks up the comment trees from the comments that are already in db;
+        returns {comment_id: root story id}
+        (comments that don't lead to a story in db are omitted)
+        """
+        roots = dict()
+        for i in range(0, len(comment_ids), cls.CHUNK_SIZE):
+            chunk = comment_ids[i:i+cls.CHUNK_SIZE]
+            get_query = f"""
+                WITH RECURSIVE up(comment_id, parent_id) AS (
+                    SELECT comment_id, parent_id
+                    FROM comment
+                    WHERE comment_id IN ({', '.join('?' for _ in chunk)})
+
+                    UNION ALL
+
+                    SELECT up.comment_id, c.parent_id
+                    FROM up JOIN comment AS c ON c.comment_id = up.parent_id
+                )
+                SELECT up.comment_id, s.story_id AS root_id
+                FROM up JOIN story AS s ON s.story_id = up.parent_id
+            """
+            for row in DBHelper.get_query(get_query, chunk):
+                roots[row['comment_id']] = row['root_id']
+        return roots
+
+    @classmethod
+    def resolve_roots(cls, comments: List[Any]) -> Dict[int, int]:
+        """
+        finds root story id for each comment from the list;
+        comments don't need to be in db yet: their parents can be
+        stories or comments in db or other comments from the list;
+        returns {comment_id: root story id}
+        (comments whose root can't be found are omitted)
+        """
+        parents = {comment.comment_id: comment.parent_id for comment in comments}
+        outside = list({pid for pid in parents.values() if pid not in parents})
+
+        # parents outside the list are either stories or comments in db
+        roots = dict()
+        for i in range(0, len(outside), cls.CHUNK_SIZE):
+            chunk = outside[i:i+cls.CHUNK_SIZE]
+            get_query = f"""
+                SELECT story_id FROM story
+                WHERE story_id IN ({', '.join('?' for _ in chunk)})
+            """
+            roots.update({row['story_id']: row['story_id'] for row in DBHelper.get_query(get_query, chunk)})
+        roots.update(cls.find_roots([pid for pid in outside if pid not in roots]))
+
+        # parents inside the list: follow the chain until we leave the list
+        resolved = dict()
+        for comment_id in parents:
+            path, node = [], comment_id
+            while node in parents and node not in resolved and node not in path:
+                path.append(node)
+                node = parents[node]
+            root = resolved.get(node, roots.get(node))
+            for node in path:
+                resolved[node] = root
+
+        return {cid: root for cid, root in resolved.items() if root is not None}
+
+    @classmethod
+    def get_add_queries(cls, stories: List[Any]) -> List[Tuple[str, List]]:
+        """
+        queries that create threads for new stories (see `DBHelper.mod_many`);
+        threads are collected from db, 
+        in case some comments were added before their story
+        """
+        return cls.get_rebuild_queries([story.story_id for story in stories])
+
+    @classmethod
+    def get_append_queries(cls, comments: List[Any]) -> List[Tuple[str, List]]:
+        """
+        queries that append new comments to their story threads
+        (see `DBHelper.mod_many`);
+        threads of comments that already have replies in db 
+        (replies were added before their parent) are rebuilt instead,
+        since these replies only become reachable from the story now
+        """
+        roots = cls.resolve_roots(comments)
+
+        comment_ids = [comment.comment_id for comment in comments]
+        with_replies = set()
+        for i in range(0, len(comment_ids), cls.CHUNK_SIZE):
+            chunk = comment_ids[i:i+cls.CHUNK_SIZE]
+            get_query = f"""
+                SELECT DISTINCT parent_id FROM comment
+                WHERE parent_id IN ({', '.join('?' for _ in chunk)})
+            """
+            with_replies.update(row['parent_id'] for row in DBHelper.get_query(get_query, chunk))
+        rebuilt = {roots[cid] for cid in with_replies if cid in roots}
+
+        return [
+            (cls.APPEND_QUERY, [
+                (comment.body, comment.body, roots[comment.comment_id])
+                for comment in comments 
+                if comment.comment_id in roots and roots[comment.comment_id] not in rebuilt
+            ]),
+            *cls.get_rebuild_queries(sorted(rebuilt)),
+        ]
+
+    @classmethod
+    def get_rebuild_queries(cls, story_ids: List[int]) -> List[Tuple[str, List]]:
+        """
+        queries that recollect threads of the specified stories from scratch
+        (see `DBHelper.mod_many`)
+        """
+        return [(cls.REBUILD_QUERY, [(story_id,) for story_id in story_ids])]
+
+    @classmethod
+    def get_delete_queries(cls, story_ids: List[int]) -> List[Tuple[str, List]]:
+        return [(cls.DELETE_QUERY, [(story_id,) for story_id in story_ids])]
+
+    @classmethod
+    def rebuild(cls, story_ids: List[int]) -> None:
+        DBHelper.mod_many(cls.get_rebuild_queries(story_ids))
+
+    @classmethod
+    def backfill(cls, chunk_size: int = CHUNK_SIZE) -> int:
+        """
+        (re)builds threads for all the stories in db,
+        one transaction per `chunk_size` stories;
+        returns the number of processed stories
+        """
+        story_ids = [row['story_id'] for row in DBHelper.get_query(
+            "SELECT story_id FROM story ORDER BY story_id", []
+        )]
+
+        for i in range(0, len(story_ids), chunk_size):
+            chunk = story_ids[i:i+chunk_size]
+            rebuild_query = cls.REBUILD_QUERY_TEMPLATE.replace(
+                "{where}", f"WHERE s.story_id IN ({', '.join('?' for _ in chunk)})"
+            )
+            DBHelper.mod_many([(rebuild_query, [chunk])])
+            print(f'[INFO] rebuilt threads for {min(i + chunk_size, len(story_ids))}/{len(story_ids)} stories')
+
+        return len(story_ids)
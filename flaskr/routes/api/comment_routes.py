@@ -15,7 +15,7 @@ from flaskr.models.comment import (
     CommentList,
 )
 
-from flaskr.routes.api.general_routes import validate
+from flaskr.routes.api.general_routes import validate, list_items, PAGE_ARGS
 
 
 def validate_comment(item):
@@ -48,10 +48,61 @@ def get_comment_by_id(id):
             "message": f"item `{id}` not found",
     }), 404
 
+def add_comment_list_to_db(items):
+    """
+    adds list of comments to db in batches of `API_WRITE_BATCH_SIZE`
+    (one transaction per batch);
+    comments that are already in db are skipped
+    """
+    try:
+        for item in items:
+            validate_comment(item)
+    except Exception as e:
+        print(e.args[0])
+        return jsonify({
+            "message": e.args[0],
+            "errors": e.args[0]
+        }), 400
+
+    # drop duplicates, keep the first occurrence
+    unique = dict()
+    for item in items:
+        unique.setdefault(item['comment_id'], item)
+    items = list(unique.values())
+
+    batch_size = app.config.get('API_WRITE_BATCH_SIZE', 500)
+    added, skipped = [], []
+    try:
+        for i in range(0, len(items), batch_size):
+            batch = items[i:i+batch_size]
+            existing = {
+                comment.comment_id 
+                for comment in CommentList.find_by_ids([item['comment_id'] for item in batch])
+            }
+            comments = [Comment(**item) for item in batch if item['comment_id'] not in existing]
+            CommentList.add_many(comments)
+
+            added.extend(comments)
+            skipped.extend(sorted(existing))
+
+        print(f"added {len(added)} comments to db, skipped {len(skipped)}")
+        return jsonify({
+            "message": f"added {len(added)} comments to db, skipped {len(skipped)} already in db",
+            "data": [comment.json() for comment in added],
+            "skipped": skipped
+        }), 201
+    except Exception as e:
+        print(e.args[0])
+        return jsonify({
+            "message": f"couldn't add comments to db (added {len(added)})",
+            "errors": e.args[0]
+        }), 500
+
 @app.route("/api/comments/", methods=["POST"], strict_slashes=False)
 def add_comment_to_db():
     """
     adds comment in db
+    (body can also be a list of such comments - see `add_comment_list_to_db`)
     expects the following body:
     {
         "comment_id": ...,
@@ -70,6 +121,9 @@ def add_comment_to_db():
             "errors": e.args[0]
         }), 400
 
+    if isinstance(item, list):
+        return add_comment_list_to_db(item)
+
     try:
         validate_comment(item)
     except Exception as e:
@@ -191,9 +245,14 @@ def get_comments_by_id():
     """
     fetches comments with specified ids from db;
     comments are returned in json's `data` field;
-    use as `/db/comments?ids=1,2,3`
+    use as `/api/comments?ids=1,2,3`;
+    without `ids` comments are listed page by page 
+    (`/api/comments?after_id=<id>&limit=<limit>&ts_from=<ts>&ts_to=<ts>`)
+    or streamed as ndjson (`&format=ndjson`), see `list_items`
     """
     if request.args.get("ids") is None:
+        if set(request.args.keys()) <= PAGE_ARGS:
+            return list_items(CommentList, 'comment_id', 'comments')
         print("could not understand the request; ")
         return jsonify({
             "message": (
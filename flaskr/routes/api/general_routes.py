@@ -1,6 +1,8 @@
 from flask import (
     current_app as app,
     request,
+    json,
+    stream_with_context,
 )
 from flask.json import jsonify
 
@@ -23,6 +25,84 @@ def validate(item, schema, item_type='item', optional={}):
                 f"got {type(item[field])}"
             )
 
+PAGE_ARGS = {"after_id", "limit", "ts_from", "ts_to", "format"}
+
+def parse_page_args(args) -> dict:
+    """
+    parses query string of paginated list routes:
+        after_id: only items with id above it are listed (default: 0)
+        limit: max number of listed items 
+            (default: `API_PAGE_SIZE`, at most `API_MAX_PAGE_SIZE`; 
+            ndjson streams have no limit by default)
+        ts_from, ts_to: min and max item timestamp in seconds
+        format: `json` (default) or `ndjson`
+    raises ValueError if query string can't be parsed
+    """
+    unknown = set(args.keys()) - PAGE_ARGS
+    if unknown:
+        raise ValueError(f"unknown query parameters: {sorted(unknown)}, expected any of {sorted(PAGE_ARGS)}")
+
+    fmt = args.get("format", "json")
+    if fmt not in ["json", "ndjson"]:
+        raise ValueError(f"`format` should be `json` or `ndjson`, got `{fmt}`")
+    ndjson = fmt == "ndjson" or request.accept_mimetypes.best == "application/x-ndjson"
+
+    try:
+        parsed = {
+            "after_id": int(args.get("after_id", 0)),
+            "begin_ts": int(args["ts_from"]) if args.get("ts_from") is not None else None,
+            "end_ts": int(args["ts_to"]) if args.get("ts_to") is not None else None,
+        }
+        limit = args.get("limit")
+        limit = int(limit) if limit is not None else None
+    except ValueError:
+        raise ValueError("`after_id`, `limit`, `ts_from` and `ts_to` should be integers")
+
+    if not ndjson:
+        limit = limit if limit is not None else app.config.get("API_PAGE_SIZE", 100)
+        limit = min(limit, app.config.get("API_MAX_PAGE_SIZE", 1000))
+    if limit is not None and limit < 1:
+        raise ValueError(f"`limit` should be positive, got {limit}")
+
+    return {**parsed, "limit": limit, "ndjson": ndjson}
+
+def list_items(item_list, id_field: str, item_type: str = 'items'):
+    """
+    keyset-paginated listing of `item_list` (`StoryList` or `CommentList`), 
+    see `parse_page_args` for query string;
+    json: page of items in json's `data` field 
+    and id to continue from in `next_after_id` field (None on the last page);
+    ndjson: one item per line, streamed straight from db cursor
+    """
+    try:
+        args = parse_page_args(request.args)
+    except ValueError as e:
+        return jsonify({
+            "message": f"could not understand the request: {e.args[0]}",
+            "errors": e.args[0]
+        }), 400
+
+    ndjson = args.pop("ndjson")
+    try:
+        if ndjson:
+            lines = (json.dumps(item.json()) + "\n" for item in item_list.iter_page(**args))
+            return app.response_class(stream_with_context(lines), mimetype="application/x-ndjson")
+
+        items = item_list.find_page(**args)
+        next_after_id = getattr(items[-1], id_field) if len(items) == args["limit"] else None
+        print(f"got {len(items)} {item_type} from db")
+        return jsonify({
+            "message": f"got {len(items)} {item_type} from db",
+            "data": [item.json() for item in items],
+            "next_after_id": next_after_id,
+        }), 200
+    except Exception as e:
+        print(e.args[0])
+        return jsonify({
+            "message": f"couldn't get {item_type} from db",
+            "errors": e.args[0],
+        }), 500
+
 @app.route("/api/", strict_slashes=False)
 def get_api_routes():
     """
@@ -31,11 +111,14 @@ def get_api_routes():
     return jsonify([
         {"GET": "/api/meta/"},
         {"GET": "/api/stories?ids=<id1>,<id2>"},
+        {"GET": "/api/stories?after_id=<id>&limit=<limit>&ts_from=<ts>&ts_to=<ts>&format=<json|ndjson>"},
         {"GET": "/api/stories/<id>/"},
+        {"GET": "/api/stories/<id>/similar?k=<k>"},
         {"POST": "/api/stories/"},
         {"PUT": "/api/stories/<id>/"},
         {"DELETE": "/api/stories/<id>/"},
         {"GET": "/api/comments?ids=<id1>,<id2>"},
+        {"GET": "/api/comments?after_id=<id>&limit=<limit>&ts_from=<ts>&ts_to=<ts>&format=<json|ndjson>"},
         {"GET": "/api/comments/<id>/"},
         {"POST": "/api/comments/"},
         {"PUT": "/api/comments/<id>/"},
@@ -15,7 +15,8 @@ from flaskr.models.comment import (
     CommentList,
 )
 
-from flaskr.routes.api.general_routes import validate
+from flaskr.routes.api.general_routes import validate, list_items, PAGE_ARGS
+from flaskr.utils.index_utils import StoryIndex
 
 
 def validate_story(item):
@@ -54,10 +55,101 @@ def get_story_by_id(id):
             "errors": f"item `{id}` not found"
         }), 404
 
+@app.route("/api/stories/<string:id>/similar", strict_slashes=False)
+def get_similar_stories(id):
+    """
+    gets `k` stories whose comment embeddings are most similar (cosine) 
+    to the comment embedding of the story with specified id
+    (see `StoryIndex`), most similar first; 
+    use as: /api/stories/<id>/similar?k=<number of stories, default: 10, max: 100>;
+    each story in json's `data` field has `similarity` field
+    (embeddings are not included)
+    """
+    try:
+        story_id = int(id)
+        k = min(max(int(request.args.get("k", 10)), 1), 100)
+    except ValueError as e:
+        return jsonify({
+            "message": "story id and `k` should be integers",
+            "errors": e.args[0]
+        }), 400
+
+    neighbours = StoryIndex.get_shared().search_by_id(story_id, k=k)
+    if neighbours is None:
+        print(f"item {id} has no embedding")
+        return jsonify({
+            "message": f"item `{id}` not found or has no embedding",
+            "errors": f"item `{id}` not found or has no embedding"
+        }), 404
+
+    id2story = {
+        story.story_id: story.json() 
+        for story in StoryList.find_by_ids([story_id for story_id, _ in neighbours])
+    }
+    stories = [
+        {**id2story[story_id], "comment_embedding": None, "similarity": similarity}
+        for story_id, similarity in neighbours if story_id in id2story
+    ]
+    return jsonify({
+        "message": f"got {len(stories)} stories similar to `{id}`",
+        "data": stories
+    })
+
+def add_story_list_to_db(items):
+    """
+    adds list of stories to db in batches of `API_WRITE_BATCH_SIZE`
+    (one transaction per batch);
+    stories that are already in db are skipped
+    """
+    try:
+        for item in items:
+            validate_story(item)
+    except Exception as e:
+        print(e.args[0])
+        return jsonify({
+            "message": e.args[0],
+            "errors": e.args[0]
+        }), 400
+
+    # drop duplicates, keep the first occurrence
+    unique = dict()
+    for item in items:
+        unique.setdefault(item['story_id'], item)
+    items = list(unique.values())
+
+    batch_size = app.config.get('API_WRITE_BATCH_SIZE', 500)
+    added, skipped = [], []
+    try:
+        for i in range(0, len(items), batch_size):
+            batch = items[i:i+batch_size]
+            existing = {
+                story.story_id 
+                for story in StoryList.find_by_ids([item['story_id'] for item in batch])
+            }
+            stories = [Story(**item) for item in batch if item['story_id'] not in existing]
+            StoryList.add_many(stories)
+
+            added.extend(stories)
+            skipped.extend(sorted(existing))
+
+        print(f"added {len(added)} stories to db, skipped {len(skipped)}")
+        return jsonify({
+            "message": f"added {len(added)} stories to db, skipped {len(skipped)} already in db",
+            "data": [story.json() for story in added],
+            "skipped": skipped
+        }), 201
+    except Exception as e:
+        print(e.args[0])
+        return jsonify({
+            "message": f"couldn't add stories to db (added {len(added)})",
+            "errors": e.args[0]
+        }), 500
+
 @app.route("/api/stories/", methods=["POST"], strict_slashes=False)
 def add_story_to_db():
     """
     adds story in db
+    (body can also be a list of such stories - see `add_story_list_to_db`)
     expects the following body:
     {
         "story_id": ...,
@@ -81,6 +173,9 @@ def add_story_to_db():
             "errors": e.args[0]
         }), 400
 
+    if isinstance(item, list):
+        return add_story_list_to_db(item)
+
     try:
         validate_story(item)
     except Exception as e:
@@ -209,9 +304,14 @@ def get_stories_by_id():
     fetches stories with specified ids from db;
     stories are returned in json's `data` field;
     stories contain additional field `children` with all comments in a single html;
-    use as `/api/stories?ids=1,2,3`
+    use as `/api/stories?ids=1,2,3`;
+    without `ids` stories are listed page by page 
+    (`/api/stories?after_id=<id>&limit=<limit>&ts_from=<ts>&ts_to=<ts>`)
+    or streamed as ndjson (`&format=ndjson`), see `list_items`
     """
     if request.args.get("ids") is None:
+        if set(request.args.keys()) <= PAGE_ARGS:
+            return list_items(StoryList, 'story_id', 'stories')
         return jsonify({
             "message": (
                 "could not understand the request; "
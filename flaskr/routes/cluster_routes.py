@@ -1,4 +1,5 @@
 import os
+import time
 
 from flask import (
     current_app as app,
@@ -8,23 +9,75 @@ from flask.json import jsonify
 
 from flaskr.utils.form_utils import RequestParser as rqparser
 from flaskr.utils.clusterpipe_utils import Clusterer
-from flaskr.utils.io_utils import ClustererSerializer
+from flaskr.utils.io_utils import ClustererSerializer, ClusteringResult
+from flaskr.utils.model_utils import ClusteringModel
 from flaskr.utils.nlp_utils import ClusterFrequencyCounter
 from flaskr.utils.cluster_utils import TSNEer
+from flaskr.utils.job_utils import Job, get_job_runner
 
 
 # set globals
 CORPUS_DIR = 'data'
-DF_FNAME = os.path.join(CORPUS_DIR, 'df.csv')
+DF_FNAME = os.path.join(CORPUS_DIR, 'df.npz') # see `ClusteringResult`
 DFT_FNAME = os.path.join(CORPUS_DIR, 'df_tsne.csv')
 PCA_FNAME = os.path.join(CORPUS_DIR, 'pca.txt')
+SCALER_FNAME = os.path.join(CORPUS_DIR, 'scaler.npz')
+MODEL_DIR = os.path.join(CORPUS_DIR, 'models') # see `ClusteringModel`
 
 
 # cluster routes
+# clustering, t-SNE and wordcloud run as background jobs (see `job_utils.JobRunner`):
+# routes respond with job id right away, job progress is available at `/jobs/<job_id>`;
+# jobs read and write shared files in `data` (result, scaler, pca, models, visuals),
+# so they are submitted as exclusive and run one at a time regardless of `JOB_WORKERS`
+def submitted(job: Job, message: str):
+    return jsonify({
+        "message": message,
+        "data": {"job_id": job.id},
+        "ok": True
+    }), 202
+
+def cluster_posts(job: Job, request_form: dict, model_dir: str) -> None:
+    name, created = os.path.basename(model_dir), int(time.time())
+    clusterer = Clusterer()
+    clusterer.change.append(job.track)
+    serializer = ClustererSerializer(clusterer)
+    serializer.add(serializer.serialize_clustering_result(
+        DF_FNAME, meta=ClusteringModel.get_result_stamp(name, created)
+    ))
+    serializer.add(serializer.serialize_pca_explained_variance(PCA_FNAME))
+    serializer.add(serializer.serialize_standardizer(SCALER_FNAME))
+
+    try:
+        clusterer\
+            .set\
+                .model_name(request_form['model_name'])\
+                .cache_size(app.config['EMBEDDING_CACHE_SIZE'])\
+                .n_workers(app.config['EMBEDDING_WORKERS'])\
+                .n_clusters(request_form['n_clusters'])\
+                .n_pca_dims(100)\
+                .min_batch_size(100)\
+                .begin_timestep(request_form['begin_ts'])\
+                .end_timestep(request_form['end_ts'])\
+                .begin_comments(request_form['begin_comm'])\
+                .end_comments(request_form['end_comm'])\
+                .begin_score(request_form['begin_score'])\
+                .end_score(request_form['end_score'])\
+            .build()\
+            .run()
+
+        # result already replaced `DF_FNAME`: its model is saved even if the job is cancelled
+        job.set_stage('saving model', cancellable=False)
+        ClusteringModel.from_clusterer(
+            clusterer, result_fname=DF_FNAME, name=name, created=created
+        ).save(model_dir)
+    finally:
+        clusterer.close() # spills are not needed once results are saved
+
 @app.route("/cluster/new", methods=["POST"])
 def cluster_posts_and_serialize_results():
     """
-    runs preprocessing and clustering pipeline and serializes results on disk;
+    starts preprocessing and clustering pipeline job that serializes results on disk;
     request body should be:
     {
         "sender": "clusterer",
@@ -34,72 +87,155 @@ def cluster_posts_and_serialize_results():
         "show-comm-end-range": <max number of comment>,
         "show-score-begin-range": <min score>,
         "show-score-end-range": <max score>,
-        "num-clusters": <number of clusters>
+        "num-clusters": <number of clusters>,
+        "model-name": <sentence transformer name>,
+        "cluster-model": <optional name under which fitted model is stored, default: `default`>
     }
+    fitted model can later be used to assign new stories (see `/cluster/update`)
+    as long as its result is not overwritten by another model
     """
     try:
         request_form = rqparser.parse(request)
+        model_dir = ClusteringModel.get_model_dir(
+            MODEL_DIR, request_form.get('cluster_model', 'default')
+        )
+    except (KeyError, ValueError, NameError, TypeError) as e:
+        return jsonify({
+            "message": "could not understand the request",
+            "errors": e.args[0]
+        }), 400
+
+    job = get_job_runner().submit('cluster', cluster_posts, request_form, model_dir, exclusive=True)
+    return submitted(job, "started clustering pipeline")
 
-        clusterer = Clusterer()
-        serializer = ClustererSerializer(clusterer)
-        serializer.add(serializer.serialize_clustering_result(DF_FNAME))
-        serializer.add(serializer.serialize_pca_explained_variance(PCA_FNAME))
+def assign_new_posts(job: Job, request_form: dict, model_dir: str) -> dict:
+    model = ClusteringModel.load(model_dir)
+    if not ClusteringModel.owns_result(model.meta):
+        raise RuntimeError(f'Clustering result on disk was not produced by {os.path.basename(model_dir)} model')
+    result_fname = model.meta['result_fname']
+    clustered_ids = ClusteringResult.read(result_fname, ['id'])['id']
+    end_ts = request_form.get('end_ts', int(time.time()))
 
+    clusterer = Clusterer()
+    clusterer.change.append(job.track)
+    serializer = ClustererSerializer(clusterer)
+    serializer.add(serializer.serialize_clustering_result(result_fname, append=True))
+
+    try:
         clusterer\
             .set\
-                .n_clusters(request_form['n_clusters'])\
-                .n_pca_dims(100)\
+                .fitted_model(model)\
+                .end_timestep(max(end_ts, model.meta['end_ts']))\
+                .exclude_ids(clustered_ids)\
+                .partial_fit(request_form['partial_fit'])\
+                .cache_size(app.config['EMBEDDING_CACHE_SIZE'])\
+                .n_workers(app.config['EMBEDDING_WORKERS'])\
                 .min_batch_size(100)\
-                .begin_timestep(request_form['begin_ts'])\
-                .end_timestep(request_form['end_ts'])\
-                .begin_comments(request_form['begin_comm'])\
-                .end_comments(request_form['end_comm'])\
-                .begin_score(request_form['begin_score'])\
-                .end_score(request_form['end_score'])\
             .build()\
-            .run()
-        
+            .run_incremental()
+
+        # result is already extended: model is saved even if the job is cancelled
+        job.set_stage('saving model', cancellable=False)
+        model.meta['end_ts'] = clusterer._end_ts
+        model.save(model_dir)
+    finally:
+        clusterer.close()
+
+    return {
+        "num_new": clusterer._num_stories,
+        "num_total": model.meta['num_stories'],
+    }
+
+@app.route("/cluster/update", methods=["POST"])
+def assign_new_posts_and_serialize_results():
+    """
+    starts a job that assigns stories that were added to db since the model was fitted 
+    (see `/cluster/new`) to the existing clusters without refitting the pipeline:
+    new stories are embedded, standardized and reduced with the stored scaler and pca
+    and appended to `data/df.npz`;
+    request body should be:
+    {
+        "sender": "updater",
+        "cluster-model": <name of stored model>,
+        "partial-fit": <1 to also update cluster centers with new stories, 0 otherwise>,
+        "show-ts-end-range": <optional max item timestamp in seconds, default: now>
+    }
+    job result has the number of new and all clustered stories;
+    responds with 409 if `data/df.npz` was since overwritten by another model
+    """
+    try:
+        request_form = rqparser.parse(request)
+        model_dir = ClusteringModel.get_model_dir(MODEL_DIR, request_form['cluster_model'])
+    except (KeyError, ValueError, NameError, TypeError) as e:
         return jsonify({
-            "message": f"ran clustering pipeline and serialized results",
-            "ok": True
-        })
-    except Exception as e:
-        print(f'[ERR: /cluster/new] {e}')
+            "message": (
+                'could not understand the request; should be ' + 
+                '{"sender": "updater", "cluster-model": <model name>, "partial-fit": <0 or 1>}'
+            ),
+            "errors": e.args[0]
+        }), 400
+
+    if not ClusteringModel.exists(model_dir):
         return jsonify({
-            "errors": e.args[0],
-        }), 500
+            "message": f"clustering model {request_form['cluster_model']} not found",
+        }), 404
+
+    if not ClusteringModel.owns_result(ClusteringModel.read_meta(model_dir)):
+        msg = (
+            f"clustering result on disk was not produced by {request_form['cluster_model']} model " +
+            "(it was overwritten by another model); refit it with `/cluster/new`"
+        )
+        return jsonify({
+            "message": msg,
+            "errors": msg
+        }), 409
+
+    job = get_job_runner().submit('update', assign_new_posts, request_form, model_dir, exclusive=True)
+    return submitted(job, f"started assigning new posts to clusters of {request_form['cluster_model']} model")
+
+def count_cluster_frequencies(job: Job) -> dict:
+    job.set_stage('counting tokens')
+    counter = ClusterFrequencyCounter(n_workers=app.config['TOKENIZER_WORKERS'])
+    counter.count_serialized_cluster_frequencies(DF_FNAME, progress=job.update)
+    job.set_stage('serializing')
+    counter.serialize_cluster_frequencies(data_dir=CORPUS_DIR, min_freq=2)
+
+    return {"num_clusters": len(counter.frequencies.keys())}
 
 @app.route("/cluster/visuals/wordcloud", methods=["POST"])
 def serialize_data_for_wordcloud():
     """
-    requires `data/df.csv` to be present - it is used to read story labels;
-    collects all comments or all stories for each cluster,
+    requires `data/df.npz` to be present - it is used to read story labels;
+    starts a job that collects all comments or all stories for each cluster,
     calculates token frequencies for each cluster 
     and serializes result to disk
     so that it can be used by dashapp;
+    job result has the number of clusters
     """
-    try:
-        counter = ClusterFrequencyCounter()
-        counter.count_serialized_cluster_frequencies(DF_FNAME)
-        counter.serialize_cluster_frequencies(data_dir=CORPUS_DIR, min_freq=2)
-
-        return jsonify({
-            "message": f"calculated token frequencies required for wordcloud and serialized result",
-            "data": {"num_clusters": len(counter.frequencies.keys())},
-            "ok": True
-        })
+    job = get_job_runner().submit('wordcloud', count_cluster_frequencies, exclusive=True)
+    return submitted(job, "started calculating token frequencies required for wordcloud")
 
-    except Exception as e:
-        print(f'[ERR: /cluster/visuals/wordcloud] {e}')
-        return jsonify({
-            "errors": e.args[0],
-        }), 500
+def embed_with_tsne(job: Job, perplexity: int, dims: int) -> None:
+    tsneer = TSNEer(
+        random_state=42, 
+        n_components=2, 
+        perplexity=perplexity
+    )
+    job.set_stage('reading embeddings')
+    embeddings = tsneer.read_embedding_from_result(
+        DF_FNAME, 
+        dims=dims
+    )
+    job.set_stage('t-SNE', len(embeddings))
+    tsneer.reduce_embedding_dimensions(embeddings)
+    job.set_stage('serializing')
+    tsneer.serialize_results(DFT_FNAME)
 
 @app.route("/cluster/visuals/tsne", methods=["POST"])
 def serialize_data_for_tsne():
     """
-    requires `data/df.csv` to be present - it is used to read pca embeddings;
-    reads pca embeddings, calculates tsne embeddings 
+    requires `data/df.npz` to be present - it is used to read pca embeddings;
+    starts a job that reads pca embeddings (memory-mapped), calculates tsne embeddings 
     and serializes them to disk (`data/df_tsne.csv`);
     request body shoud be:
     {
@@ -110,28 +246,14 @@ def serialize_data_for_tsne():
     """
     try:    
         form_request = rqparser.parse(request)
-        perplexity = min(max(form_request['perplexity'], 5), 50)
-        dims = min(max(form_request['dims'], 2), 100)
+    except (KeyError, ValueError, NameError, TypeError) as e:
+        return jsonify({
+            "message": "could not understand the request",
+            "errors": e.args[0]
+        }), 400
 
-        tsneer = TSNEer(
-            random_state=42, 
-            n_components=2, 
-            perplexity=perplexity
-        )
-        embeddings = tsneer.read_embedding_from_csv(
-            DF_FNAME, 
-            dims=dims
-        )
-        tsneer.reduce_embedding_dimensions(embeddings)
-        tsneer.serialize_results(DFT_FNAME)
+    perplexity = min(max(form_request['perplexity'], 5), 50)
+    dims = min(max(form_request['dims'], 2), 100)
 
-        return jsonify({
-            "message": f"calculated 2D embedding visualization with t-SNE and serialized results",
-            "ok": True
-        })
-            
-    except Exception as e:
-        print(f'[ERR: /cluster/visuals/tsne] {e}')
-        return jsonify({
-            "errors": e.args[0],
-        }), 500
+    job = get_job_runner().submit('tsne', embed_with_tsne, perplexity, dims, exclusive=True)
+    return submitted(job, "started calculating 2D embedding visualization with t-SNE")
@@ -8,6 +8,7 @@ from flask import (
 from flask.json import jsonify
 
 from flaskr.utils.form_utils import RequestParser as rqparser
+from flaskr.utils.io_utils import ClusteringResult
 
 # file routes
 @app.route("/file")
@@ -15,6 +16,8 @@ def read_file():
     """ 
     reads file with specified fname and returns contents in json's `data` field;
     use as: /file?fname=<fname> 
+    clustering results (`.npz`, see `ClusteringResult`) can be read column-selectively:
+    /file?fname=data/df.npz&columns=id,label
     """
     fname = request.args.get("fname")
 
@@ -26,9 +29,9 @@ def read_file():
 
     # checks ext
     ext = fname.split(".")[-1]
-    if ext not in ["txt", "csv", "json"]:
+    if ext not in ["txt", "csv", "json", "npz"]:
         return jsonify({
-            "message": f"file extension should be one of: txt, csv or json",
+            "message": f"file extension should be one of: txt, csv, json or npz",
         }), 400
 
     # reads as txt, csv (with header) or json depending on ext
@@ -48,6 +51,14 @@ def read_file():
                     "data": json.load(f),
                     "ok": True
                 })
+        elif ext == "npz":
+            columns = request.args.get("columns")
+            result = ClusteringResult.read(fname, columns.split(",") if columns else None)
+            return jsonify({
+                "message": f"read {fname} as dataframe",
+                "data": {col: vals.tolist() for col, vals in result.items()},
+                "ok": True
+            })
         elif ext == "csv":
             with open(fname, "r") as f:
                 lines = f.read().splitlines()
@@ -72,7 +83,7 @@ def read_file():
 @app.route("/file", methods=["DELETE"])
 def delete_file():
     """
-    deletes all {txt, csv, json} files from `data` subdir that match specified pattern;
+    deletes all {txt, csv, json, npz} files from `data` subdir that match specified pattern;
     request body should be:
     {
         "sender": "deleter",
@@ -99,9 +110,9 @@ def delete_file():
 
     # checks ext
     ext = fname_pattern.split(".")[-1]
-    if ext not in ["txt", "csv", "json"]:
+    if ext not in ["txt", "csv", "json", "npz"]:
         return jsonify({
-            "message": f"file extension should be one of: txt, csv or json",
+            "message": f"file extension should be one of: txt, csv, json or npz",
         }), 400
 
     # check location
@@ -0,0 +1,62 @@
+from flask import (
+    current_app as app,
+    request,
+)
+from flask.json import jsonify
+
+from flaskr.utils.job_utils import get_job_runner
+
+# job routes (see `job_utils.JobRunner`)
+@app.route("/jobs")
+def get_jobs():
+    """
+    returns status of all recent jobs (most recent last);
+    use as: /jobs or /jobs?status=running
+    """
+    status = request.args.get("status")
+    jobs = [
+        job.json() for job in get_job_runner().list()
+        if status is None or job.status == status
+    ]
+    return jsonify({
+        "message": f"found {len(jobs)} jobs",
+        "data": jobs,
+        "ok": True
+    })
+
+@app.route("/jobs/<job_id>")
+def get_job(job_id):
+    """
+    returns job status (`queued`, `running`, `done`, `failed` or `cancelled`),
+    current stage, progress (`done`/`total`), throughput (items/s) and eta (s) 
+    of the current stage and job result once it's done
+    """
+    job = get_job_runner().get(job_id)
+    if job is None:
+        return jsonify({
+            "message": f"job {job_id} not found",
+        }), 404
+
+    return jsonify({
+        "message": f"job {job_id} is {job.status}",
+        "data": job.json(),
+        "ok": True
+    })
+
+@app.route("/jobs/<job_id>", methods=["DELETE"])
+def cancel_job(job_id):
+    """
+    cancels job: queued job is not started, 
+    running job stops at its next progress report
+    """
+    job = get_job_runner().cancel(job_id)
+    if job is None:
+        return jsonify({
+            "message": f"job {job_id} not found",
+        }), 404
+
+    return jsonify({
+        "message": f"requested cancellation of job {job_id}",
+        "data": job.json(),
+        "ok": True
+    })
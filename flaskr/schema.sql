@@ -16,7 +16,7 @@ CREATE TABLE IF NOT EXISTS story (
     score INTEGER,
     title VARCHAR,
     num_comments INTEGER,
-    comment_embedding VARCHAR,
+    comment_embedding BLOB, -- float32 (see `flaskr.utils.embedding_utils`)
     body_embedding VARCHAR
 );
 
@@ -27,4 +27,37 @@ CREATE TABLE IF NOT EXISTS comment (
     body VARCHAR,
     parent_id INTEGER,
     FOREIGN KEY (parent_id) REFERENCES parent (parent_id)
-);
\ No newline at end of file
+);
+
+-- all comments of a story concatenated into a single html
+-- (kept up to date on writes; rebuild with `flask backfill-threads`)
+CREATE TABLE IF NOT EXISTS story_thread (
+    story_id INTEGER PRIMARY KEY,
+    children VARCHAR,
+    num_comments INTEGER,
+    FOREIGN KEY (story_id) REFERENCES story (story_id)
+);
+
+-- secondary indices (added to existing dbs by `flask init-db`)
+-- stories are filtered by these fields before clustering
+CREATE INDEX IF NOT EXISTS story_filter_idx 
+ON story (unix_time, num_comments, score);
+
+-- comment trees are collected by recursively joining comments on parent_id
+CREATE INDEX IF NOT EXISTS comment_parent_idx 
+ON comment (parent_id);
+
+-- story embeddings cached per transformer model;
+-- an entry is valid only while `content_hash` matches the current story thread
+-- (see `flaskr.models.embedding_cache`)
+CREATE TABLE IF NOT EXISTS embedding_cache (
+    story_id INTEGER NOT NULL,
+    model_name VARCHAR NOT NULL,
+    content_hash VARCHAR NOT NULL,
+    embedding BLOB NOT NULL, -- float32
+    last_used INTEGER NOT NULL, -- used for lru eviction
+    PRIMARY KEY (story_id, model_name)
+);
+
+CREATE INDEX IF NOT EXISTS embedding_cache_lru_idx 
+ON embedding_cache (last_used);
@@ -7,7 +7,7 @@ function removeAllNodeChildren(node) {
 function reset() {
     // clear old data files
     const fnamesToBeDeleted = [
-        'data/df.csv','data/df_tsne.csv','data/pca.txt','data/freq_*.json'
+        'data/df.npz','data/df.csv','data/df_tsne.csv','data/pca.txt','data/freq_*.json'
     ];
     for (let fname of fnamesToBeDeleted) {
         postData('/file', {'sender': 'deleter', 'fname': fname}, method='DELETE')
@@ -59,6 +59,9 @@ semanticClusterBtn.addEventListener('click', function (evt) {
 
     postData('/cluster/new', params)
         .then(res => checkForServerErrors(res))
+        .then(res => waitForJob(res.data['job_id'], job => {
+            semanticClusterBtn.innerHTML = `${spinnerAmination} Clustering Posts: ${formatJobProgress(job)}...`;
+        }))
         .then(res => {
             semanticClusterBtn.innerHTML = `Cluster Posts`;
     
@@ -90,14 +93,14 @@ showSemanticClusterPostsBtn.addEventListener('click', function (evt) {
     // make table visible
     tableRoot.style.display = "";
 
-    fetch('/file?fname=data/df.csv')
+    fetch('/file?fname=data/df.npz&columns=id,label')
     .then(res => checkForServerErrors(res))
     .then(res => res.json())
     .then(res => {
         // filters post ids based on the target label
         filtered_ids = filterAbyBwhereBisC(
             res.data['id'],
-            res.data['label'],
+            res.data['label'].map(String), // labels are ints in npz
             targetLabel
         );
         return fetch(`/api/stories?ids=${filtered_ids.join(',')}`)
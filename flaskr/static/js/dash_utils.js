@@ -75,6 +75,7 @@ embedTsneBtn.addEventListener('click', function (res) {
     // calculate reduced-dim embeddings with tsne and add plot
     postData('/cluster/visuals/tsne', params)
     .then(res => checkForServerErrors(res))
+    .then(res => waitForJob(res.data['job_id']))
     .then(res => addTsneEmbeddings())
     .catch(err => {
         console.log(err);
@@ -88,7 +89,10 @@ wordcloudBtn.addEventListener('click', function (evt) {
 
     postData('/cluster/visuals/wordcloud', {})
     .then(res => checkForServerErrors(res))
-    .then(res => addWordCloud(res.data['num_clusters']))
+    .then(res => waitForJob(res.data['job_id'], job => {
+        wordcloudBtn.innerHTML = `${spinnerAmination} Generating WordClouds: ${formatJobProgress(job)}...`;
+    }))
+    .then(res => addWordCloud(res.result['num_clusters']))
     .then(res => {
         wordcloudBtn.innerHTML = 'Generate WordClouds';
     })
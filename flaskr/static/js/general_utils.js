@@ -59,4 +59,33 @@ function checkForServerErrors(res) {
         throw new Error(res.errors);
     }
     return res;
-}
\ No newline at end of file
+}
+
+function formatJobProgress(job) {
+    const stage = job.stage || job.status;
+    const progress = job.total ? ` ${job.done}/${job.total}` : '';
+    const eta = job.eta !== null ? ` (~${Math.ceil(job.eta)}s left)` : '';
+    return `${stage}${progress}${eta}`;
+}
+
+async function waitForJob(jobId, onProgress=null, interval=1000) {
+    // polls `/jobs/<jobId>` until job is finished, resolves with job info
+    // (job result is in `job.result`), rejects if job failed or was cancelled
+    while (true) {
+        const res = await fetch(`/jobs/${jobId}`)
+            .then(res => res.json())
+            .then(res => checkForServerErrors(res));
+        const job = res.data;
+
+        if (job.status === 'done') {
+            return job;
+        }
+        if (job.status === 'failed' || job.status === 'cancelled') {
+            throw new Error(job.error || `job ${job.name} was ${job.status}`);
+        }
+        if (onProgress !== null) {
+            onProgress(job);
+        }
+        await new Promise(resolve => setTimeout(resolve, interval));
+    }
+}
@@ -1,15 +1,15 @@
-from typing import Any, Dict, List, Set, Optional, Generator, Union
+from typing import Any, Dict, List, Set, Tuple, Optional, Generator, Union
 
 import os
 import numpy as np
 from collections import defaultdict
+from collections.abc import Iterator
 
 import errno
 from smart_open import open  # for transparently opening remote files
-from itertools import cycle, tee
+from itertools import tee
 
-from sklearn.manifold import TSNE
-import pandas as pd
+from flaskr.utils.io_utils import ClusteringResult
 
 
 def copy_and_measure_generator(generator: Generator, num_copies: int = 1):
@@ -54,6 +54,17 @@ def copy_and_measure_batch_generator(generator: Generator, num_copies: int = 1):
         num_items += len(batch)
     return gs[1:], (num_batches, num_items, len(item) if hasattr(item, '__iter__') else 1)
 
+def copy_iterable(iterable: Any, num_copies: int = 2):
+    """
+    returns `num_copies` iterables over the same data: 
+    re-iterable objects (lists, datasets from `dataset_utils`) are returned as is,
+    one-shot iterators (generators) are copied with `tee`
+    (which buffers all elements until each copy consumes them)
+    """
+    if isinstance(iterable, Iterator):
+        return tee(iterable, num_copies)
+    return tuple(iterable for _ in range(num_copies))
+
 class SerialReader:
     def __init__(self, fname: str, blacklist: Optional[Set]=None):
         self.fname = fname
@@ -158,146 +169,295 @@ class GeneratorStandardizer:
 class BatchedGeneratorStandardizer:
     def __init__(self):
         """
-        assumes that each batch in a 2d numpy array
+        assumes that each batch in a 2d numpy array;
+        statistics are accumulated in a single pass: 
+        per-batch mean and sum of squared deviations (m2) are merged
+        with the running ones (Chan et al. parallel variance),
+        so the standardizer can also be fitted incrementally with `partial_fit`
         """
         self.gen = None
+        self.num = 0
         self.mean = None
+        self.m2 = None
+        self.var = None # standard deviation (kept under old name)
+
+    def reset(self) -> None:
+        self.num = 0
+        self.mean = None
+        self.m2 = None
         self.var = None
-        
-    def get_mean(self) -> np.ndarray:
-        (g1,g2) = tee(self.gen)
-        
-        sm,num = None,0
-        for i,batch in enumerate(g1):
-            if not i:
-                sm = np.zeros(batch[0].shape)
-            sm += batch.sum(axis=0)
-            num += batch.shape[0]
-            
-        self.gen = g2
-        self.mean = sm / num
-        
-        return self.mean
-        
-    def get_var(self) -> np.ndarray:
-        # check if self.gen is not None
-        (g1,g2) = tee(self.gen)
-        
-        sm, num = None, 0
-        for i,batch in enumerate(g1):
-            if not i:
-                sm = np.zeros(batch[0].shape)
-            for sample in batch:
-                sm += (sample - self.mean)**2
-            num += batch.shape[0]
-            
-        self.var = np.sqrt(sm / num) if num else np.zeros(sample.shape)
-        self.gen = g2
 
-        return self.var
-    
+    def partial_fit(self, batch: np.ndarray) -> 'BatchedGeneratorStandardizer':
+        batch = np.asarray(batch, dtype=np.float64)
+        num_b = batch.shape[0]
+        if not num_b:
+            return self
+
+        mean_b = batch.mean(axis=0)
+        m2_b = ((batch - mean_b)**2).sum(axis=0)
+
+        if not self.num:
+            self.num, self.mean, self.m2 = num_b, mean_b, m2_b
+        else:
+            num = self.num + num_b
+            delta = mean_b - self.mean
+            self.mean = self.mean + delta * num_b / num
+            self.m2 = self.m2 + m2_b + delta**2 * self.num * num_b / num
+            self.num = num
+
+        self.var = np.sqrt(self.m2 / self.num)
+        return self
+
     def fit(self, gen: Generator) -> bool:
-        self.gen = gen        
-        self.get_mean()
-        self.get_var()
+        """fits on all batches of `gen` in a single pass (consumes generators)"""
+        self.reset()
+        self.gen = gen
+        for batch in gen:
+            self.partial_fit(batch)
         
         return True
-        
+
+    def transform_batch(self, batch: np.ndarray) -> np.ndarray:
+        # features with zero variance are only centered
+        std = np.where(self.var > 0, self.var, 1.)
+        return (batch - self.mean.reshape(1,-1)) / std.reshape(1,-1)
+
     def transform(self, gen: Generator) -> Generator:
         def helper(gen):
-            mean = self.mean.reshape(1,-1)
-            var = self.var.reshape(1,-1)
             for batch in gen:
-                yield (batch - mean) / var
+                yield self.transform_batch(batch)
                 
         return helper(gen)
     
     def fit_transform(self, gen: Generator) -> Generator:
-        self.fit(gen)
+        # generators need to be copied for the second pass (re-iterables don't)
+        (g1, g2) = copy_iterable(gen)
+        self.fit(g1)
+        self.gen = g2
         return self.transform(self.gen)
+
+    def save(self, fname: str) -> None:
+        np.savez(fname, num=self.num, mean=self.mean, m2=self.m2)
+
+    @classmethod
+    def load(cls, fname: str) -> 'BatchedGeneratorStandardizer':
+        scaler = cls()
+        with np.load(fname) as state:
+            scaler.num = int(state['num'])
+            scaler.mean = state['mean']
+            scaler.m2 = state['m2']
+        scaler.var = np.sqrt(scaler.m2 / scaler.num)
+        return scaler
         
 class KMeansForGenerator:
-    def __init__(self, n_clusters: int, iters: int = 300, tol: float = 1e-5):
+    def __init__(
+        self, 
+        n_clusters: int, 
+        iters: int = 300, 
+        tol: float = 1e-5,
+        init: Union[str, np.ndarray] = 'k-means++',
+        init_size: Optional[int] = None,
+        chunk_size: int = 4096,
+        random_state: Optional[int] = None
+    ):
+        """
+        k-means (Lloyd's algorithm) for data that doesn't fit in memory;
+        input is an iterable of batches (2d numpy arrays, one sample per row;
+        1d arrays are treated as single samples) or a single 2d array,
+        re-iterable datasets (see `dataset_utils`) are read once per iteration,
+        one-shot generators are buffered on the first pass;
+        sample-to-centroid distances are computed in chunks of `chunk_size` rows
+        as `|x|^2 - 2 x.C^T + |C|^2` (a single matrix product per chunk);
+        initial centroids are chosen with k-means++ on a uniform sample
+        of `init_size` rows (default: `max(1000, 10 * n_clusters)`)
+        or passed as (n_clusters, dim) array in `init`;
+        clusters that end up empty are moved to the samples 
+        farthest from their centroids
+        """
         self.n_clusters = n_clusters
         self.iters = iters
         self.tol = tol
+        self.init = init
+        self.init_size = init_size or max(1000, 10 * n_clusters)
+        self.chunk_size = chunk_size
+        self.rng = np.random.default_rng(random_state)
         self.centroids = None
-        
-    def fit(self, X_generator: Generator) -> np.ndarray:
+        self.inertia = None
+        self.n_iter = 0
+
+    @staticmethod
+    def _iter_rows(batches: Any) -> Generator:
+        """yields 2d float64 arrays (single samples as rows)"""
+        if isinstance(batches, np.ndarray) and batches.ndim == 2:
+            batches = [batches]
+        for batch in batches:
+            batch = np.asarray(batch, dtype=np.float64)
+            yield batch.reshape(1, -1) if batch.ndim == 1 else batch
+
+    def _iter_chunks(self, batches: Any) -> Generator:
+        for batch in self._iter_rows(batches):
+            for i in range(0, batch.shape[0], self.chunk_size):
+                yield batch[i:i+self.chunk_size]
+
+    @staticmethod
+    def _sq_distances(chunk: np.ndarray, centroids: np.ndarray, centroids_sq: np.ndarray) -> np.ndarray:
+        """(rows, n_clusters) squared euclidean distances"""
+        sq_dists = np.einsum('ij,ij->i', chunk, chunk)[:, None] - 2 * chunk @ centroids.T + centroids_sq[None, :]
+        return np.maximum(sq_dists, 0, out=sq_dists)
+
+    def _sample_rows(self, batches: Any) -> np.ndarray:
+        """uniform sample of `init_size` rows (single pass, reservoir sampling)"""
+        sample, num = None, 0
+        for chunk in self._iter_chunks(batches):
+            if sample is None:
+                sample = np.empty((self.init_size, chunk.shape[1]))
+            # first rows fill the reservoir, later rows replace random entries
+            fill = min(max(self.init_size - num, 0), chunk.shape[0])
+            sample[num:num+fill] = chunk[:fill]
+            if fill < chunk.shape[0]:
+                idx = self.rng.integers(0, np.arange(num + fill, num + chunk.shape[0]) + 1)
+                keep = idx < self.init_size
+                sample[idx[keep]] = chunk[fill:][keep]
+            num += chunk.shape[0]
+
+        if not num:
+            raise ValueError('Cannot fit KMeans on empty input')
+        return sample[:min(num, self.init_size)]
+
+    def _init_centroids(self, batches: Any) -> np.ndarray:
         """
-        finds centroids, consumes input generator
+        greedy k-means++ seeding on a sample of input rows:
+        each next centroid is the best (lowest potential) 
+        of `2 + log(k)` candidates drawn with probability ~ squared distance
+        to the closest chosen centroid
         """
-        (g1,), (num_samples, sample_sz) = copy_and_measure_generator(X_generator, 1)
-        cycled_samples = cycle(g1)
-        self.centroids = np.random.rand(self.n_clusters, sample_sz)
-    
-        for _ in range(self.iters):
-            cluster_sum = np.zeros((self.n_clusters, sample_sz))
-            cluster_cnt = np.zeros((self.n_clusters, 1))
-            for _ in range(num_samples):
-                # assign cluster to sample
-                sample = next(cycled_samples) # should be 1d np.array
-                sq_dists = np.zeros((self.n_clusters,)) # square distances for speed
-                for c in range(self.n_clusters):
-                    sq_dists[c] = np.dot(
-                        sample - self.centroids[c], 
-                        sample - self.centroids[c]
-                    )
-                idx = np.argmin(sq_dists)
-                cluster_sum[idx, :] += sample
-                cluster_cnt[idx, 0] += 1
-
-            # update clusters
-            centroids = cluster_sum / cluster_cnt
-            if max([np.abs(pt1 - pt2) 
-                    for c1,c2 in zip(centroids, self.centroids)
-                    for pt1, pt2 in zip(c1,c2)
-                   ]) < self.tol:
-                self.centroids = centroids
-                break
-            self.centroids = centroids
+        if not isinstance(self.init, str):
+            return np.array(self.init, dtype=np.float64)
 
-        return self.centroids
-    
-    def transform(self, X_generator: Generator) -> Generator:
+        sample = self._sample_rows(batches)
+        sample_sq = np.sum(sample**2, axis=1)
+        n_trials = 2 + int(np.log(self.n_clusters))
+
+        centroids = np.empty((self.n_clusters, sample.shape[1]))
+        centroids[0] = sample[self.rng.integers(len(sample))]
+        closest = self._sq_distances(sample, centroids[:1], np.sum(centroids[:1]**2, axis=1)).ravel()
+        for c in range(1, self.n_clusters):
+            total = closest.sum()
+            if total <= 0:
+                centroids[c] = sample[self.rng.integers(len(sample))]
+                continue
+
+            candidates = np.searchsorted(np.cumsum(closest), self.rng.random(n_trials) * total)
+            candidates = np.minimum(candidates, len(sample) - 1)
+            # (n_trials, rows) distances if each candidate was chosen
+            candidate_dists = np.minimum(
+                closest[None, :], 
+                self._sq_distances(sample[candidates], sample, sample_sq)
+            )
+            best = np.argmin(candidate_dists.sum(axis=1))
+            centroids[c] = sample[candidates[best]]
+            closest = candidate_dists[best]
+        return centroids
+
+    def _lloyd_step(self, batches: Any) -> Tuple[np.ndarray, np.ndarray, np.ndarray, float]:
         """
-        assigns each sample of the input generator to the closest centroid;
-        returns euclidean distances from each sample to the closest centroid;
-        consumes input generator
+        single pass over the data: assigns samples to current centroids;
+        returns (per-cluster sums, per-cluster counts, 
+        farthest samples (at most n_clusters, farthest first), inertia)
         """
-        if self.centroids is None:
-            raise RuntimeError(
-                'KMeans centroids are not defined! Run `fit` method first.'
-            )
-            
-        return (
-            np.array([
-                np.linalg.norm(sample - self.centroids[c])
-                for c in range(self.n_clusters)
-            ])
-            for sample in X_generator            
-        )
-    def predict(self, X_generator: Generator) -> Generator:
+        centroids_sq = np.sum(self.centroids**2, axis=1)
+        sums = np.zeros_like(self.centroids)
+        counts = np.zeros(self.n_clusters, dtype=np.int64)
+        far_samples, far_dists = np.empty((0, self.centroids.shape[1])), np.empty(0)
+        inertia = 0.
+
+        for chunk in self._iter_chunks(batches):
+            sq_dists = self._sq_distances(chunk, self.centroids, centroids_sq)
+            labels = np.argmin(sq_dists, axis=1)
+            closest = sq_dists[np.arange(len(labels)), labels]
+            inertia += closest.sum()
+
+            counts += np.bincount(labels, minlength=self.n_clusters)
+            onehot = (labels[:, None] == np.arange(self.n_clusters)[None, :]).astype(chunk.dtype)
+            sums += onehot.T @ chunk
+
+            # candidates for relocating empty clusters
+            far_samples = np.concatenate([far_samples, chunk])
+            far_dists = np.concatenate([far_dists, closest])
+            if len(far_dists) > self.n_clusters:
+                keep = np.argpartition(-far_dists, self.n_clusters)[:self.n_clusters]
+                far_samples, far_dists = far_samples[keep], far_dists[keep]
+
+        order = np.argsort(-far_dists)
+        return sums, counts, far_samples[order], inertia
+
+    def fit(self, X_generator: Any) -> np.ndarray:
         """
-        assigns each sample of the input generator to the closest centroid;
-        returns generator of class predictions for each sample;
-        consumes input generator
+        finds centroids; returns (n_clusters, dim) array of centroids
         """
+        batches = list(X_generator) if isinstance(X_generator, Iterator) else X_generator
+        self.centroids = self._init_centroids(batches)
+
+        for self.n_iter in range(1, self.iters + 1):
+            sums, counts, far_samples, self.inertia = self._lloyd_step(batches)
+            
+            centroids = self.centroids.copy()
+            nonempty = counts > 0
+            centroids[nonempty] = sums[nonempty] / counts[nonempty, None]
+            # empty clusters are moved to the samples farthest from their centroids
+            empty = np.flatnonzero(~nonempty)[:len(far_samples)]
+            centroids[empty] = far_samples[:len(empty)]
+
+            shift = np.max(np.abs(centroids - self.centroids))
+            self.centroids = centroids
+            if not len(empty) and shift < self.tol:
+                break
+
+        return self.centroids
+
+    def _check_fitted(self) -> None:
         if self.centroids is None:
             raise RuntimeError(
                 'KMeans centroids are not defined! Run `fit` method first.'
             )
-            
+
+    def _iter_sq_distances(self, X_generator: Any) -> Generator:
+        if isinstance(X_generator, np.ndarray) and X_generator.ndim == 2:
+            X_generator = [X_generator]
+        centroids_sq = np.sum(self.centroids**2, axis=1)
+        for batch in X_generator:
+            batch = np.asarray(batch, dtype=np.float64)
+            rows = batch.reshape(1, -1) if batch.ndim == 1 else batch
+            sq_dists = np.concatenate([
+                self._sq_distances(rows[i:i+self.chunk_size], self.centroids, centroids_sq)
+                for i in range(0, rows.shape[0], self.chunk_size)
+            ]) if rows.shape[0] else np.empty((0, self.n_clusters))
+            yield sq_dists[0] if batch.ndim == 1 else sq_dists
+
+    def transform(self, X_generator: Any) -> Generator:
+        """
+        returns generator of euclidean distances from samples to all centroids:
+        (n_clusters,) array for each sample or (rows, n_clusters) array for each batch
+        of the input generator
+        """
+        self._check_fitted()
+        return (np.sqrt(sq_dists) for sq_dists in self._iter_sq_distances(X_generator))
+
+    def predict(self, X_generator: Any) -> Generator:
+        """
+        assigns samples of the input generator to the closest centroids;
+        returns generator of cluster labels:
+        single label for each sample or 1d array of labels for each batch
+        """
+        self._check_fitted()
         return (
-            np.argmin([
-                np.dot(sample - self.centroids[c],sample - self.centroids[c])
-                for c in range(self.n_clusters)
-            ])
-            for sample in X_generator
+            np.argmin(sq_dists, axis=-1) 
+            for sq_dists in self._iter_sq_distances(X_generator)
         )
 
 class TSNEer:
     def __init__(self, **kwargs):
+        from sklearn.manifold import TSNE
         self.tsne = TSNE(**kwargs)
         self.reduced = None
 
@@ -309,6 +469,7 @@ class TSNEer:
             dims: int = 768
         ) -> np.ndarray:
 
+        import pandas as pd
         print('tsne dims:', dims)
         self.df = pd.read_csv(fname, sep=sep)
         return np.stack(
@@ -320,6 +481,17 @@ class TSNEer:
             ).to_numpy()
         )
 
+    def read_embedding_from_result(self, fname: str, dims: int = 768) -> np.ndarray:
+        """
+        reads clustering result (`.npz` or tsv, see `io_utils.ClusteringResult`);
+        `.npz` embeddings are a zero-copy slice of the memory-mapped result
+        """
+        import pandas as pd
+        result = ClusteringResult.read(fname)
+        embeddings = result.pop('embedding')
+        self.df = pd.DataFrame(result)
+        return embeddings[:, :dims]
+
     def reduce_embedding_dimensions(self, embeddings: np.ndarray) -> np.ndarray:
         self.reduced = self.tsne.fit_transform(embeddings)
         print(self.reduced.shape)
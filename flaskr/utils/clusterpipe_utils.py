@@ -1,30 +1,28 @@
 from types import FunctionType, prepare_class
-from typing import Any, Dict, List, Optional, Generator
+from typing import Any, Dict, List, Tuple, Optional, Generator
 
 import os
 import sys
+import time
+import tempfile
 import warnings
-from itertools import tee
-import requests as rq
+import multiprocessing as mp
+from collections import deque, defaultdict
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np
-from sklearn.cluster import MiniBatchKMeans
-from sklearn.decomposition import PCA, IncrementalPCA
-from sklearn.manifold import TSNE
 
 from flaskr.utils.nlp_utils import (
-    StoryEmbedder,
+    EmbedderRegistry,
     html2sentences,
 )
 
-from flaskr.utils.cluster_utils import (
-    copy_and_measure_generator,
-    copy_and_measure_batch_generator,
-    BatchedGeneratorStandardizer
-)
+from flaskr.utils.cluster_utils import BatchedGeneratorStandardizer
+from flaskr.utils.dataset_utils import BatchDataset, EmbeddingStore, RecordSpill
 
 from flaskr.utils.db_utils import DBHelper as dbh
 from flaskr.utils.io_utils import Event, Observer, Observable
-from flaskr.models.story import Story
+from flaskr.models.story import Story, StoryList
+from flaskr.models.embedding_cache import EmbeddingCache
 
 
 def rebatch_generator(batches: Generator, min_batch_size: int):
@@ -41,8 +39,31 @@ def rebatch_generator(batches: Generator, min_batch_size: int):
             prev = curr.copy()
             curr = []
 
-    # last batch
-    yield prev + curr
+    # last batch (nothing is yielded if there were no elements)
+    if prev or curr:
+        yield prev + curr
+
+
+# embedding worker state (each worker process loads its own transformer)
+_worker_embedder = None
+
+def _init_embedding_worker(model_name: str, num_threads: int) -> None:
+    global _worker_embedder
+    import torch
+    torch.set_num_threads(num_threads)
+    _worker_embedder = EmbedderRegistry.get(model_name)
+
+def _embed_story_threads(threads: List[str], batch_size: int) -> Tuple[np.ndarray, int, float]:
+    """
+    runs in embedding worker: embeds story threads (htmls);
+    returns (embeddings, worker pid, seconds spent)
+    """
+    tic = time.perf_counter()
+    embeddings = _worker_embedder.embed_stories(
+        [html2sentences(thread) for thread in threads],
+        batch_size=batch_size
+    )
+    return embeddings, os.getpid(), time.perf_counter() - tic
 
 
 class Pipeliner:
@@ -63,6 +84,24 @@ class ClustererBuilder:
     def __init__(self, clusterer: 'Clusterer'):
         self.clusterer = clusterer
 
+    def model_name(self, val: str) -> 'ClustererBuilder':
+        if val and val != self.clusterer._model_name:
+            self.clusterer._model_name = val
+            self.clusterer.embedder = None # taken from `EmbedderRegistry` on first use
+        return self
+
+    def cache_size(self, val: Optional[int]) -> 'ClustererBuilder':
+        self.clusterer._cache_size = val
+        return self
+
+    def n_workers(self, val: int) -> 'ClustererBuilder':
+        self.clusterer._n_workers = val
+        return self
+
+    def encode_batch_size(self, val: int) -> 'ClustererBuilder':
+        self.clusterer._encode_batch_size = val
+        return self
+
     def n_clusters(self, val: int) -> 'ClustererBuilder':
         self.clusterer._n_clusters = val
         return self
@@ -71,6 +110,14 @@ class ClustererBuilder:
         self.clusterer._n_pca_dims = val
         return self
 
+    def spill_dir(self, val: Optional[str]) -> 'ClustererBuilder':
+        self.clusterer._spill_dir = val
+        return self
+
+    def embedding_store(self, val: Optional[str]) -> 'ClustererBuilder':
+        self.clusterer._embedding_store = val
+        return self
+
     def min_batch_size(self, val: int) -> 'ClustererBuilder':
         self.clusterer._min_batch_size = val
         return self
@@ -99,14 +146,53 @@ class ClustererBuilder:
         self.clusterer._end_score = val
         return self
 
+    def exclude_ids(self, val: Optional[List[int]]) -> 'ClustererBuilder':
+        self.clusterer._exclude_ids = None if val is None else np.unique(np.asarray(val, dtype=np.int64))
+        return self
+
+    def partial_fit(self, val: bool) -> 'ClustererBuilder':
+        self.clusterer._partial_fit = bool(val)
+        return self
+
+    def fitted_model(self, model: 'ClusteringModel') -> 'ClustererBuilder':
+        """
+        takes fitted scaler, pca and kmeans and the params they were fitted with
+        from stored model (see `flaskr.utils.model_utils`);
+        used to assign new stories with `run_incremental`
+        """
+        meta = model.meta
+        self.model_name(meta['model_name'])
+        self.n_clusters(meta['n_clusters'])
+        self.n_pca_dims(meta['n_pca_dims'])
+        self.begin_timestep(meta['begin_ts'])
+        self.end_timestep(meta['end_ts'])
+        self.begin_comments(meta['begin_comm'])
+        self.end_comments(meta['end_comm'])
+        self.begin_score(meta['begin_score'])
+        self.end_score(meta['end_score'])
+        self.clusterer._reduced = meta['reduced']
+        self.clusterer.scaler = model.scaler
+        self.clusterer.pca = model.pca
+        self.clusterer.kmeans = model.kmeans
+        self.clusterer.centroids = model.kmeans.cluster_centers_
+        return self
+
     def build(self) -> 'Clusterer':
         return self.clusterer
 
 
 class Clusterer(Observable):
+    DEFAULT_MODEL_NAME = 'sentence-transformers/all-distilroberta-v1'
+
+    # story fields kept for serialization
+    STORY_FIELDS = ['story_id', 'author', 'unix_time', 'score', 'title', 'url', 'num_comments']
+
     def __init__(self):
         super().__init__() # adds `change` attr of type `Event` (see io_utils)
-        self._model_name = 'sentence-transformers/all-distilroberta-v1'
+        self._model_name = self.DEFAULT_MODEL_NAME
+        self._cache_size = None # max number of cached embeddings (all models)
+        self._encode_batch_size = 64 # sentences per transformer call
+        self._n_workers = 0 # embedding processes (0: embed in current process)
         self._n_clusters = 10
         self._n_pca_dims = 100
         self._min_batch_size = 100
@@ -116,18 +202,32 @@ class Clusterer(Observable):
         self._end_comm = 500
         self._begin_score = 0
         self._end_score = 500
+        self._exclude_ids = None # sorted ids of stories that are skipped (e.g., already clustered)
+        self._partial_fit = False # update fitted kmeans with new stories (`run_incremental`)
+        self._reduced = False # whether kmeans was fitted on pca-reduced embeddings
 
         self._num_batches = 0
         self._num_stories = 0
-
+        self._throughput = defaultdict(lambda: [0, 0.]) # worker: [stories, seconds]
+
+        # stages are re-iterable datasets (see `flaskr.utils.dataset_utils`):
+        # stories and embeddings are spilled to disk in a single pass over db,
+        # later stages are lazily recomputed from the spill on each pass
+        self._spill_dir = None
+        self._embedding_store = None # path of raw embedding store (temporary if not set)
+        self._tmpdir = None
+        self._story_spill = None # removed by `close`
+        self._unfinished_store = None # embedding store that is being written
         self._stories = None
         self._embeddings = None
+        self._lowdim_embeddings = None
         self._labels = None
 
         self.pipeliner = Pipeliner()
-        self.embedder = StoryEmbedder(model_name=self._model_name)
+        self.embedder = None # taken from `EmbedderRegistry` on first cache miss
+        self.cache = None
         self.scaler = BatchedGeneratorStandardizer()
-        self.kmeans = MiniBatchKMeans(n_clusters=self._n_clusters)
+        self.kmeans = None
         self.pca = None
         self.centroids = None
 
@@ -146,7 +246,7 @@ class Clusterer(Observable):
 
     @property
     def embeddings(self):
-        return self._stories
+        return self._embeddings
 
     @embeddings.setter
     def embeddings(self, val):
@@ -155,7 +255,7 @@ class Clusterer(Observable):
 
     @property
     def lowdim_embeddings(self):
-        return self._stories
+        return self._lowdim_embeddings
 
     @lowdim_embeddings.setter
     def lowdim_embeddings(self, val):
@@ -172,12 +272,14 @@ class Clusterer(Observable):
         self.change('labels', val) 
 
     def _story_batch_generator(self, delta_ts: int = 100000) -> Generator:
-        get_query = f'''
-            {Story.RECURSIVE_CTE_WITHOUT_WHERE}
-            WHERE 
-                s.unix_time BETWEEN ? AND ? AND
-                s.num_comments BETWEEN ? AND ? AND
-                s.score BETWEEN ? AND ?
+        """
+        yields batches of at most `min_batch_size` story dicts;
+        only ids of the stories from each time window are read at once
+        (from `story_filter_idx`), stories with comments are read batch by batch
+        """
+        ids_query = f'''
+            SELECT s.story_id FROM story AS s
+            {Story.FILTER_WHERE}
             ;
         '''
 
@@ -193,20 +295,67 @@ class Clusterer(Observable):
                 self._begin_score, self._end_score
             )
 
-            story_dicts = dbh.get_query(get_query, p)
-
-            if len(story_dicts):
+            story_ids = [row['story_id'] for row in dbh.get_query(ids_query, p)]
+            if self._exclude_ids is not None and story_ids:
+                story_ids = np.asarray(story_ids, dtype=np.int64)
+                story_ids = story_ids[~np.isin(story_ids, self._exclude_ids)].tolist()
+
+            for i in range(0, len(story_ids), self._min_batch_size):
+                chunk = story_ids[i:i+self._min_batch_size]
+                get_query = f'''
+                    {Story.SELECT_WITH_CHILDREN}
+                    WHERE s.story_id IN ({', '.join('?' for _ in chunk)})
+                    ;
+                '''
+                story_dicts = dbh.get_query(get_query, chunk)
                 num += len(story_dicts)
                 yield story_dicts
         print(f'[INFO] got {num} stories!')
 
+    def _lookup_story_embeddings(self, story_list: List[Dict]) -> Tuple[List, List, Dict, List[int]]:
+        """
+        reads embeddings of unchanged stories from the embedding cache
+        (see `flaskr.models.embedding_cache`);
+        returns (ids, hashes, {story_id: cached embedding}, indices of missed stories)
+        """
+        if self.cache is None:
+            self.cache = EmbeddingCache(self._model_name, max_entries=self._cache_size)
+
+        ids = [story['story_id'] for story in story_list]
+        hashes = [EmbeddingCache.hash_content(story['children']) for story in story_list]
+        cached = self.cache.get_many(ids, hashes)
+        missed = [i for i, story_id in enumerate(ids) if story_id not in cached]
+
+        return ids, hashes, cached, missed
+
+    def _store_story_embeddings(
+        self, 
+        lookup: Tuple[List, List, Dict, List[int]], 
+        new_embeddings: List[np.ndarray]
+    ) -> List[np.ndarray]:
+        """
+        writes embeddings of missed stories to db (single transaction per batch);
+        returns embeddings of all stories from the lookup in original order
+        """
+        ids, hashes, cached, missed = lookup
+        new_ids = [ids[i] for i in missed]
+        if new_ids:
+            cached.update(zip(new_ids, new_embeddings))
+            self.cache.put_many(new_ids, [hashes[i] for i in missed], new_embeddings)
+            # default model embeddings are also exposed via story api
+            if self._model_name == self.DEFAULT_MODEL_NAME:
+                StoryList.update_embeddings(new_ids, new_embeddings)
+
+        return [cached[story_id] for story_id in ids]
+
     def _read_or_generate_story_embeddings(self, story_list: List[Dict]) -> List[np.ndarray]:
         """
         returns the list of embeddings; each embedding corresponds
         to a story in `story_list` and is calculated
         by averaging all embeddings corresponding to story comments;
-        read the embedding from db if already present 
-        and writes it to db when calculated
+        embeddings are read from the embedding cache if the story thread
+        hasn't changed since they were calculated with the selected model,
+        otherwise they are calculated in current process and written to the cache
         INPUTS:
            stories: list: each element is a story dict with keys:
                story_id, author, unix_time, score, title, url, num_comments, children
@@ -222,70 +371,122 @@ class Clusterer(Observable):
                 ...
             ]
         """
-        update_query = '''
-            UPDATE story
-            SET comment_embedding = ?
-            WHERE story_id = ?        
+        lookup = self._lookup_story_embeddings(story_list)
+        missed = lookup[3]
+
+        new_embeddings = []
+        if missed:
+            if self.embedder is None:
+                self.embedder = EmbedderRegistry.get(self._model_name)
+            tic = time.perf_counter()
+            new_embeddings = list(self.embedder.embed_stories(
+                [html2sentences(story_list[i]['children']) for i in missed],
+                batch_size=self._encode_batch_size
+            ))
+            self._throughput[os.getpid()][0] += len(missed)
+            self._throughput[os.getpid()][1] += time.perf_counter() - tic
+
+        return self._store_story_embeddings(lookup, new_embeddings)
+
+    def _read_or_generate_story_embeddings_in_workers(self, story_batches: Generator) -> Generator:
+        """
+        same as `_read_or_generate_story_embeddings` for each batch,
+        but missed stories are embedded in a pool of `self._n_workers` processes
+        (each with its own transformer and `cpu_count / n_workers` torch threads);
+        up to `2 * n_workers` batches are in flight,
+        embeddings are yielded in the same order as the story batches
+        """
+        num_threads = max(1, (os.cpu_count() or 1) // self._n_workers)
+        executor = ProcessPoolExecutor(
+            max_workers=self._n_workers,
+            mp_context=mp.get_context('spawn'), # don't fork torch/sqlite state
+            initializer=_init_embedding_worker,
+            initargs=(self._model_name, num_threads)
+        )
+
+        def collect(lookup, future):
+            new_embeddings = []
+            if future is not None:
+                embeddings, pid, seconds = future.result()
+                new_embeddings = list(embeddings)
+                self._throughput[pid][0] += len(new_embeddings)
+                self._throughput[pid][1] += seconds
+            return self._store_story_embeddings(lookup, new_embeddings)
+
+        try:
+            pending = deque()
+            for batch in story_batches:
+                lookup = self._lookup_story_embeddings(batch)
+                missed = lookup[3]
+                future = executor.submit(
+                    _embed_story_threads,
+                    [batch[i]['children'] for i in missed],
+                    self._encode_batch_size
+                ) if missed else None
+                pending.append((lookup, future))
+
+                if len(pending) >= 2 * self._n_workers:
+                    yield collect(*pending.popleft())
+
+            while pending:
+                yield collect(*pending.popleft())
+        finally:
+            executor.shutdown()
+
+    def _count_stories(self) -> int:
+        """number of stories that match the filters (except `exclude_ids`), reads ids only"""
+        ids_query = f'''
+            SELECT s.story_id FROM story AS s
+            {Story.FILTER_WHERE}
+            ;
         '''
-
-        batch = []
-        for story in story_list:
-            # fetch embedding if roberta is selected and the embedding is already in db
-            if self._model_name == 'sentence-transformers/all-distilroberta-v1' and\
-                story.get('comment_embedding'):
-                embedding = np.array([
-                    float(val) for val in story['comment_embedding'].split(',')
-                ])
-            else:
-                embedding = self.embedder.embed_and_average_sentences(
-                    html2sentences(story['children'])
-                )
-                # write embedding to db (update story row) only if roberta was used
-                if self._model_name == 'sentence-transformers/all-distilroberta-v1':
-                    story['comment_embedding'] = ','.join(str(val) for val in embedding)
-
-                    dbh.mod_query(
-                        update_query, 
-                        (story['comment_embedding'], story['story_id']), 
-                        commit=True
-                    )
-
-            batch.append(embedding)
-
-        return batch
-
-    def _get_story_batches(self, delta_ts: int = 100000) -> Generator:
+        p = (
+            self._begin_ts, self._end_ts,
+            self._begin_comm, self._end_comm,
+            self._begin_score, self._end_score
+        )
+        story_ids = np.asarray([row['story_id'] for row in dbh.get_query(ids_query, p)], dtype=np.int64)
+        if self._exclude_ids is not None:
+            story_ids = story_ids[~np.isin(story_ids, self._exclude_ids)]
+        return len(story_ids)
+
+    def _set_stage(self, stage: str, total: Optional[int] = None) -> None:
+        """reports pipeline stage to observers (e.g., `job_utils.Job.track`)"""
+        self.change('stage', (stage, total))
+
+    def _track(self, batches: BatchDataset) -> BatchDataset:
+        """reports the number of processed stories to observers on each pass over batches"""
+        def report(batch):
+            self.change('progress', len(batch))
+            return batch
+        return batches.map(report)
+
+    def _get_story_batches(self, delta_ts: int = 100000) -> BatchDataset:
         """
         queries db based on form request,
-        recursively collects all comments for each story,
-        returns a generator, where each element 
-        is a list ("batch") of story dicts with the following fields:
+        returns a re-iterable dataset (each pass re-runs the query), 
+        where each element is a list ("batch") of story dicts 
+        with the following fields:
             'story_id', 'author', 'unix_time', 'score', 
             'title', 'url', 'num_comments', 'children'
         """
         print('[INFO] fetching data from db...')
-
-        # get stories
-        gen = self._story_batch_generator(delta_ts=delta_ts)
-
-        # rebatch stories
-        gen = rebatch_generator(gen, self._min_batch_size)
-
-        # copy genrator: save one copy, return another
-        print('[INFO] copying story generator...')
-        batches, (num_batches, num_items, _) = copy_and_measure_batch_generator(gen, num_copies=2)
-        self._num_batches = num_batches
-        self._num_stories = num_items
-        self.stories = batches[0]
-
-        return batches[1]
+        return BatchDataset.from_generator(
+            lambda: rebatch_generator(
+                self._story_batch_generator(delta_ts=delta_ts),
+                self._min_batch_size
+            )
+        )
 
     def _get_embedding_batches(
         self, 
-        story_batches: Optional[Generator] = None
-    ) -> Generator:
+        story_batches: Optional[BatchDataset] = None
+    ) -> BatchDataset:
         """
-        each element of a batch is a (batch_size, embed_dim) numpy array
+        makes a single pass over story batches and spills
+        story embeddings and story metadata (without comments) to disk;
+        returns embeddings dataset, where each batch 
+        is a (batch_size, embed_dim) numpy array
         (embed_dim is 768 for default bert transformers and 384 for minis)
         """
         if story_batches is None and self.stories is None:
@@ -295,27 +496,66 @@ class Clusterer(Observable):
             )
 
         print('[INFO] generating embeddings...')
-        def batch_generator(story_batches):
-            num = 0
+        self._set_stage('embedding', self._count_stories())
+        if self._embedding_store is None:
+            self._tmpdir = tempfile.TemporaryDirectory(dir=self._spill_dir)
+        story_spill, previous_spill = RecordSpill(self._spill_dir), self._story_spill
+        self._story_spill = story_spill
+        embedding_store = self._unfinished_store = EmbeddingStore.create(
+            self._embedding_store or os.path.join(self._tmpdir.name, 'embeddings')
+        )
+        pending_ids = deque()
+
+        def spill_stories(story_batches):
+            # keep story metadata, comments are only needed for embedding
             for batch in story_batches:
-                num += len(batch)
-                #yield np.stack(self.get_story_embeddings(batch))
-                yield np.stack(self._read_or_generate_story_embeddings(batch))
-            print(f'[INFO] got {num} embeddings!')
-        
-        # copy genrator: save one copy, return another
-        gen = batch_generator(story_batches or self._stories)
-        print('[INFO] copying embedding generator...')
-        batches = tee(gen, 2)
-        self.embeddings = batches[0]
+                story_spill.append([
+                    {field: story.get(field) for field in self.STORY_FIELDS} 
+                    for story in batch
+                ])
+                pending_ids.append([story['story_id'] for story in batch])
+                yield batch
+
+        story_batches = spill_stories(story_batches or self.stories)
+        if self._n_workers > 0:
+            embedded = self._read_or_generate_story_embeddings_in_workers(story_batches)
+        else:
+            embedded = (
+                self._read_or_generate_story_embeddings(batch) for batch in story_batches
+            )
+
+        # batches are embedded in order (see `_read_or_generate_story_embeddings_in_workers`)
+        for embeddings in embedded:
+            ids = pending_ids.popleft()
+            embedding_store.append(ids, np.stack(embeddings))
+            self.change('progress', len(ids))
+        embedding_store.finalize(model_name=self._model_name)
+        self._unfinished_store = None
+        print(f'[INFO] got {embedding_store.num} embeddings!')
+        if self.cache is not None:
+            print(
+                f'[INFO] embedding cache: {self.cache.stats["hits"]} hits, ' +\
+                f'{self.cache.stats["misses"]} misses, {self.cache.stats["evicted"]} evicted'
+            )
+        for worker, (num_embedded, seconds) in self._throughput.items():
+            print(
+                f'[INFO] embedding worker {worker}: {num_embedded} stories in {seconds:.1f}s ' +\
+                f'({num_embedded / max(seconds, 1e-9):.1f} stories/s)'
+            )
 
-        return batches[1]
+        self._num_batches = len(embedding_store.meta['batches'])
+        self._num_stories = embedding_store.num
+        self.stories = story_spill.finalize()
+        self.embeddings = embedding_store
+        if previous_spill is not None:
+            previous_spill.close()
 
+        return self.embeddings
 
     def _standardize_embedding_batches(
         self, 
-        embedding_batches: Optional[Generator] = None
-    ) -> Generator:
+        embedding_batches: Optional[BatchDataset] = None
+    ) -> BatchDataset:
 
         if embedding_batches is None and self.embeddings is None:
             raise RuntimeError(
@@ -324,24 +564,26 @@ class Clusterer(Observable):
             )
         
         print('[INFO] standardizing embeddings...')
-        normalized = self.scaler.fit_transform(embedding_batches or self._embeddings)
-        batches = tee(normalized, 2)
-        self.embeddings = batches[0]
+        embedding_batches = embedding_batches or self.embeddings
+        self._set_stage('standardizing', self._num_stories)
+        self.scaler.fit(self._track(embedding_batches))
+        self.embeddings = embedding_batches.map(self.scaler.transform_batch)
 
-        return batches[1]
+        return self.embeddings
 
     def _reduce_embedding_dimensionality_by_batches(
         self, 
-        embedding_batches: Optional[Generator] = None
-    ) -> Generator:
+        embedding_batches: Optional[BatchDataset] = None
+    ) -> BatchDataset:
 
-        if embedding_batches is None and self._embeddings is None:
+        if embedding_batches is None and self.embeddings is None:
             raise RuntimeError(
                 'There is nothing to reduce yet! ' +\
                 'You must obtain and story embeddings first! ' +\
                 'Consider running `get_embedding_batches()` or `set_embedding_batches()`'
             )
 
+        embedding_batches = embedding_batches or self.embeddings
         if self._num_stories < self._n_pca_dims:
             warnings.warn(
                 'Can not reduce the dimensionality of the embeddings!\n' +\
@@ -349,32 +591,27 @@ class Clusterer(Observable):
                 f'got n_samples={self._num_stories} and n_dims={self._n_pca_dims}!\n' +\
                 'Returning original embeddings without changes.'
             )
-            return embedding_batches or self.embeddings
+            return embedding_batches
 
-        # copy high dim embeddings
-        highdim_batches = tee(embedding_batches or self.embeddings, 2)
-
-        # train pca
+        # train pca (first pass)
         print(f'[INFO] reducing embedding dimensionality to {self._n_pca_dims}...')
+        from sklearn.decomposition import IncrementalPCA
         self.pca = IncrementalPCA(n_components=self._n_pca_dims)
-        for batch in highdim_batches[0]:
+        self._set_stage('reducing', self._num_stories)
+        for batch in self._track(embedding_batches):
             self.pca.partial_fit(batch)
         
-        # reduce
-        def batch_generator(batches):
-            for batch in batches:
-                yield self.pca.transform(batch)
-
-        lowdim_batches = tee(batch_generator(highdim_batches[1]), 3)
-        self.embeddings = lowdim_batches[0]
-        self.lowdim_embeddings = lowdim_batches[1]
+        # reduce (lazily, on each following pass)
+        self._reduced = True
+        self.embeddings = embedding_batches.map(self.pca.transform)
+        self.lowdim_embeddings = self.embeddings
 
-        return lowdim_batches[2]
+        return self.embeddings
 
     def _cluster_embedding_batches(
         self, 
-        embedding_batches: Optional[Generator] = None
-    ) -> None:
+        embedding_batches: Optional[BatchDataset] = None
+    ) -> BatchDataset:
         if embedding_batches is None and self.embeddings is None:
             raise RuntimeError(
                 'There is nothing to cluster yet! ' +\
@@ -382,24 +619,97 @@ class Clusterer(Observable):
                 'Consider running `get_embedding_batches()` or `set_embedding_batches()`'
             )
 
-        print('[INFO] copying embeddings')
-        batches = tee(embedding_batches or self.embeddings, 2)
-        
         # train kmeans
         print(f'[INFO] clustering stories to {self._n_clusters} clusters...')
-        for batch in batches[0]:
+        from sklearn.cluster import MiniBatchKMeans
+        self.kmeans = MiniBatchKMeans(n_clusters=self._n_clusters)
+        self._set_stage('clustering', self._num_stories)
+        for batch in self._track(embedding_batches or self.embeddings):
             self.kmeans.partial_fit(batch)
 
         self.centroids = self.kmeans.cluster_centers_
 
-        # predict labels
-        def cluster(batches):
-            for batch in batches:
-                yield self.kmeans.predict(batch)
+        # predict labels (lazily, while result is serialized)
+        self._set_stage('assigning', self._num_stories)
+        self.labels = self._track(embedding_batches or self.embeddings).map(self.kmeans.predict)
+        return self.labels
+
+    def _transform_embedding_batches(
+        self, 
+        embedding_batches: Optional[BatchDataset] = None
+    ) -> BatchDataset:
+        """
+        standardizes and reduces embeddings with already fitted scaler and pca
+        (see `ClustererBuilder.fitted_model`): these are not updated,
+        so new embeddings end up in the same space as already clustered ones
+        """
+        if embedding_batches is None and self.embeddings is None:
+            raise RuntimeError(
+                'There is nothing to transform! '+\
+                'Consider running `get_embedding_batches()` first!'
+            )
+
+        print('[INFO] transforming embeddings with fitted model...')
+        self.embeddings = (embedding_batches or self.embeddings).map(self.scaler.transform_batch)
+        if self._reduced:
+            self.embeddings = self.embeddings.map(self.pca.transform)
+            self.lowdim_embeddings = self.embeddings
+
+        return self.embeddings
 
-        self.labels = cluster(batches[1])
+    def _assign_embedding_batches(
+        self, 
+        embedding_batches: Optional[BatchDataset] = None
+    ) -> Optional[BatchDataset]:
+        """
+        assigns embeddings to the clusters of already fitted kmeans;
+        if `partial_fit` is set, kmeans is first updated with new embeddings;
+        labels are not set if there are no new stories
+        """
+        if not self._num_stories:
+            print('[INFO] no new stories to assign')
+            return None
+
+        embedding_batches = embedding_batches or self.embeddings
+        if self._partial_fit:
+            print(f'[INFO] updating {self._n_clusters} clusters with new stories...')
+            self._set_stage('clustering', self._num_stories)
+            for batch in self._track(embedding_batches):
+                self.kmeans.partial_fit(batch)
+            self.centroids = self.kmeans.cluster_centers_
+
+        print(f'[INFO] assigning {self._num_stories} new stories to clusters...')
+        self._set_stage('assigning', self._num_stories)
+        self.labels = self._track(embedding_batches).map(self.kmeans.predict)
         return self.labels
 
+    def run_incremental(self):
+        """
+        assigns stories that are not in `exclude_ids` to the clusters 
+        of a fitted model (see `ClustererBuilder.fitted_model`)
+        without refitting scaler and pca
+        """
+        if self.kmeans is None:
+            raise RuntimeError(
+                'There is no fitted model to assign stories to! ' +\
+                'Consider setting `fitted_model(.)` first'
+            )
+
+        dummy = lambda x, **params: self._get_story_batches(**params)
+
+        self.pipeliner.add(dummy, {'delta_ts': 100000})
+        self.pipeliner.add(self._get_embedding_batches)
+        self.pipeliner.add(self._transform_embedding_batches)
+        self.pipeliner.add(self._assign_embedding_batches)
+
+        try:
+            self.pipeliner.run('dummy_input')
+        except BaseException:
+            self.close()
+            raise
+
+        return self
+
     def run(self):
         # we need to create dummy fun,
         # because pipeliner requires an input for the pipe,
@@ -412,6 +722,35 @@ class Clusterer(Observable):
         self.pipeliner.add(self._reduce_embedding_dimensionality_by_batches)
         self.pipeliner.add(self._cluster_embedding_batches)
 
-        self.pipeliner.run('dummy_input')
+        try:
+            self.pipeliner.run('dummy_input')
+        except BaseException:
+            self.close()
+            raise
+
+        return self
+
+    def close(self) -> None:
+        """
+        removes story spill and temporary embedding store
+        (`stories` and `embeddings` can't be iterated after that);
+        called when the pipeline fails, otherwise once results are saved
+        (or use clusterer as a context manager)
+        """
+        if self._story_spill is not None:
+            self._story_spill.close()
+            self._story_spill = None
+        if self._unfinished_store is not None:
+            self._unfinished_store.remove()
+            self._unfinished_store = None
+        if self._tmpdir is not None:
+            if isinstance(self._embeddings, EmbeddingStore):
+                self._embeddings.remove() # drops memory maps before the dir is removed
+            self._tmpdir.cleanup()
+            self._tmpdir = None
+
+    def __enter__(self) -> 'Clusterer':
+        return self
 
-        return self
\ No newline at end of file
+    def __exit__(self, *exc) -> None:
+        self.close()
@@ -1,8 +1,7 @@
-from typing import Any, List, Dict, Set, Optional, Union
+from typing import Any, Callable, List, Dict, Set, Tuple, Optional, Union
 
-import os, json, re, datetime
+import os, json, re, datetime, threading
 import numpy as np
-import scipy as sc
 import pandas as pd
 from itertools import accumulate
 
@@ -10,15 +9,23 @@ import plotly.express as px
 from plotly.subplots import make_subplots
 import plotly.graph_objects as go
 
-from wordcloud import WordCloud, STOPWORDS, ImageColorGenerator
+from flaskr.utils.io_utils import ClusteringResult
 
 class ColorHelper:
     def __init__(self, colorscheme=px.colors.sequential.Plasma):
         self.color_hex = colorscheme
         self.color_rgb = np.array([self.hex2rgb(h) for h in self.color_hex])
-        self.color_spline = sc.interpolate.CubicSpline(
-            np.linspace(0,1,len(self.color_rgb)), self.color_rgb
-        )
+        self._color_spline = None
+
+    @property
+    def color_spline(self) -> Callable:
+        # built on first use (scipy is only needed once figures are drawn)
+        if self._color_spline is None:
+            from scipy.interpolate import CubicSpline
+            self._color_spline = CubicSpline(
+                np.linspace(0,1,len(self.color_rgb)), self.color_rgb
+            )
+        return self._color_spline
 
     @staticmethod
     def hex2rgb(hx: str) -> List[int]:
@@ -55,70 +62,140 @@ def update_fig_layout(fig: go.Figure) -> go.Figure:
     return fig
 
 class DataHelper:
+    """
+    parsed clustering results are cached in-process: each cache entry is keyed
+    on file path + mtime + size, so frames are only re-read and re-derived
+    after the file was rewritten (e.g., by a new clustering run);
+    returned frames are shared between callers and should be treated as read-only
+    """
+    # clustering result (see `io_utils.ClusteringResult`), legacy tsv as fallback
+    RESULT_FNAMES = ['data/df.npz', 'data/df.csv']
+    TSNE_FNAME = 'data/df_tsne.csv'
+
+    _cache: Dict[str, Tuple[Tuple, Any]] = dict()
+    # derived frames are built from the cached result while holding the lock
+    _lock = threading.RLock()
+
+    @staticmethod
+    def _get_file_key(fname: str) -> Optional[Tuple]:
+        try:
+            stat = os.stat(fname)
+        except OSError:
+            return None
+        return (os.path.abspath(fname), stat.st_mtime_ns, stat.st_size)
+
     @classmethod
-    def get_cluster_barplot_df(cls) -> pd.DataFrame:
-        fname = 'data/df.csv'
+    def _get_cached(cls, name: str, fnames: List[str], build: Callable[[str], Any]) -> Optional[Any]:
+        """
+        returns `build(fname)` for the first existing file in `fnames`;
+        the value is stored as `name` and rebuilt only when the file changes;
+        returns None if none of the files exist
+        """
+        for fname in fnames:
+            key = cls._get_file_key(fname)
+            if key is not None:
+                break
+        else:
+            with cls._lock:
+                cls._cache.pop(name, None)
+            return None
+
+        with cls._lock:
+            cached_key, value = cls._cache.get(name, (None, None))
+            if cached_key != key:
+                value = build(fname)
+                cls._cache[name] = (key, value)
+            return value
 
-        if not os.path.isfile(fname):
-            print(f'{fname} not found!')
-            return pd.DataFrame({'Cluster': [], 'Number of Posts': []})
+    @classmethod
+    def clear_cache(cls) -> None:
+        with cls._lock:
+            cls._cache.clear()
 
-        df = pd.read_csv(fname, sep='\t')
-        
-        df_bar = df.groupby('label').count()
-        df_bar['Cluster'] = df_bar.index
-        df_bar['Number of Posts'] = df_bar['id']
-        
-        return df_bar
+    @staticmethod
+    def _get_local_dates(unix_time: np.ndarray) -> np.ndarray:
+        """
+        unix timestamps -> local dates as `datetime64[D]`;
+        utc offsets can only change on quarter-hour boundaries,
+        so they are looked up once per distinct quarter-hour
+        """
+        unix_time = np.asarray(unix_time, dtype=np.int64)
+        quarters, inverse = np.unique(unix_time // 900, return_inverse=True)
+        offsets = np.array([
+            datetime.datetime.fromtimestamp(int(q) * 900).astimezone().utcoffset().total_seconds()
+            for q in quarters
+        ], dtype=np.int64)
+        return ((unix_time + offsets[inverse.reshape(-1)]) // 86400).astype('datetime64[D]')
 
     @classmethod
-    def get_daily_barplot_df(cls) -> pd.DataFrame:
-        fname = 'data/df.csv'
+    def _read_result(cls, fname: str) -> pd.DataFrame:
+        """reads clustering result (`embedding` is reduced to the first two axes)"""
+        result = ClusteringResult.read(fname)
+        embeddings = result.pop('embedding')
+        result['Axis-A'] = np.array(embeddings[:, 0])
+        result['Axis-B'] = np.array(embeddings[:, 1])
+        return pd.DataFrame(result)
 
-        if not os.path.isfile(fname):
-            print(f'{fname} not found!')
-            return pd.DataFrame({'Cluster': [], 'Number of Posts': []})
+    @classmethod
+    def _get_result_df(cls) -> Optional[pd.DataFrame]:
+        df = cls._get_cached('result', cls.RESULT_FNAMES, cls._read_result)
+        if df is None:
+            print(f'{cls.RESULT_FNAMES[0]} not found!')
+        return df
 
-        df = pd.read_csv(fname, sep='\t')
-        df['unix_time'] = df['unix_time'].map(
-            lambda ts: datetime.datetime.fromtimestamp(int(ts)).date()
-        )
+    @classmethod
+    def get_cluster_barplot_df(cls) -> pd.DataFrame:
+        def build(fname: str) -> pd.DataFrame:
+            labels, counts = np.unique(cls._get_result_df()['label'], return_counts=True)
+            return pd.DataFrame({'Cluster': labels, 'Number of Posts': counts})
 
-        df_bar = df.groupby(['unix_time', 'label']).count()
-        df_bar['Date'] = df_bar.index.map(lambda t: str(t[0]))
-        df_bar['Cluster'] = df_bar.index.map(lambda t: t[1])
-        df_bar['Number of Posts'] = df_bar['id']
+        df_bar = cls._get_cached('cluster_barplot', cls.RESULT_FNAMES, build)
+        if df_bar is None:
+            return pd.DataFrame({'Cluster': [], 'Number of Posts': []})
+        return df_bar
 
-        return df_bar[['Date', 'Cluster', 'Number of Posts']]
+    @classmethod
+    def get_daily_barplot_df(cls) -> pd.DataFrame:
+        def build(fname: str) -> pd.DataFrame:
+            df = cls._get_result_df()
+            df_bar = pd.DataFrame({
+                'Date': cls._get_local_dates(df['unix_time'].to_numpy()),
+                'Cluster': df['label'].to_numpy(),
+            }).groupby(['Date', 'Cluster']).size().rename('Number of Posts').reset_index()
+            df_bar['Date'] = df_bar['Date'].dt.strftime('%Y-%m-%d')
+            return df_bar
+
+        df_bar = cls._get_cached('daily_barplot', cls.RESULT_FNAMES, build)
+        if df_bar is None:
+            return pd.DataFrame({'Date': [], 'Cluster': [], 'Number of Posts': []})
+        return df_bar
 
     @classmethod
     def get_pca_embedding_df(cls) -> pd.DataFrame:
-        fname = 'data/df.csv'
+        def build(fname: str) -> pd.DataFrame:
+            df = cls._get_result_df().copy(deep=False)
+            df.columns = [col.title() for col in df.columns]
+            return df
 
-        if not os.path.isfile(fname):
-            print('`data/df.csv` not found!')
+        df = cls._get_cached('pca_embedding', cls.RESULT_FNAMES, build)
+        if df is None:
             return pd.DataFrame({'Axis-A': [], 'Axis-B': []})
-
-        df = pd.read_csv(fname, sep='\t')
-        df['Axis-A'] = df['embedding'].map(lambda row: float(row.split(',')[0]))
-        df['Axis-B'] = df['embedding'].map(lambda row: float(row.split(',')[1]))
-        df.columns = [col.title() for col in df.columns]
-
         return df
 
     @classmethod
     def get_tsne_embedding_df(cls) -> pd.DataFrame:
-        fname = 'data/df_tsne.csv'
-
-        if not os.path.isfile(fname):
-            print('`data/df_tsne.csv` not found!')
-            return pd.DataFrame({'Axis-A': [], 'Axis-A': []})
-
-        df = pd.read_csv(fname, sep='\t')
-        df['Axis-A'] = df['embedding_tsne'].map(lambda row: float(row.split(',')[0]))
-        df['Axis-B'] = df['embedding_tsne'].map(lambda row: float(row.split(',')[1]))
-        df.columns = [col.title() for col in df.columns]
-
+        def build(fname: str) -> pd.DataFrame:
+            df = pd.read_csv(fname, sep='\t')
+            axes = df['embedding_tsne'].str.split(',', n=2, expand=True)
+            df['Axis-A'] = axes[0].astype(float)
+            df['Axis-B'] = axes[1].astype(float)
+            df.columns = [col.title() for col in df.columns]
+            return df
+
+        df = cls._get_cached('tsne_embedding', [cls.TSNE_FNAME], build)
+        if df is None:
+            print(f'`{cls.TSNE_FNAME}` not found!')
+            return pd.DataFrame({'Axis-A': [], 'Axis-B': []})
         return df
 
     @classmethod
@@ -162,7 +239,7 @@ class FigureHelper:
         n_clusters = len(df['Cluster'].unique())
 
         if not continuous:
-            df['Cluster'] = df['Cluster'].map(str) # str vals -> discrete color scheme
+            df = df.assign(Cluster=df['Cluster'].map(str)) # str vals -> discrete color scheme
     
         fig = px.bar(
             df,
@@ -182,7 +259,7 @@ class FigureHelper:
         n_clusters = len(df['Cluster'].unique())
 
         if not continuous:
-            df['Cluster'] = df['Cluster'].map(str) # str vals -> discrete color scheme
+            df = df.assign(Cluster=df['Cluster'].map(str)) # str vals -> discrete color scheme
 
         fig = px.bar(
             df,
@@ -259,6 +336,7 @@ class FigureHelper:
 
     @classmethod
     def get_wordclouds(cls, frequencies: Dict) -> go.Figure:
+        from wordcloud import WordCloud
         wcloud = WordCloud()
 
         fig = make_subplots(
@@ -0,0 +1,211 @@
+from typing import Any, Callable, Dict, List, Optional, Generator, Iterator
+
+import os
+import abc
+import json
+import pickle
+import tempfile
+import numpy as np
+
+
+class BatchDataset(abc.ABC):
+    """
+    re-iterable sequence of batches: unlike generators,
+    each `iter(dataset)` starts a new pass over the data,
+    so several passes don't require keeping copies of all batches in memory
+    """
+    @abc.abstractmethod
+    def __iter__(self) -> Iterator:
+        pass
+
+    def map(self, fun: Callable) -> 'MappedDataset':
+        """lazily applies `fun` to each batch on each pass"""
+        return MappedDataset(self, fun)
+
+    @staticmethod
+    def from_generator(generator_fun: Callable[[], Generator]) -> 'GeneratorDataset':
+        return GeneratorDataset(generator_fun)
+
+
+class GeneratorDataset(BatchDataset):
+    """each pass calls `generator_fun()` and iterates over the new generator"""
+    def __init__(self, generator_fun: Callable[[], Generator]):
+        self.generator_fun = generator_fun
+
+    def __iter__(self) -> Iterator:
+        return iter(self.generator_fun())
+
+
+class MappedDataset(BatchDataset):
+    def __init__(self, source: BatchDataset, fun: Callable):
+        self.source = source
+        self.fun = fun
+
+    def __iter__(self) -> Iterator:
+        for batch in self.source:
+            yield self.fun(batch)
+
+
+class SpillDataset(BatchDataset):
+    """
+    batches appended to a file on disk and read back one by one on each pass;
+    file is created in `spill_dir` (system temp dir by default)
+    and removed by `close` (or on exit when used as a context manager)
+    """
+    def __init__(self, spill_dir: Optional[str] = None):
+        fd, self.fname = tempfile.mkstemp(suffix='.spill', dir=spill_dir)
+        self._file = os.fdopen(fd, 'wb')
+        self.num_batches = 0
+        self.num_items = 0
+
+    def append(self, batch: Any) -> None:
+        self._write(batch)
+        self.num_batches += 1
+        self.num_items += len(batch)
+
+    def finalize(self) -> 'SpillDataset':
+        """flushes written batches; should be called before reading"""
+        self._file.flush()
+        return self
+
+    def close(self) -> None:
+        self._file.close()
+        if os.path.exists(self.fname):
+            os.remove(self.fname)
+
+    def __enter__(self) -> 'SpillDataset':
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+    def __del__(self):
+        try:
+            self.close()
+        except Exception:
+            pass
+
+    @abc.abstractmethod
+    def _write(self, batch: Any) -> None:
+        pass
+
+
+class EmbeddingStore(BatchDataset):
+    """
+    (num, dim) float32 embedding matrix stored on disk as:
+        `<path>.f32`: raw little-endian float32 matrix (row-major),
+        `<path>.ids`: raw int64 story ids (one per row),
+        `<path>.json`: metadata (num, dim, batch sizes, ...);
+    written once (`create` -> `append` -> `finalize`),
+    then read as a memory map (`open`): `matrix` and `ids` are zero-copy
+    and iterating over the store yields slices of the written batches
+    """
+    DTYPE = np.dtype('<f4')
+    ID_DTYPE = np.dtype('<i8')
+
+    def __init__(self, path: str, meta: Optional[Dict] = None):
+        self.path = path
+        self.meta = meta or {'num': 0, 'dim': None, 'batches': []}
+        self._files = None
+        self._matrix = None
+        self._ids = None
+
+    @classmethod
+    def create(cls, path: str) -> 'EmbeddingStore':
+        """
+        opens a new store for writing; files are written under temporary names
+        and replace existing store files on `finalize`
+        """
+        store = cls(path)
+        store._files = (open(f'{path}.f32.tmp', 'wb'), open(f'{path}.ids.tmp', 'wb'))
+        return store
+
+    @classmethod
+    def open(cls, path: str) -> 'EmbeddingStore':
+        with open(f'{path}.json') as f:
+            return cls(path, json.load(f))
+
+    @staticmethod
+    def exists(path: str) -> bool:
+        return all(os.path.isfile(f'{path}.{ext}') for ext in ['f32', 'ids', 'json'])
+
+    @property
+    def num(self) -> int:
+        return self.meta['num']
+
+    @property
+    def dim(self) -> Optional[int]:
+        return self.meta['dim']
+
+    def __len__(self) -> int:
+        return self.num
+
+    def append(self, ids: List[int], embeddings: np.ndarray) -> None:
+        embeddings = np.ascontiguousarray(embeddings, dtype=self.DTYPE)
+        if len(ids) != embeddings.shape[0]:
+            raise ValueError(f'Got {len(ids)} ids for {embeddings.shape[0]} embeddings')
+        if self.meta['dim'] is None:
+            self.meta['dim'] = embeddings.shape[1]
+        elif embeddings.shape[1] != self.meta['dim']:
+            raise ValueError(f'Expected embeddings with {self.dim} dims, got {embeddings.shape[1]}')
+
+        self._files[0].write(embeddings.tobytes())
+        self._files[1].write(np.asarray(ids, dtype=self.ID_DTYPE).tobytes())
+        self.meta['num'] += embeddings.shape[0]
+        self.meta['batches'].append(embeddings.shape[0])
+
+    def finalize(self, **meta) -> 'EmbeddingStore':
+        """closes written files and stores metadata (+ optional extra `meta`)"""
+        for f in self._files:
+            f.close()
+        self._files = None
+        self.meta.update(meta)
+
+        os.replace(f'{self.path}.f32.tmp', f'{self.path}.f32')
+        os.replace(f'{self.path}.ids.tmp', f'{self.path}.ids')
+        with open(f'{self.path}.json', 'w') as f:
+            json.dump(self.meta, f)
+        return self
+
+    @property
+    def matrix(self) -> np.ndarray:
+        """read-only (num, dim) memory map"""
+        if self._matrix is None:
+            self._matrix = np.memmap(f'{self.path}.f32', dtype=self.DTYPE, mode='r', shape=(self.num, self.dim)) \
+                if self.num else np.zeros((0, self.dim or 0), dtype=self.DTYPE)
+        return self._matrix
+
+    @property
+    def ids(self) -> np.ndarray:
+        """read-only memory map of story ids"""
+        if self._ids is None:
+            self._ids = np.memmap(f'{self.path}.ids', dtype=self.ID_DTYPE, mode='r', shape=(self.num,)) \
+                if self.num else np.zeros(0, dtype=self.ID_DTYPE)
+        return self._ids
+
+    def __iter__(self) -> Iterator[np.ndarray]:
+        matrix, offset = self.matrix, 0
+        for rows in self.meta['batches']:
+            yield matrix[offset:offset+rows]
+            offset += rows
+
+    def remove(self) -> None:
+        """removes store files (and temporary files of unfinished store)"""
+        for f in self._files or []:
+            f.close()
+        self._files = None
+        self._matrix = self._ids = None
+        for ext in ['f32', 'ids', 'json', 'f32.tmp', 'ids.tmp']:
+            if os.path.exists(f'{self.path}.{ext}'):
+                os.remove(f'{self.path}.{ext}')
+
+
+class RecordSpill(SpillDataset):
+    """batches of picklable records (e.g., lists of small dicts)"""
+    def _write(self, batch: List) -> None:
+        pickle.dump(batch, self._file, protocol=pickle.HIGHEST_PROTOCOL)
+
+    def __iter__(self) -> Iterator[List]:
+        with open(self.fname, 'rb') as f:
+            for _ in range(self.num_batches):
+                yield pickle.load(f)
@@ -3,7 +3,12 @@ from typing import Any, Dict, List, Tuple, Set, Optional, Generator, Union
 import sqlite3
 from flaskr.db import get_db, close_db
 
-class DBHelper:    
+class DBHelper:
+    """
+    all queries within the same app context (request or job) 
+    share a single connection (see `flaskr.db.get_db`),
+    which is closed on app context teardown
+    """
     @classmethod
     def get_connection(cls) -> sqlite3.Cursor:
         return get_db()
@@ -34,14 +39,54 @@ class DBHelper:
     def get_query(cls, query_pattern: str, params: Union[List,Tuple]) -> List[Optional[sqlite3.Row]]:
         db = cls.get_connection()
         rows = db.execute(query_pattern, tuple(params)).fetchall()
-        cls.close_connection()
         return cls.rows2dicts(rows) if rows is not None else []
 
+    @classmethod
+    def iter_query(cls, query_pattern: str, params: Union[List,Tuple], chunk_size: int = 1000) -> Generator[Dict, None, None]:
+        """
+        yields rows (as dicts) straight from the db cursor, 
+        fetching `chunk_size` rows at a time, 
+        so memory doesn't grow with the number of selected rows
+        """
+        cursor = cls.get_connection().execute(query_pattern, tuple(params))
+        try:
+            while True:
+                rows = cursor.fetchmany(chunk_size)
+                if not rows:
+                    break
+                for row in rows:
+                    yield cls.row2dict(row)
+        finally:
+            cursor.close()
+
     @classmethod
     def mod_query(cls, query_pattern: str, params: Union[List,Tuple], commit: bool = True) -> List[Optional[sqlite3.Row]]:
         db = cls.get_connection()
         db.execute(query_pattern, tuple(params))
         if commit:
             db.commit()
-        cls.close_connection()
+        return True
+
+    @classmethod
+    def mod_many(cls, queries: List[Tuple[str, List]], commit: bool = True) -> bool:
+        """
+        runs each query pattern with `executemany` over its list of params,
+        all queries are run within a single transaction (one commit);
+        if any query fails - the whole transaction is rolled back
+        INPUTS:
+            queries: list of (query_pattern, list_of_params) tuples, e.g.:
+                [
+                    ("INSERT INTO story (story_id, title) VALUES (?, ?)", [(1, 'a'), (2, 'b')]),
+                    ("INSERT INTO parent (parent_id, parent_type) VALUES (?, ?)", [(1, 'story'), (2, 'story')]),
+                ]
+        """
+        db = cls.get_connection()
+        try:
+            for query_pattern, params_list in queries:
+                db.executemany(query_pattern, [tuple(params) for params in params_list])
+            if commit:
+                db.commit()
+        except Exception:
+            db.rollback()
+            raise
         return True
@@ -0,0 +1,55 @@
+from typing import Any, Dict, List, Tuple, Set, Optional, Generator, Union
+
+import numpy as np
+
+# embeddings are stored in db as raw little-endian float32 blobs
+EMBEDDING_DTYPE = np.dtype('<f4')
+
+def embedding2blob(embedding: Union[np.ndarray, List, str, bytes, None]) -> Optional[bytes]:
+    """
+    converts embedding to the raw float32 blob stored in db;
+    accepts arrays/lists of floats, blobs (returned as is)
+    and legacy comma-joined strings
+    """
+    if embedding is None or (isinstance(embedding, str) and not embedding):
+        return None
+    if isinstance(embedding, (bytes, bytearray, memoryview)):
+        return bytes(embedding)
+    if isinstance(embedding, str):
+        embedding = embedding.split(',')
+    return np.asarray(embedding, dtype=EMBEDDING_DTYPE).tobytes()
+
+def blob2embedding(blob: Union[bytes, str, None]) -> Optional[np.ndarray]:
+    """
+    converts blob from db to 1d float32 array without copying
+    (the array is read-only); legacy comma-joined strings are parsed
+    """
+    if blob is None or (isinstance(blob, str) and not blob):
+        return None
+    if isinstance(blob, str):
+        return np.array(blob.split(','), dtype=EMBEDDING_DTYPE)
+    return np.frombuffer(blob, dtype=EMBEDDING_DTYPE)
+
+def embedding2str(embedding: Union[np.ndarray, bytes, str, None]) -> Optional[str]:
+    """
+    converts embedding to comma-joined string (format used by the api)
+    """
+    if embedding is None or isinstance(embedding, str):
+        return embedding
+    if isinstance(embedding, (bytes, bytearray, memoryview)):
+        embedding = blob2embedding(embedding)
+    return ','.join(str(val) for val in embedding)
+
+def blobs2matrix(blobs: List[Union[bytes, str]]) -> np.ndarray:
+    """
+    stacks embedding blobs into a contiguous (n, dim) float32 array
+    (each blob is copied once)
+    """
+    if not blobs:
+        return np.zeros((0, 0), dtype=EMBEDDING_DTYPE)
+
+    first = blob2embedding(blobs[0])
+    matrix = np.empty((len(blobs), first.shape[0]), dtype=EMBEDDING_DTYPE)
+    for i, blob in enumerate(blobs):
+        matrix[i] = blob2embedding(blob)
+    return matrix
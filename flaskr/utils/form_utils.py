@@ -23,6 +23,8 @@ class RequestParser:
         'model-name': 'model_name',
         'perplexity': 'perplexity',
         'dims': 'dims',
+        'cluster-model': 'cluster_model',
+        'partial-fit': 'partial_fit',
     }
     # specify the list of html eles for each sender type
     _sender2html = {
@@ -36,7 +38,13 @@ class RequestParser:
             'show-score-begin-range', 'show-score-end-range',
             'num-clusters', 'model-name'
         ],
-        'tsneer': ['perplexity', 'dims']
+        'tsneer': ['perplexity', 'dims'],
+        'updater': ['cluster-model', 'partial-fit'],
+    }
+    # html eles that are parsed only if present in the request
+    _sender2optional = {
+        'clusterer': ['cluster-model'],
+        'updater': ['show-ts-end-range'],
     }
     # specify how each key should be parsed
     _key2type = {
@@ -46,8 +54,9 @@ class RequestParser:
             'begin_comm', 'end_comm', 
             'begin_score', 'end_score', 
             'num_topics', 'n_clusters',
-            'perplexity', 'dims'
+            'perplexity', 'dims', 'partial_fit'
         ]},
+        'cluster_model': 'str',
         'fname': 'str',
         'fnames': 'list[str]',
         'model_name': 'str',
@@ -69,7 +78,9 @@ class RequestParser:
         'fname': 'file name',
         'fnames': 'file names',
         'model_name': 'name of the transformer',
-        'story_ids': 'list of post ids'
+        'story_ids': 'list of post ids',
+        'cluster_model': 'name of the stored clustering model',
+        'partial_fit': 'whether to update clusters with new posts (0 or 1)',
     }
     _key2bounds = {
         'begin_id': [1, 99999999],
@@ -82,7 +93,8 @@ class RequestParser:
         'end_score': [1, 300],
         'n_clusters': [2, 50],
         'perplexity': [5, 50],
-        'dims': [5, 50]
+        'dims': [5, 50],
+        'partial_fit': [0, 1]
     }
 
     @classmethod
@@ -109,15 +121,18 @@ class RequestParser:
             raise TypeError(f'[ERR] {cls._key2description.get(key) or key} is of unrecognized type!\n')
         
     @classmethod
-    def _parse_request(cls, request: Request, htmls: List[str]) -> Dict:
+    def _parse_request(cls, request: Request, htmls: List[str], optional: Optional[List[str]] = None) -> Dict:
         form = request.form or request.get_json()
         parsed = dict()
-        for html in htmls:
+        for html in htmls + (optional or []):
             key = cls._html2key.get(html)
-            if form.get(html) is None and form.get(key) is None:
+            field = form.get(html) if form.get(html) is not None else form.get(key)
+            if field is None:
+                if optional and html in optional:
+                    continue
                 raise NameError(f'Error accessing element with id "{html}" ({key})\n')
             
-            parsed[key] = cls._parse_field(key, form.get(html) or form.get(key)) 
+            parsed[key] = cls._parse_field(key, field) 
                             
         return parsed
 
@@ -174,7 +189,9 @@ class RequestParser:
                 f'Received form: {request.form}\n'
             ))
 
-        parsed = cls._parse_request(request, cls._sender2html[sender])
+        parsed = cls._parse_request(
+            request, cls._sender2html[sender], cls._sender2optional.get(sender)
+        )
         cls._fit_parsed_request_within_bounds(parsed) # modifies input
         cls._check_if_ranges_are_valid(parsed) # doesn't return anything or raises error
         return parsed
\ No newline at end of file
@@ -1,10 +1,20 @@
-from typing import Any, Dict, List, Tuple, Set, Optional, Generator, Union
+from typing import Any, Dict, List, Tuple, Set, Optional, Generator, Union, Iterable
 
 import requests as rq
 import datetime
+import threading
+import time
+from urllib.parse import urlparse
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from flask import current_app
 
-from flaskr.models.story import Story
-from flaskr.models.comment import Comment
+from flaskr.models.story import Story, StoryList
+from flaskr.models.comment import Comment, CommentList
+from flaskr.models.item import ItemList
+
+HN_API_URL = 'https://hacker-news.firebaseio.com/v0'
 
 story_api2schema = {
     'story_id': 'id',
@@ -30,10 +40,103 @@ comment_api2schema = {
     'type': 'type' # not in schema...
 }
 
+class RateLimiter:
+    def __init__(self, rate: Optional[float] = None, burst: Optional[int] = None):
+        """
+        thread-safe token bucket;
+        allows on average `rate` calls to `acquire()` per second
+        with at most `burst` calls in a row;
+        limiting is disabled if `rate` is None or 0
+        """
+        self.rate = rate
+        self.capacity = max(1, burst or int(rate or 1))
+        self.tokens = float(self.capacity)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self) -> None:
+        """blocks until the next call is allowed"""
+        if not self.rate:
+            return
+
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(
+                    self.capacity, 
+                    self.tokens + (now - self.updated) * self.rate
+                )
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+class HNClient:
+    def __init__(
+        self, 
+        api_url: str = HN_API_URL, 
+        max_connections: int = 16, 
+        rate_limit: Optional[float] = None,
+        timeout: float = 10,
+        retries: int = 3
+    ):
+        """
+        thin wrapper around a single keep-alive `requests.Session`
+        that can be shared by all ingest threads;
+        `rate_limit` is the max number of requests per second per host
+        """
+        self.api_url = api_url.rstrip('/')
+        self.rate_limit = rate_limit
+        self.timeout = timeout
+
+        adapter = HTTPAdapter(
+            pool_connections=4,
+            pool_maxsize=max_connections,
+            max_retries=Retry(
+                total=retries, 
+                backoff_factor=0.5,
+                status_forcelist=(429, 500, 502, 503, 504)
+            )
+        )
+        self.session = rq.Session()
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+        self._limiters = dict()
+        self._lock = threading.Lock()
+
+    def _get_limiter(self, url: str) -> RateLimiter:
+        host = urlparse(url).netloc
+        with self._lock:
+            if host not in self._limiters:
+                self._limiters[host] = RateLimiter(self.rate_limit)
+            return self._limiters[host]
+
+    def get(self, url: str) -> Any:
+        self._get_limiter(url).acquire()
+        res = self.session.get(url, timeout=self.timeout)
+        res.raise_for_status() # error pages are not json
+        return res.json()
+
+    def get_item(self, item_id: Union[int, str]) -> Optional[Dict]:
+        return self.get(f'{self.api_url}/item/{item_id}.json')
+
+    def close(self) -> None:
+        self.session.close()
+
+_client = None
+
+def get_client() -> HNClient:
+    """returns process-wide client with the default settings"""
+    global _client
+    if _client is None:
+        _client = HNClient()
+    return _client
+
 def query_api(item_id: Union[int, str]) -> str:
-    url = f'https://hacker-news.firebaseio.com/v0/item/{item_id}.json?print=pretty'
-    res = rq.get(url)
-    return res.json()
+    return get_client().get_item(item_id)
 
 def translate_response_api2schema(res: Dict) -> Dict:
     if res is None:
@@ -49,6 +152,28 @@ def translate_response_api2schema(res: Dict) -> Dict:
             for field in comment_api2schema.keys()
         }
 
+def is_empty(item: Optional[Dict]) -> bool:
+    return item is None or item.get('deleted',False) or item.get('dead',False)
+
+def describe_item(item: Dict) -> str:
+    return (
+        f'got {item.get("type", "UNKNOWN")} ' +\
+        f'from {str(datetime.datetime.fromtimestamp(int(item.get("unix_time") or 0))).split(" ")[0]}'
+    )
+
+def add_or_update_item(item: Dict, story_needs_update: bool = False) -> None:
+    print(f'{describe_item(item)}, adding to db...')
+
+    if story_needs_update:
+        story = Story(**item)
+        story.update()
+    elif item.get('type') == 'story':
+        story = Story(**item)
+        story.add()
+    elif item.get('type') == 'comment':
+        comment = Comment(**item)
+        comment.add()
+
 def fetch_and_add_item_by_id(item_id: Union[int, str], commit: str = True) -> Optional[Dict]:
     print(f'[INFO] getting {item_id}...', end=' ')
 
@@ -62,55 +187,205 @@ def fetch_and_add_item_by_id(item_id: Union[int, str], commit: str = True) -> Op
         story_needs_update = True
 
     # get item
-    item = query_api(item_id) # raw re  sponse
+    item = query_api(item_id) # raw response
     item = translate_response_api2schema(item) # fields are now the same as in schema (+)
     
     # skip if empty/deleted/dead
-    if item is None or item.get('deleted',False) or item.get('dead',False):
+    if is_empty(item):
         print('got empty, deleted or dead...')
         return    
     
     # add to db if not empty
-    print(
-        f'got {item.get("type", "UNKNOWN")} ' +\
-        f'from {str(datetime.datetime.fromtimestamp(int(item.get("unix_time") | 0))).split(" ")[0]}, ' +\
-        f'adding to db...'
-    )
-
-    if story_needs_update:
-        story = Story(**item)
-        story.update()
-    elif item.get('type') == 'story':
-        story = Story(**item)
-        story.add()
-    elif item.get('type') == 'comment':
-        comment = Comment(**item)
-        comment.add()
+    add_or_update_item(item, story_needs_update)
 
     return item
 
-def query_hn_and_add_result_to_db(form_request: Dict) -> None:
+class HNIngester:
+    def __init__(
+        self, 
+        client: Optional[HNClient] = None, 
+        max_workers: int = 16, 
+        chunk_size: int = 256,
+        batch_size: int = 500
+    ):
+        """
+        fetches items from hn api concurrently and adds them to db;
+        follows the same rules as `fetch_and_add_item_by_id`:
+        comments that are already in db are skipped (not even fetched),
+        stories that are already in db are fetched and updated;
+        http requests are made by a pool of at most `max_workers` threads,
+        while all db reads/writes happen in the calling thread
+        (so it should be called within app context);
+        ids are processed in chunks of `chunk_size`: 
+        one db lookup per chunk, next chunk is fetched while 
+        the current one is written to db;
+        fetched items are buffered and written to db 
+        in transactions of `batch_size` items
+        """
+        self.client = client or HNClient(max_connections=max_workers)
+        self.max_workers = max_workers
+        self.chunk_size = chunk_size
+        self.batch_size = batch_size
+        self.stats = {'fetched': 0, 'added': 0, 'updated': 0, 'skipped': 0, 'failed': 0}
+        self._buffers = {'add_stories': [], 'update_stories': [], 'add_comments': []}
+
+    def _buffer(self, item: Dict, story_needs_update: bool) -> None:
+        if story_needs_update:
+            self._buffers['update_stories'].append(Story(**item))
+        elif item.get('type') == 'story':
+            self._buffers['add_stories'].append(Story(**item))
+        elif item.get('type') == 'comment':
+            self._buffers['add_comments'].append(Comment(**item))
+
+        if sum(len(buffer) for buffer in self._buffers.values()) >= self.batch_size:
+            self.flush()
+
+    def flush(self) -> None:
+        """
+        writes all buffered items to db: one transaction per item type;
+        if a batch fails, falls back to writing its items one by one
+        """
+        for key, write_many, write_one, stat in [
+            ('add_stories', StoryList.add_many, Story.add, 'added'),
+            ('update_stories', StoryList.update_many, Story.update, 'updated'),
+            ('add_comments', CommentList.add_many, Comment.add, 'added'),
+        ]:
+            batch, self._buffers[key] = self._buffers[key], []
+            if not batch:
+                continue
+
+            try:
+                write_many(batch)
+                self.stats[stat] += len(batch)
+            except Exception as e:
+                print(f'[WARN] could not write batch of {len(batch)} items ({e}), writing one by one...')
+                for item in batch:
+                    try:
+                        write_one(item)
+                        self.stats[stat] += 1
+                    except Exception as e:
+                        print(f'[ERR] could not write item: {e}')
+                        self.stats['failed'] += 1
+
+    def _chunks(self, item_ids: Iterable[int]) -> Generator:
+        chunk = []
+        for item_id in item_ids:
+            chunk.append(item_id)
+            if len(chunk) >= self.chunk_size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+    def _fetch(self, item_id: int) -> Tuple[int, Optional[Dict], Optional[Exception]]:
+        try:
+            return item_id, self.client.get_item(item_id), None
+        except Exception as e:
+            return item_id, None, e
+
+    def _submit(self, executor: ThreadPoolExecutor, chunk: List[int]) -> Tuple[Set, List]:
+        """
+        looks up which items from the chunk are already in db
+        and submits the rest for fetching;
+        returns (ids of stories to update, list of futures)
+        """
+        existing = {item.item_id: item.type for item in ItemList.find_by_ids(chunk)}
+
+        to_update, futures = set(), []
+        for item_id in chunk:
+            if existing.get(item_id) == 'comment':
+                self.stats['skipped'] += 1
+                continue
+            if existing.get(item_id) == 'story':
+                to_update.add(item_id)
+            futures.append(executor.submit(self._fetch, item_id))
+
+        return to_update, futures
+
+    def _store(self, to_update: Set, futures: List) -> Generator:
+        for future in futures:
+            item_id, res, err = future.result()
+            if err is not None:
+                print(f'[ERR] could not fetch {item_id}: {err}')
+                self.stats['failed'] += 1
+                continue
+
+            self.stats['fetched'] += 1
+            item = translate_response_api2schema(res)
+            if is_empty(item):
+                continue
+            
+            print(f'[INFO] {item_id}: {describe_item(item)}')
+            self._buffer(item, item_id in to_update)
+
+            yield item
+
+    def ingest(self, item_ids: Iterable[int]) -> Generator:
+        """
+        fetches and adds/updates all items with specified ids;
+        yields each item that was added or updated 
+        (all items are written to db by the time the generator is exhausted)
+        """
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            pending = None
+            for chunk in self._chunks(item_ids):
+                submitted = self._submit(executor, chunk)
+                if pending is not None:
+                    yield from self._store(*pending)
+                pending = submitted
+
+            if pending is not None:
+                yield from self._store(*pending)
+
+        self.flush()
+
+    def ingest_range(self, begin_id: int, end_id: int) -> Dict:
         """
         collect all the stories in the requested range and 
-        all thhe comments parented by these stories + 
+        all the comments parented by these stories + 
         all the comments in the requested range
         """
         extra_comment_ids = []
-    
-        # add/update all items in the requested range
-        print(f'<<< REQUESTING ITEMS FROM {form_request["begin_id"]} TO {form_request["end_id"]} >>>')
-        for item_id in range(form_request['begin_id'], form_request['end_id']+1):
-            item = fetch_and_add_item_by_id(item_id, commit=True)
 
+        # add/update all items in the requested range
+        print(f'<<< REQUESTING ITEMS FROM {begin_id} TO {end_id} >>>')
+        for item in self.ingest(range(begin_id, end_id + 1)):
             # for stories only: record comments (kids) outside requested range
-            if item is not None and item.get('kids', None) is not None:
+            if item.get('kids', None) is not None:
                 extra_comment_ids.extend([
                     comment_id for comment_id in item['kids']
-                    if comment_id > form_request["end_id"]
+                    if comment_id > end_id
                 ])
-    
+
         # add comments outside the requested range
         # if they are parented by the stories withing the requested range
         print('<<< REQUESTING MORE ITEMS! >>>')
-        for i,item_id in enumerate(extra_comment_ids):
-            fetch_and_add_item_by_id(item_id, commit=True)
\ No newline at end of file
+        for _ in self.ingest(extra_comment_ids):
+            pass
+
+        print(f'[INFO] ingest stats: {self.stats}')
+        return self.stats
+
+def query_hn_and_add_result_to_db(form_request: Dict) -> Dict:
+        """
+        collect all the stories in the requested range and 
+        all thhe comments parented by these stories + 
+        all the comments in the requested range;
+        uses app config to set up the ingester:
+        `HN_API_URL`, `INGEST_MAX_WORKERS`, `INGEST_RATE_LIMIT`, `INGEST_BATCH_SIZE`;
+        returns ingest stats (see `HNIngester.stats`)
+        """
+        client = HNClient(
+            api_url=current_app.config.get('HN_API_URL', HN_API_URL),
+            max_connections=current_app.config.get('INGEST_MAX_WORKERS', 16),
+            rate_limit=current_app.config.get('INGEST_RATE_LIMIT'),
+        )
+        ingester = HNIngester(
+            client=client, 
+            max_workers=current_app.config.get('INGEST_MAX_WORKERS', 16),
+            batch_size=current_app.config.get('INGEST_BATCH_SIZE', 500)
+        )
+        try:
+            return ingester.ingest_range(form_request['begin_id'], form_request['end_id'])
+        finally:
+            client.close()
@@ -0,0 +1,274 @@
+from typing import Any, Dict, List, Tuple, Optional, Union
+
+import threading
+import numpy as np
+from flask import current_app
+
+from flaskr.utils.cluster_utils import KMeansForGenerator
+from flaskr.utils.embedding_utils import EMBEDDING_DTYPE, embedding2blob, blob2embedding
+
+class StoryIndex:
+    """
+    in-memory nearest neighbour index over story embeddings (cosine similarity);
+    embeddings are stored as unit-length float32 rows of a single matrix
+    that grows by doubling, so stories can be added (or updated) incrementally;
+    small indices are searched exactly: scores are computed block by block
+    (`block_size` rows per matrix-vector product) and only top-k are kept;
+    once the index has `min_ivf_size` rows it becomes an inverted file index:
+    rows are assigned to the nearest of `nlist` k-means centroids (coarse quantizer,
+    trained on a sample with `cluster_utils.KMeansForGenerator`) and only rows
+    of the `nprobe` lists nearest to the query are scored;
+    centroids are retrained (and all rows reassigned) once the index doubles in size
+    """
+    def __init__(
+        self,
+        nprobe: int = 8,
+        min_ivf_size: int = 50000,
+        block_size: int = 65536,
+        random_state: Optional[int] = 42
+    ):
+        self.nprobe = nprobe
+        self.min_ivf_size = min_ivf_size
+        self.block_size = block_size
+        self.random_state = random_state
+        self.num = 0
+        self._ids = np.zeros(0, dtype=np.int64)
+        self._matrix = None
+        self._pos = dict() # story id -> row
+        self._centroids = None
+        self._sq_centroids = None
+        self._lists = np.zeros(0, dtype=np.int32) # row -> nearest centroid
+        self._trained_num = 0
+        self._lock = threading.RLock()
+
+    @property
+    def dim(self) -> Optional[int]:
+        return None if self._matrix is None else self._matrix.shape[1]
+
+    @property
+    def is_ivf(self) -> bool:
+        return self._centroids is not None
+
+    def __contains__(self, story_id: int) -> bool:
+        return int(story_id) in self._pos
+
+    def __len__(self) -> int:
+        return self.num
+
+    @staticmethod
+    def _normalize(embeddings: np.ndarray) -> np.ndarray:
+        embeddings = np.array(embeddings, dtype=EMBEDDING_DTYPE, ndmin=2)
+        norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+        return embeddings / np.maximum(norms, 1e-12)
+
+    def _grow(self, num: int, dim: int) -> None:
+        capacity = 0 if self._matrix is None else self._matrix.shape[0]
+        if num <= capacity:
+            return
+        capacity = max(num, 2 * capacity, 1024)
+        matrix = np.empty((capacity, dim), dtype=EMBEDDING_DTYPE)
+        ids = np.empty(capacity, dtype=np.int64)
+        lists = np.empty(capacity, dtype=np.int32)
+        if self._matrix is not None:
+            matrix[:self.num] = self._matrix[:self.num]
+            ids[:self.num] = self._ids[:self.num]
+            lists[:self.num] = self._lists[:self.num]
+        self._matrix, self._ids, self._lists = matrix, ids, lists
+
+    def _assign(self, rows: np.ndarray) -> np.ndarray:
+        """nearest centroid of each row (as `argmin |c|^2 - 2 x.c`)"""
+        return np.argmin(self._sq_centroids - 2 * rows @ self._centroids.T, axis=1).astype(np.int32)
+
+    def add(self, story_ids: List[int], embeddings: Union[np.ndarray, List[np.ndarray]]) -> None:
+        """adds stories or replaces embeddings of stories that are already indexed"""
+        if not len(story_ids):
+            return
+        rows = self._normalize(embeddings)
+        with self._lock:
+            if self.dim is not None and rows.shape[1] != self.dim:
+                raise ValueError(f'Expected embeddings with {self.dim} dims, got {rows.shape[1]}')
+
+            num, positions = self.num, []
+            for story_id in story_ids:
+                story_id = int(story_id)
+                if story_id not in self._pos:
+                    self._pos[story_id] = num
+                    num += 1
+                positions.append(self._pos[story_id])
+            positions = np.asarray(positions, dtype=np.int64)
+
+            self._grow(num, rows.shape[1])
+            self._matrix[positions] = rows
+            self._ids[positions] = np.asarray(story_ids, dtype=np.int64)
+            if self.is_ivf:
+                self._lists[positions] = self._assign(rows)
+            self.num = num
+
+    def remove(self, story_ids: List[int]) -> None:
+        """removes stories from the index (last rows are moved to their place)"""
+        with self._lock:
+            for story_id in story_ids:
+                pos = self._pos.pop(int(story_id), None)
+                if pos is None:
+                    continue
+                last = self.num - 1
+                if pos != last:
+                    self._matrix[pos] = self._matrix[last]
+                    self._ids[pos] = self._ids[last]
+                    self._lists[pos] = self._lists[last]
+                    self._pos[int(self._ids[pos])] = pos
+                self.num = last
+
+    def _maybe_train(self) -> None:
+        """(re)trains coarse quantizer if the index is large enough or doubled since training"""
+        if self.num < self.min_ivf_size or (self.is_ivf and self.num < 2 * self._trained_num):
+            return
+
+        nlist = int(min(max(np.sqrt(self.num), 16), 1024))
+        rng = np.random.default_rng(self.random_state)
+        sample = self._matrix[rng.choice(self.num, size=min(self.num, 32 * nlist), replace=False)]
+        print(f'[INFO] training story index quantizer: {nlist} lists, {len(sample)} samples...')
+        kmeans = KMeansForGenerator(n_clusters=nlist, iters=10, random_state=self.random_state)
+        kmeans.fit(sample)
+
+        self._centroids = kmeans.centroids.astype(EMBEDDING_DTYPE)
+        self._sq_centroids = (self._centroids ** 2).sum(axis=1)
+        for i in range(0, self.num, self.block_size):
+            end = min(i + self.block_size, self.num)
+            self._lists[i:end] = self._assign(self._matrix[i:end])
+        self._trained_num = self.num
+
+    @staticmethod
+    def _merge_top_k(
+        best: Tuple[np.ndarray, np.ndarray],
+        scores: np.ndarray,
+        rows: np.ndarray,
+        k: int
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        if len(scores) > k:
+            top = np.argpartition(-scores, k - 1)[:k]
+            scores, rows = scores[top], rows[top]
+        scores, rows = np.concatenate([best[0], scores]), np.concatenate([best[1], rows])
+        if len(scores) > k:
+            top = np.argpartition(-scores, k - 1)[:k]
+            scores, rows = scores[top], rows[top]
+        return scores, rows
+
+    def search(
+        self,
+        embedding: np.ndarray,
+        k: int = 10,
+        exclude: Optional[List[int]] = None
+    ) -> List[Tuple[int, float]]:
+        """
+        returns up to `k` (story id, cosine similarity) pairs
+        most similar to `embedding`, most similar first;
+        stories in `exclude` are skipped
+        """
+        query = self._normalize(embedding)[0]
+        exclude = set(int(story_id) for story_id in exclude or [])
+        with self._lock:
+            self._maybe_train()
+            if not self.num:
+                return []
+
+            kk = k + len(exclude)
+            best = (np.zeros(0, dtype=EMBEDDING_DTYPE), np.zeros(0, dtype=np.int64))
+            if self.is_ivf:
+                probes = np.argsort(self._sq_centroids - 2 * self._centroids @ query)[:self.nprobe]
+                candidates = np.flatnonzero(np.isin(self._lists[:self.num], probes))
+                for i in range(0, len(candidates), self.block_size):
+                    rows = candidates[i:i+self.block_size]
+                    best = self._merge_top_k(best, self._matrix[rows] @ query, rows, kk)
+            else:
+                for i in range(0, self.num, self.block_size):
+                    end = min(i + self.block_size, self.num)
+                    best = self._merge_top_k(best, self._matrix[i:end] @ query, np.arange(i, end), kk)
+
+            order = np.argsort(-best[0], kind='stable')
+            neighbours = [
+                (int(self._ids[row]), float(score))
+                for score, row in zip(best[0][order], best[1][order])
+            ]
+
+        return [(story_id, score) for story_id, score in neighbours if story_id not in exclude][:k]
+
+    def search_by_id(self, story_id: int, k: int = 10) -> Optional[List[Tuple[int, float]]]:
+        """neighbours of an indexed story (the story itself is excluded); None if not indexed"""
+        with self._lock:
+            pos = self._pos.get(int(story_id))
+            if pos is None:
+                return None
+            embedding = self._matrix[pos].copy()
+        return self.search(embedding, k=k, exclude=[story_id])
+
+    # --- process-wide indices (one per db), built from stored story embeddings on first use ---
+    _shared: Dict[str, 'StoryIndex'] = dict()
+    _shared_lock = threading.Lock()
+
+    @classmethod
+    def get_shared(cls) -> 'StoryIndex':
+        """
+        returns index of comment embeddings of all stories in the app's db;
+        index is built on first use and kept up to date by `update_shared`
+        (called whenever story embeddings are written, see `models.story.StoryList`)
+        """
+        from flaskr.models.story import StoryList
+
+        key = current_app.config['DATABASE']
+        with cls._shared_lock:
+            if key not in cls._shared:
+                index = cls(
+                    nprobe=current_app.config.get('STORY_INDEX_NPROBE', 8),
+                    min_ivf_size=current_app.config.get('STORY_INDEX_MIN_IVF_SIZE', 50000)
+                )
+                for story_ids, embeddings in StoryList.iter_embeddings():
+                    index.add(story_ids, embeddings)
+                print(f'[INFO] built story index with {index.num} stories')
+                cls._shared[key] = index
+            return cls._shared[key]
+
+    @classmethod
+    def update_shared(cls, story_ids: List[int], embeddings: List[np.ndarray]) -> None:
+        """
+        adds/updates stories in the index of the app's db (if it was built already);
+        called after embeddings are committed, so it never raises for bad embeddings: 
+        embeddings with a different number of dims than the index are skipped
+        (their stories are removed from the index, since their old embeddings are outdated);
+        stories whose embeddings were set to `None` are removed as well
+        """
+        index = cls._shared.get(current_app.config['DATABASE'])
+        if index is None:
+            return
+
+        # embeddings can come from api as comma-joined strings
+        ids, rows, skipped, removed = [], [], [], []
+        dim = index.dim
+        for story_id, embedding in zip(story_ids, embeddings):
+            embedding = blob2embedding(embedding2blob(embedding))
+            if embedding is None:
+                removed.append(story_id)
+                continue
+            dim = dim or embedding.shape[0]
+            if embedding.shape[0] != dim:
+                skipped.append(story_id)
+                continue
+            ids.append(story_id)
+            rows.append(embedding)
+
+        if skipped:
+            print(
+                f'[WARN] story index has {dim}-dim embeddings, ' +
+                f'skipped {len(skipped)} stories with other embeddings: {skipped[:10]}'
+            )
+            index.remove(skipped)
+        if removed:
+            index.remove(removed)
+        if ids:
+            index.add(ids, np.stack(rows))
+
+    @classmethod
+    def remove_shared(cls, story_ids: List[int]) -> None:
+        index = cls._shared.get(current_app.config['DATABASE'])
+        if index is not None:
+            index.remove(story_ids)
@@ -1,11 +1,289 @@
 from typing import List, Dict, Tuple, Optional, Union, Generator
 from types import FunctionType
 
-from sklearn.decomposition import PCA, IncrementalPCA
+import os
+import json
+import struct
+import zipfile
+import numpy as np
 
-from flaskr.utils.cluster_utils import (
-    copy_and_measure_generator
-)
+class ClusteringResult:
+    """
+    clustering result stored as uncompressed `.npz` with typed columns:
+        id: int64, unix_time: int64, label: int32,
+        title, url: utf-8 strings (stored as `<col>.npy` uint8 bytes 
+            + `<col>_offsets.npy` int64 offsets),
+        embedding: (num, dim) float32,
+        meta: utf-8 json (e.g., name and `created` stamp of the model that produced the result);
+    written in a single pass with `ClusteringResult.create(fname, num)`:
+    embedding block is streamed into the archive batch by batch, 
+    small columns are buffered and written on `close`;
+    archive is written under temporary name (`<fname>.tmp`) and replaces `fname` on `close`,
+    so an unfinished result (see `abort`) never overwrites the previous one;
+    columns can be read selectively with `ClusteringResult.read`,
+    embedding block is memory-mapped (members are not compressed);
+    legacy tsv results (`df.csv`) can also be read or converted with `from_csv`
+    """
+    INT_COLUMNS = {'id': '<i8', 'unix_time': '<i8', 'label': '<i4'}
+    STR_COLUMNS = ['title', 'url']
+    COLUMNS = ['id', 'title', 'url', 'unix_time', 'label', 'embedding']
+    EMBEDDING_DTYPE = np.dtype('<f4')
+
+    # rows (elements of other columns) copied at once by `extend`
+    COPY_CHUNK_SIZE = 10000
+
+    def __init__(self, fname: str, num: int, replaces: Optional[str] = None, meta: Optional[Dict] = None):
+        self.fname = fname
+        self.num = num
+        self.replaces = replaces # result that is replaced by this one on `close`
+        self.meta = meta or dict()
+        self.columns = {col: [] for col in self.INT_COLUMNS.keys()}
+        self.columns.update({col: [] for col in self.STR_COLUMNS})
+        self._zip = zipfile.ZipFile(fname, 'w', compression=zipfile.ZIP_STORED, allowZip64=True)
+        self._embedding = None
+        self._dim = None
+        self._num_embeddings = 0
+        self._base = None # memory-mapped columns of extended result (see `extend`)
+
+    @classmethod
+    def create(cls, fname: str, num: int, meta: Optional[Dict] = None) -> 'ClusteringResult':
+        return cls(f'{fname}.tmp', num, replaces=fname, meta=meta)
+
+    @classmethod
+    def extend(cls, fname: str, num: int) -> 'ClusteringResult':
+        """
+        opens existing `.npz` result for appending `num` more stories (with `append`);
+        existing members are memory-mapped and their raw bytes are copied chunk by chunk
+        to a new archive that replaces `fname` on `close`: old rows are not decoded,
+        only appended rows are encoded (string offsets are shifted past the old ones)
+        """
+        if not fname.endswith('.npz'):
+            raise ValueError(f'Only `.npz` results can be extended, got {fname}')
+
+        names = [*cls.INT_COLUMNS.keys(), *cls.STR_COLUMNS, *(f'{col}_offsets' for col in cls.STR_COLUMNS)]
+        base = {name: cls._memmap_member(fname, f'{name}.npy') for name in names}
+        result = cls(f'{fname}.tmp', base['id'].shape[0] + num, replaces=fname, meta=cls.read_meta(fname))
+        try:
+            result._base = base
+            embeddings = cls._memmap_member(fname, 'embedding.npy')
+            for i in range(0, embeddings.shape[0], cls.COPY_CHUNK_SIZE):
+                result._append_embeddings(embeddings[i:i+cls.COPY_CHUNK_SIZE])
+            del embeddings # closes memory map of the replaced file
+        except BaseException:
+            result.abort()
+            raise
+        return result
+
+    def append(self, stories: List[Dict], labels: List[int], embeddings: np.ndarray) -> None:
+        """
+        appends a batch of story dicts (story_id, title, url, unix_time),
+        their cluster labels and embeddings
+        """
+        for st, lbl in zip(stories, labels):
+            self.columns['id'].append(st.get('story_id'))
+            self.columns['unix_time'].append(st.get('unix_time') or 0)
+            self.columns['label'].append(lbl)
+            self.columns['title'].append(st.get('title') or '')
+            self.columns['url'].append(st.get('url') or '') # nullable
+
+        self._append_embeddings(embeddings)
+
+    def _append_embeddings(self, embeddings: np.ndarray) -> None:
+        embeddings = np.ascontiguousarray(embeddings, dtype=self.EMBEDDING_DTYPE)
+        if self._embedding is None:
+            self._embedding = self._zip.open('embedding.npy', 'w', force_zip64=True)
+            np.lib.format.write_array_header_2_0(self._embedding, {
+                'descr': np.lib.format.dtype_to_descr(self.EMBEDDING_DTYPE),
+                'fortran_order': False,
+                'shape': (self.num, embeddings.shape[1]),
+            })
+            self._dim = embeddings.shape[1]
+        elif embeddings.shape[1] != self._dim:
+            raise ValueError(f'Expected embeddings with {self._dim} dims, got {embeddings.shape[1]}')
+        self._embedding.write(embeddings.tobytes())
+        self._num_embeddings += embeddings.shape[0]
+
+    def abort(self) -> None:
+        """discards unfinished result (`fname` keeps the previous one)"""
+        self._base = None
+        if self._embedding is not None:
+            self._embedding.close()
+        self._zip.close()
+        if self.replaces is not None and os.path.exists(self.fname):
+            os.remove(self.fname)
+
+    def close(self) -> None:
+        if self._num_embeddings != self.num:
+            self.abort()
+            raise RuntimeError(f'Expected {self.num} embeddings, got {self._num_embeddings}')
+        try:
+            if self._embedding is not None:
+                self._embedding.close()
+
+            # rows of extended result go after (raw copies of) its old rows
+            base = self._base or dict()
+            for col, dtype in self.INT_COLUMNS.items():
+                self._write_chunks(col, dtype, [
+                    *([base[col]] if base else []), np.asarray(self.columns[col], dtype=dtype)
+                ])
+            for col in self.STR_COLUMNS:
+                data, offsets = self._encode_strings(self.columns[col])
+                if base:
+                    old_offsets = base[f'{col}_offsets']
+                    self._write_chunks(col, np.uint8, [base[col], data])
+                    self._write_chunks(f'{col}_offsets', '<i8', [old_offsets, offsets[1:] + old_offsets[-1]])
+                else:
+                    self._write_array(col, data)
+                    self._write_array(f'{col}_offsets', offsets)
+            if self.meta:
+                self._write_array('meta', np.frombuffer(json.dumps(self.meta).encode('utf-8'), dtype=np.uint8))
+            self._base = None # closes memory maps of the replaced file
+            self._zip.close()
+        except BaseException:
+            self.abort()
+            raise
+
+        if self.replaces is not None:
+            os.replace(self.fname, self.replaces)
+
+    def _write_array(self, name: str, arr: np.ndarray) -> None:
+        with self._zip.open(f'{name}.npy', 'w', force_zip64=True) as f:
+            np.lib.format.write_array(f, arr, allow_pickle=False)
+
+    def _write_chunks(self, name: str, dtype: Union[str, np.dtype], chunks: List[np.ndarray]) -> None:
+        """writes 1-d `chunks` as a single `.npy` member (without concatenating them in memory)"""
+        dtype = np.dtype(dtype)
+        with self._zip.open(f'{name}.npy', 'w', force_zip64=True) as f:
+            np.lib.format.write_array_header_2_0(f, {
+                'descr': np.lib.format.dtype_to_descr(dtype),
+                'fortran_order': False,
+                'shape': (sum(chunk.shape[0] for chunk in chunks),),
+            })
+            for chunk in chunks:
+                for i in range(0, chunk.shape[0], self.COPY_CHUNK_SIZE):
+                    f.write(np.ascontiguousarray(chunk[i:i+self.COPY_CHUNK_SIZE], dtype=dtype).tobytes())
+
+    @staticmethod
+    def _encode_strings(strings: List[str]) -> Tuple[np.ndarray, np.ndarray]:
+        encoded = [string.encode('utf-8') for string in strings]
+        offsets = np.zeros(len(encoded) + 1, dtype='<i8')
+        np.cumsum([len(string) for string in encoded], out=offsets[1:])
+        return np.frombuffer(b''.join(encoded), dtype=np.uint8), offsets
+
+    @staticmethod
+    def _decode_strings(data: np.ndarray, offsets: np.ndarray) -> np.ndarray:
+        buf = data.tobytes()
+        return np.array([
+            buf[b:e].decode('utf-8') for b, e in zip(offsets[:-1], offsets[1:])
+        ], dtype=object)
+
+    @classmethod
+    def _memmap_member(cls, fname: str, name: str) -> np.ndarray:
+        """memory-maps `.npy` member of uncompressed `.npz` archive"""
+        with zipfile.ZipFile(fname) as zf:
+            if name not in zf.namelist(): # empty result
+                return np.zeros((0, 0), dtype=cls.EMBEDDING_DTYPE)
+            info = zf.getinfo(name)
+        if info.compress_type != zipfile.ZIP_STORED:
+            with np.load(fname) as npz:
+                return npz[name[:-len('.npy')]]
+
+        with open(fname, 'rb') as f:
+            # skip local file header: 30 bytes + file name + extra field
+            f.seek(info.header_offset)
+            header = f.read(30)
+            name_len, extra_len = struct.unpack('<HH', header[26:30])
+            f.seek(info.header_offset + 30 + name_len + extra_len)
+            # skip npy header
+            version = np.lib.format.read_magic(f)
+            shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f) \
+                if version == (1, 0) else np.lib.format.read_array_header_2_0(f)
+            offset = f.tell()
+
+        if not np.prod(shape):
+            return np.zeros(shape, dtype=dtype)
+        return np.memmap(fname, dtype=dtype, mode='r', offset=offset, shape=shape, 
+            order='F' if fortran_order else 'C')
+
+    @classmethod
+    def read(cls, fname: str, columns: Optional[List[str]] = None) -> Dict[str, np.ndarray]:
+        """
+        reads selected columns (all by default) of `.npz` or legacy `.csv` result;
+        returns {column: array}; strings are returned as object arrays,
+        `.npz` embeddings as read-only memory map
+        """
+        columns = columns or cls.COLUMNS
+        unknown = [col for col in columns if col not in cls.COLUMNS]
+        if unknown:
+            raise KeyError(f'Unknown columns: {unknown}, should be one of {cls.COLUMNS}')
+
+        if fname.endswith('.csv'):
+            return cls._read_csv(fname, columns)
+
+        result = dict()
+        with np.load(fname, allow_pickle=False) as npz:
+            for col in columns:
+                if col == 'embedding':
+                    continue
+                elif col in cls.STR_COLUMNS:
+                    result[col] = cls._decode_strings(npz[col], npz[f'{col}_offsets'])
+                else:
+                    result[col] = npz[col]
+        if 'embedding' in columns:
+            result['embedding'] = cls._memmap_member(fname, 'embedding.npy')
+
+        return {col: result[col] for col in columns}
+
+    @staticmethod
+    def read_meta(fname: str) -> Dict:
+        """meta of `.npz` result (empty for legacy results or results written without meta)"""
+        if not fname.endswith('.npz'):
+            return dict()
+        with np.load(fname, allow_pickle=False) as npz:
+            if 'meta' not in npz.files:
+                return dict()
+            return json.loads(npz['meta'].tobytes().decode('utf-8'))
+
+    @classmethod
+    def _read_csv(cls, fname: str, columns: List[str]) -> Dict[str, np.ndarray]:
+        import pandas as pd # only needed for legacy results
+        df = pd.read_csv(fname, sep='\t', usecols=columns, keep_default_na=False)
+        result = dict()
+        for col in columns:
+            if col == 'embedding':
+                result[col] = np.array([
+                    row.split(',') for row in df[col]
+                ], dtype=cls.EMBEDDING_DTYPE)
+            elif col in cls.STR_COLUMNS:
+                result[col] = df[col].astype(str).to_numpy(dtype=object)
+            else:
+                result[col] = df[col].to_numpy(dtype=cls.INT_COLUMNS[col])
+        return result
+
+    @classmethod
+    def from_csv(cls, csv_fname: str, fname: str, chunksize: int = 10000) -> int:
+        """
+        converts legacy tsv result (with `embedding` column) to `.npz`;
+        returns the number of converted stories
+        """
+        import pandas as pd
+        num = sum(1 for _ in open(csv_fname)) - 1
+        result = cls.create(fname, num)
+        try:
+            for df in pd.read_csv(csv_fname, sep='\t', chunksize=chunksize, keep_default_na=False):
+                result.append(
+                    [
+                        {'story_id': st_id, 'title': title, 'url': url, 'unix_time': ts}
+                        for st_id, title, url, ts in zip(df['id'], df['title'], df['url'], df['unix_time'])
+                    ],
+                    df['label'].tolist(),
+                    np.array([row.split(',') for row in df['embedding']], dtype=cls.EMBEDDING_DTYPE)
+                )
+        except BaseException:
+            result.abort()
+            raise
+        result.close()
+        return num
 
 class Event(list):
     def __call__(self, *args, **kwargs):
@@ -32,8 +310,15 @@ class ClustererSerializer(Serializer):
         super().__init__(clusterer)
         self.clusterer = clusterer
 
-    def serialize_clustering_result(self, fname: str) -> FunctionType:
+    def serialize_clustering_result(
+        self, fname: str, append: bool = False, meta: Optional[Dict] = None
+    ) -> FunctionType:
         """
+        result is written as columnar `.npz` (see `ClusteringResult`) 
+        if `fname` ends with `.npz` or as tsv otherwise;
+        `meta` is stored with `.npz` result (see `ClusteringResult.read_meta`);
+        with `append` new stories are added to existing `.npz` result
+        (e.g., after `Clusterer().run_incremental()`);
         clusterer change event is called as `Clusterer().change(name, val)`;
         however we also need to specify `fname` for serialization;
         `this` high order fun takes `fname` as arg and returns 
@@ -51,7 +336,7 @@ class ClustererSerializer(Serializer):
         def helper(name, val):
             if name == 'labels':
                 print('LABEL SERIALIZER TRIGGERED')
-                self._serialize_clustering_result(fname)
+                self._serialize_clustering_result(fname, append=append, meta=meta)
         return helper
 
     def serialize_pca_explained_variance(self, fname: str) -> FunctionType:
@@ -76,7 +361,23 @@ class ClustererSerializer(Serializer):
                 self._serialize_pca_explained_variance(fname)
         return helper
 
-    def _serialize_clustering_result(self, fname: str = './data/df.csv') -> bool:
+    def serialize_standardizer(self, fname: str) -> FunctionType:
+        """
+        returns a trigger that saves the state of clusterer's standardizer
+        (see `BatchedGeneratorStandardizer.save`) once stories are clustered;
+        add it as:
+        ```
+        serializer.add(serializer.serialize_standardizer(fname))
+        ```
+        """
+        def helper(name, val):
+            if name == 'labels' and self.clusterer.scaler.num:
+                self.clusterer.scaler.save(fname)
+        return helper
+
+    def _serialize_clustering_result(
+        self, fname: str = './data/df.csv', append: bool = False, meta: Optional[Dict] = None
+    ) -> bool:
         # check if all the necessary data is available
         if self.clusterer.kmeans is None or self.clusterer._embeddings is None:
             raise RuntimeError(
@@ -84,25 +385,15 @@ class ClustererSerializer(Serializer):
                 'You must obtain and cluster embeddings first!'
             )
 
-        print('[INFO] copying stories...')
-        story_batches, (l,_) = copy_and_measure_generator(self.clusterer._stories, num_copies=2)
-        self.clusterer._stories = story_batches[0]
-        if not l:
+        # stories, embeddings and labels are re-iterable datasets 
+        # (see `flaskr.utils.dataset_utils`): each zip below is a new pass
+        if not self.clusterer._num_stories:
             raise RuntimeError(
-                'Story generator is empty! ' +\
+                'Story dataset is empty! ' +\
                 'Consider rerunning .get_story_batches()'
             )
-        
-        print('[INFO] copying embeddings...')
-        emb_batches, (l,_) = copy_and_measure_generator(self.clusterer._embeddings, num_copies=2)
-        self.clusterer._embeddings = emb_batches[0]
-        if not l:
-            raise RuntimeError(
-                'Embedding generator is empty! ' +\
-                'Consider rerunning .get_embedding_batches()'
-            )
 
-        if not self.clusterer.labels:
+        if self.clusterer.labels is None:
             raise RuntimeError(
                 'There are no labels to serialize! ' +\
                 'Consider running .cluster_story_batches()'
@@ -115,27 +406,33 @@ class ClustererSerializer(Serializer):
                 self.clusterer._num_stories, 
                 self.clusterer._n_pca_dims
             )
+            from sklearn.decomposition import PCA
             self.clusterer.pca = PCA(n_components=n_dims)
-            self.clusterer.pca.fit(self.kmeans.cluster_centers_)
+            self.clusterer.pca.fit(self.clusterer.kmeans.cluster_centers_)
             print(f'[INFO] pca dim set to {n_dims}')
 
         # --- serialize ---
         print(f'[INFO] serializing result to {fname}...')
+        if append or fname.endswith('.npz'):
+            # labels are predicted (and job progress is reported) while result is written:
+            # on failure or cancellation the unfinished result is discarded, `fname` is kept
+            result = ClusteringResult.extend(fname, self.clusterer._num_stories) if append \
+                else ClusteringResult.create(fname, self.clusterer._num_stories, meta=meta)
+            try:
+                for st_batch, emb_batch, lbl_batch in self._iter_result_batches():
+                    result.append(st_batch, lbl_batch, emb_batch)
+            except BaseException:
+                result.abort()
+                raise
+            result.close()
+            return True
+
         fields = ['id', 'title', 'url', 'unix_time', 'label', 'embedding']
         with open(fname, 'w') as f:
             f.write('\t'.join(fields) + '\n')
 
-        for st_batch, emb_batch, lbl_batch in zip(
-            story_batches[1], emb_batches[1], self.clusterer._labels
-        ):
-            # reduce dimensionality with pca if it hasn't already been done
-            # otehrwise take n_dims first eigenvecs
-            emb_proj = self.clusterer.pca.transform(emb_batch) \
-                if emb_batch.shape[1] > self.clusterer._n_pca_dims \
-                else emb_batch
-            
-            for st, emb, lbl in zip(st_batch, emb_proj, lbl_batch):
-                with open(fname, 'a') as f:
+            for st_batch, emb_batch, lbl_batch in self._iter_result_batches():
+                for st, emb, lbl in zip(st_batch, emb_batch, lbl_batch):
                     f.write(
                         '\t'.join([
                             str(st.get('story_id')),
@@ -149,6 +446,18 @@ class ClustererSerializer(Serializer):
 
         return True
 
+    def _iter_result_batches(self) -> Generator:
+        """yields (story batch, low-dim embedding batch, label batch)"""
+        for st_batch, emb_batch, lbl_batch in zip(
+            self.clusterer.stories, self.clusterer.embeddings, self.clusterer.labels
+        ):
+            # reduce dimensionality with pca if it hasn't already been done
+            # otehrwise take n_dims first eigenvecs
+            emb_proj = self.clusterer.pca.transform(emb_batch) \
+                if emb_batch.shape[1] > self.clusterer._n_pca_dims \
+                else emb_batch
+            yield st_batch, emb_proj, lbl_batch
+
     def _serialize_pca_explained_variance(self, fname: int = 'data/pca.txt') -> bool:
         if self.clusterer.pca is None:
             return False
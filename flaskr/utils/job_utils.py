@@ -0,0 +1,195 @@
+from typing import Any, Callable, Dict, List, Optional
+
+import time
+import uuid
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from flask import Flask, current_app
+
+class JobCancelled(Exception):
+    pass
+
+class Job:
+    """
+    state of a background job (see `JobRunner`): status, current stage and progress;
+    progress is reported by the job itself with `set_stage` and `advance`
+    (or `track` for clusterer change events) - both raise `JobCancelled`
+    once the job is cancelled, so the job stops at the next progress report;
+    stages that must not be interrupted (e.g. saving a model whose result
+    is already written) are set with `cancellable=False`
+    """
+    STATUSES = ['queued', 'running', 'done', 'failed', 'cancelled']
+
+    def __init__(self, name: str):
+        self.id = uuid.uuid4().hex
+        self.name = name
+        self.status = 'queued'
+        self.stage = None
+        self.done = 0
+        self.total = None
+        self.result = None
+        self.error = None
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+        self._stage_started = None
+        self._cancelled = threading.Event()
+        self._lock = threading.Lock()
+
+    @property
+    def is_finished(self) -> bool:
+        return self.status in ['done', 'failed', 'cancelled']
+
+    def cancel(self) -> None:
+        self._cancelled.set()
+
+    def check_cancelled(self) -> None:
+        if self._cancelled.is_set():
+            raise JobCancelled(f'Job {self.id} ({self.name}) was cancelled')
+
+    def set_stage(self, stage: str, total: Optional[int] = None, cancellable: bool = True) -> None:
+        if cancellable:
+            self.check_cancelled()
+        with self._lock:
+            print(f'[INFO] job {self.id} ({self.name}): {stage}')
+            self.stage = stage
+            self.done = 0
+            self.total = total
+            self._stage_started = time.time()
+
+    def advance(self, num: int = 1) -> None:
+        self.check_cancelled()
+        with self._lock:
+            self.done += num
+
+    def update(self, done: int, total: Optional[int] = None) -> None:
+        self.check_cancelled()
+        with self._lock:
+            self.done = done
+            self.total = total if total is not None else self.total
+
+    def track(self, name: str, val: Any) -> None:
+        """
+        callback for clusterer change events (see `Clusterer.change`):
+        `stage` events carry (stage name, total number of stories or None),
+        `progress` events carry the number of processed stories
+        """
+        if name == 'stage':
+            self.set_stage(*val)
+        elif name == 'progress':
+            self.advance(val)
+
+    def json(self) -> Dict:
+        with self._lock:
+            now = self.finished or time.time()
+            elapsed = now - self.started if self.started else 0.
+            stage_elapsed = now - self._stage_started if self._stage_started else 0.
+            throughput = self.done / stage_elapsed if stage_elapsed > 0 else None
+            eta = max(self.total - self.done, 0) / throughput \
+                if throughput and self.total is not None and not self.is_finished else None
+
+            return {
+                'job_id': self.id,
+                'name': self.name,
+                'status': self.status,
+                'stage': self.stage,
+                'done': self.done,
+                'total': self.total,
+                'elapsed': round(elapsed, 1), # seconds since job started
+                'throughput': round(throughput, 1) if throughput else None, # items per second in current stage
+                'eta': round(eta, 1) if eta is not None else None, # seconds left in current stage
+                'result': self.result,
+                'error': self.error,
+            }
+
+class JobRunner:
+    """
+    runs jobs in a pool of `max_workers` threads:
+    at most `max_workers` heavy jobs run at once, the rest are queued;
+    jobs submitted as `exclusive` (e.g. jobs that write shared files) 
+    run one at a time and stay queued while another exclusive job runs;
+    each job runs in its own app context (with its own db connection)
+    and is called as `fun(job, *args, **kwargs)`;
+    only `history_size` most recent finished jobs are kept
+    """
+    def __init__(self, app: Flask, max_workers: int = 1, history_size: int = 100):
+        self.app = app
+        self.history_size = history_size
+        self.executor = ThreadPoolExecutor(max_workers=max(1, max_workers), thread_name_prefix='job')
+        self.jobs = OrderedDict()
+        self.lock = threading.Lock()
+        self.exclusive_lock = threading.Lock()
+
+    def submit(self, name: str, fun: Callable, *args, exclusive: bool = False, **kwargs) -> Job:
+        job = Job(name)
+        with self.lock:
+            self.jobs[job.id] = job
+            self._forget_finished()
+        self.executor.submit(self._run_exclusive if exclusive else self._run, job, fun, *args, **kwargs)
+        return job
+
+    def _run_exclusive(self, job: Job, fun: Callable, *args, **kwargs) -> None:
+        with self.exclusive_lock:
+            self._run(job, fun, *args, **kwargs)
+
+    def _run(self, job: Job, fun: Callable, *args, **kwargs) -> None:
+        if job._cancelled.is_set():
+            job.status = 'cancelled'
+            job.finished = time.time()
+            return
+
+        job.status = 'running'
+        job.started = time.time()
+        try:
+            with self.app.app_context():
+                job.result = fun(job, *args, **kwargs)
+            job.status = 'done'
+        except JobCancelled as e:
+            print(f'[INFO] {e}')
+            job.status = 'cancelled'
+        except Exception as e:
+            print(f'[ERR: job {job.name}] {e}')
+            job.error = str(e.args[0]) if e.args else repr(e)
+            job.status = 'failed'
+        finally:
+            job.finished = time.time()
+            with self.lock:
+                self._forget_finished()
+
+    def _forget_finished(self) -> None:
+        finished = [job_id for job_id, job in self.jobs.items() if job.is_finished]
+        for job_id in finished[:max(len(finished) - self.history_size, 0)]:
+            del self.jobs[job_id]
+
+    def get(self, job_id: str) -> Optional[Job]:
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def list(self) -> List[Job]:
+        with self.lock:
+            return list(self.jobs.values())
+
+    def cancel(self, job_id: str) -> Optional[Job]:
+        """queued jobs are not started, running jobs stop at their next progress report"""
+        job = self.get(job_id)
+        if job is not None and not job.is_finished:
+            job.cancel()
+        return job
+
+_job_runner_lock = threading.Lock()
+
+def get_job_runner() -> JobRunner:
+    """
+    returns app-wide job runner (created on first use),
+    configured with `JOB_WORKERS` and `JOB_HISTORY_SIZE`
+    """
+    app = current_app._get_current_object()
+    with _job_runner_lock:
+        if 'job_runner' not in app.extensions:
+            app.extensions['job_runner'] = JobRunner(
+                app,
+                max_workers=app.config.get('JOB_WORKERS', 1),
+                history_size=app.config.get('JOB_HISTORY_SIZE', 100)
+            )
+        return app.extensions['job_runner']
@@ -0,0 +1,117 @@
+from typing import Any, Dict, List, Optional
+
+import os
+import re
+import json
+import time
+import pickle
+
+from flaskr.utils.cluster_utils import BatchedGeneratorStandardizer
+from flaskr.utils.io_utils import ClusteringResult
+
+class ClusteringModel:
+    """
+    fitted state of the clustering pipeline (see `clusterpipe_utils.Clusterer`)
+    stored as a named model in `<root>/<name>/`:
+        meta.json: transformer name, number of clusters, story filters, ...
+        scaler.npz: standardizer state (see `BatchedGeneratorStandardizer.save`),
+        pca.pkl, kmeans.pkl: pickled sklearn `IncrementalPCA` and `MiniBatchKMeans`;
+    stored model can be used to assign clusters to new stories
+    without refitting (see `Clusterer.run_incremental`),
+    but only while its result is on disk: 
+    the result is stamped with model name and `created` time (see `owns_result`)
+    """
+    NAME_PATTERN = re.compile('^[A-Za-z0-9_-]{1,64}$')
+    # clusterer attributes stored in meta
+    PARAMS = [
+        '_model_name', '_n_clusters', '_n_pca_dims', '_reduced',
+        '_begin_ts', '_end_ts', '_begin_comm', '_end_comm', '_begin_score', '_end_score'
+    ]
+
+    def __init__(self, meta: Dict, scaler: BatchedGeneratorStandardizer, pca: Any, kmeans: Any):
+        self.meta = meta
+        self.scaler = scaler
+        self.pca = pca
+        self.kmeans = kmeans
+
+    @classmethod
+    def get_model_dir(cls, root: str, name: str) -> str:
+        if not isinstance(name, str) or not cls.NAME_PATTERN.match(name):
+            raise ValueError(
+                f'Model name should consist of at most 64 letters, digits, `_` or `-`, got {name}'
+            )
+        return os.path.join(root, name)
+
+    @staticmethod
+    def exists(model_dir: str) -> bool:
+        return all(
+            os.path.isfile(os.path.join(model_dir, fname))
+            for fname in ['meta.json', 'scaler.npz', 'pca.pkl', 'kmeans.pkl']
+        )
+
+    @staticmethod
+    def read_meta(model_dir: str) -> Dict:
+        with open(os.path.join(model_dir, 'meta.json')) as f:
+            return json.load(f)
+
+    @staticmethod
+    def get_result_stamp(name: str, created: int) -> Dict:
+        """stored with clustering result (see `ClusteringResult.read_meta`)"""
+        return {'model': name, 'created': created}
+
+    @classmethod
+    def owns_result(cls, meta: Dict) -> bool:
+        """
+        whether the result at `result_fname` was produced by the model with this meta
+        (results of all models are written to the same file, 
+        so a newer model overwrites the result of the older one)
+        """
+        fname = meta.get('result_fname')
+        if not fname or not os.path.isfile(fname):
+            return False
+        return ClusteringResult.read_meta(fname) == cls.get_result_stamp(meta.get('name'), meta.get('created'))
+
+    @classmethod
+    def from_clusterer(cls, clusterer: 'Clusterer', **meta) -> 'ClusteringModel':
+        """
+        takes fitted state of clusterer after `run` or `run_incremental`;
+        `meta` is stored along with clusterer params 
+        (e.g., `result_fname`, `name` and `created` - see `owns_result`)
+        """
+        if clusterer.kmeans is None or clusterer.pca is None:
+            raise RuntimeError(
+                'Clusterer is not fitted yet! ' +\
+                'Run the pipeline and serialize the result first.'
+            )
+        params = {param.lstrip('_'): getattr(clusterer, param) for param in cls.PARAMS}
+        return cls({**params, **meta}, clusterer.scaler, clusterer.pca, clusterer.kmeans)
+
+    def save(self, model_dir: str) -> None:
+        """each file is written under temporary name and then replaces the old one"""
+        os.makedirs(model_dir, exist_ok=True)
+        self.meta['updated'] = int(time.time())
+        self.meta.setdefault('created', self.meta['updated'])
+        if self.meta.get('result_fname') and os.path.isfile(self.meta['result_fname']):
+            self.meta['num_stories'] = len(ClusteringResult.read(self.meta['result_fname'], ['id'])['id'])
+
+        def replace(fname, write):
+            path = os.path.join(model_dir, fname)
+            with open(f'{path}.tmp', 'wb') as f:
+                write(f)
+            os.replace(f'{path}.tmp', path)
+
+        replace('scaler.npz', self.scaler.save)
+        replace('pca.pkl', lambda f: pickle.dump(self.pca, f, protocol=pickle.HIGHEST_PROTOCOL))
+        replace('kmeans.pkl', lambda f: pickle.dump(self.kmeans, f, protocol=pickle.HIGHEST_PROTOCOL))
+        # meta is written last: model is only complete (see `exists`) once it's there
+        replace('meta.json', lambda f: f.write(json.dumps(self.meta, indent=2).encode('utf-8')))
+
+    @classmethod
+    def load(cls, model_dir: str) -> 'ClusteringModel':
+        meta = cls.read_meta(model_dir)
+        scaler = BatchedGeneratorStandardizer.load(os.path.join(model_dir, 'scaler.npz'))
+        with open(os.path.join(model_dir, 'pca.pkl'), 'rb') as f:
+            pca = pickle.load(f)
+        with open(os.path.join(model_dir, 'kmeans.pkl'), 'rb') as f:
+            kmeans = pickle.load(f)
+        return cls(meta, scaler, pca, kmeans)
@@ -1,51 +1,117 @@
-from typing import Any, Dict, List, Set, Optional, Generator
+from typing import Any, Callable, Dict, List, Set, Tuple, Optional, Generator, Union
 
 import os
 import json
 import numpy as np
-import lxml
-import bs4 as bs
 import re
-from collections import defaultdict
-from sentence_transformers import SentenceTransformer
+from html import unescape
+import multiprocessing as mp
+import threading
+from collections import defaultdict, deque, Counter, OrderedDict
+from functools import lru_cache
+from concurrent.futures import ProcessPoolExecutor
 
 from smart_open import open
 
-import nltk
-from nltk.corpus import stopwords
-from nltk.stem import PorterStemmer, LancasterStemmer
+from flaskr.models.thread import StoryThreadList
+from flaskr.utils.io_utils import ClusteringResult
+from flaskr.utils.stopwords import ENGLISH_STOP_WORDS
 
-from flaskr.models.story import Story
+# heavy dependencies (`sentence_transformers` with torch, `nltk`) are imported on first use
 
-nltk.download('stopwords')
-stop_words = stopwords.words('english')
-stop_words = set(stop_words)
+# html tags and comments (HN comments only use a handful of simple tags: 
+# `<p>`, `<a>`, `<i>`, `<pre><code>`; `<` in text is always escaped)
+HTML_TAG_PATTERN = re.compile(r'<!--.*?-->|<(/?)([a-zA-Z][^\s/>]*)[^>]*>', re.DOTALL)
+# tags without content, tags that implicitly close `<p>`
+HTML_VOID_TAGS = {'br', 'hr', 'img', 'input', 'meta', 'link', 'wbr', 'area', 'base', 'col', 'embed', 'source'}
+HTML_BLOCK_TAGS = {
+    'p', 'pre', 'div', 'ul', 'ol', 'dl', 'table', 'blockquote', 'hr', 
+    'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'form', 'address', 'fieldset',
+}
+ASCII_SPACES = '\x20\x0a\x09\x0c\x0d'
+# punctuation removed from sentences
+SENTENCE_PUNCT_TABLE = {
+    i: '' for i in 
+    list(range(33, 46)) + 
+    list(range(58,64)) + 
+    list(range(91,97)) +
+    list(range(123,127))
+}
+
+def html2nodes(html: str) -> Generator[Tuple[str, int], None, None]:
+    """
+    yields (text node, paragraph) for each text node of html
+    in document order (entities decoded, comments skipped),
+    `paragraph` is the index of enclosing `<p>` (-1 outside of paragraphs);
+    each `<p>` also yields an empty node to mark its start;
+    text nodes are the same as the strings of BeautifulSoup tree
+    built with lxml: leading whitespace of the document is dropped,
+    stray end tags don't split text and whitespace-only nodes 
+    are collapsed to a single '\\n' or ' ' (unless inside `<pre>`)
+    """
+    html = html.replace('\r\n', '\n').replace('\r', '\n')
+    start, paragraph, num_paragraphs = 0, -1, 0
+    num_open = defaultdict(int)
+    for match in HTML_TAG_PATTERN.finditer(html):
+        closing, tag = match.group(1), (match.group(2) or '').lower()
+        if closing and not num_open[tag]:
+            continue # stray end tag: ignored, text around it is a single node
+
+        txt = _clean_text_node(
+            html[start:match.start()], 
+            start == 0, 
+            num_open['pre'] + num_open['textarea']
+        )
+        if txt:
+            yield txt, paragraph
+        start = match.end()
+
+        if not tag:
+            continue # comment
+        if tag == 'p' and not closing:
+            num_open['p'] = 1
+            paragraph, num_paragraphs = num_paragraphs, num_paragraphs + 1
+            yield '', paragraph
+            continue
+        if tag == 'p' or (tag in HTML_BLOCK_TAGS and not closing):
+            num_open['p'] = 0
+            paragraph = -1
+        if tag not in HTML_VOID_TAGS and tag != 'p':
+            num_open[tag] += -1 if closing else 1
+
+    txt = _clean_text_node(html[start:], start == 0, num_open['pre'] + num_open['textarea'])
+    if txt:
+        yield txt, paragraph
+
+def _clean_text_node(txt: str, is_first: bool, num_pre: int) -> str:
+    txt = HTML_TAG_PATTERN.sub('', txt) if '</' in txt else txt # stray end tags
+    if is_first:
+        txt = txt.lstrip(ASCII_SPACES)
+    if '&' in txt:
+        txt = unescape(txt)
+    if txt and not num_pre and not txt.strip(ASCII_SPACES):
+        txt = '\n' if '\n' in txt else ' '
+    return txt
 
 def html2text(html: str) -> str:
-    soup = bs.BeautifulSoup(html, 'lxml')
-    return soup.get_text(separator=' ')
+    return ' '.join(txt for txt, _ in html2nodes(html) if txt)
 
-def html2paragraphs(html: str) -> str:
-    soup = bs.BeautifulSoup(html, 'lxml')    
-    return [
-        sp.get_text(separator=' ') 
-        for sp in soup.find_all('p')
-    ]
+def html2paragraphs(html: str) -> List[str]:
+    """texts of `<p>` elements (text before the first `<p>` is not a paragraph)"""
+    paragraphs = []
+    for txt, paragraph in html2nodes(html):
+        if paragraph == len(paragraphs):
+            paragraphs.append([])
+        if txt and paragraph >= 0:
+            paragraphs[paragraph].append(txt)
+    return [' '.join(paragraph) for paragraph in paragraphs]
 
 def html2sentences(html: str) -> List[str]:
-    # get dict to remove punctuation
-    tr = {
-        i: '' for i in 
-        list(range(33, 46)) + 
-        list(range(58,64)) + 
-        list(range(91,97)) +
-        list(range(123,127))
-    }
     # get html-free text
     txt = html2text(html)
-    # split into sentences
+    # split into sentences, remove punctuation
     return [
-        sentence.strip().lower().translate(tr)
+        sentence.strip().lower().translate(SENTENCE_PUNCT_TABLE)
         for sentence in txt.split('.')
     ]
 
@@ -74,6 +140,7 @@ class RareWordFinder:
 
 class StoryEmbedder:
     def __init__(self, model_name: str = 'sentence-transformers/all-distilroberta-v1'):
+        from sentence_transformers import SentenceTransformer
         self.model = SentenceTransformer(model_name)
 
     def embed_sentences(self, sentences: List[str]) -> List[np.ndarray]:
@@ -82,15 +149,127 @@ class StoryEmbedder:
     def embed_and_average_sentences(self, sentences: List[str]) -> np.ndarray:
         return self.model.encode(sentences).mean(axis=0)
 
+    def embed_stories(self, stories: List[List[str]], batch_size: int = 64) -> np.ndarray:
+        """
+        embeds sentences of many stories at once and averages them per story;
+        sentences of all stories are sorted by length and encoded 
+        in batches of `batch_size` (so that batches are well filled 
+        and have little padding), then averaged back per story
+        INPUTS:
+            stories: list: each element is a list of story sentences
+            batch_size: number of sentences per `encode` call
+        OUTPUTS:
+            (num_stories, embed_dim) float32 array; 
+            stories without sentences get zero embeddings
+        """
+        lengths = np.array([len(sentences) for sentences in stories], dtype=np.int64)
+        flat = [sentence for sentences in stories for sentence in sentences]
+        if not flat:
+            dim = self.model.get_sentence_embedding_dimension()
+            return np.zeros((len(stories), dim), dtype=np.float32)
+
+        # encode longest sentences first, write results back in original order
+        order = np.argsort([-len(sentence) for sentence in flat], kind='stable')
+        embeddings = None
+        for i in range(0, len(flat), batch_size):
+            idxs = order[i:i+batch_size]
+            batch = self.model.encode([flat[idx] for idx in idxs], batch_size=batch_size)
+            if embeddings is None:
+                embeddings = np.empty((len(flat), batch.shape[1]), dtype=np.float32)
+            embeddings[idxs] = batch
+
+        # segment means (sentences of each story are contiguous in `flat`)
+        nonempty = lengths > 0
+        offsets = np.cumsum(lengths) - lengths
+        averaged = np.zeros((len(stories), embeddings.shape[1]), dtype=np.float32)
+        averaged[nonempty] = np.add.reduceat(embeddings, offsets[nonempty], axis=0) / \
+            lengths[nonempty, None]
+        return averaged
 
+class EmbedderRegistry:
+    """
+    process-wide registry of loaded story embedders (transformers):
+    embedders are loaded by model name on first use and shared by all consumers
+    (e.g., `Clusterer`) in the process;
+    at most `max_size` embedders are kept loaded, least recently used is evicted
+    (consumers that still hold it can keep using it);
+    use as:
+    ```
+    embedder = EmbedderRegistry.get(model_name)
+    ```
+    """
+    max_size = 2
+    stats = {'hits': 0, 'loads': 0, 'evicted': 0}
+    _embedders: 'OrderedDict[str, StoryEmbedder]' = OrderedDict()
+    _lock = threading.Lock()
+    # model name -> lock held while the model is loaded (loaded once even if requested concurrently)
+    _loading: Dict[str, threading.Lock] = dict()
+
+    @classmethod
+    def configure(cls, max_size: int = 2, preload: Optional[List[str]] = None) -> None:
+        """sets the max number of loaded embedders and loads `preload` models right away"""
+        with cls._lock:
+            cls.max_size = max(1, max_size)
+            cls._evict()
+        for model_name in (preload or [])[:cls.max_size]:
+            print(f'[INFO] preloading {model_name}...')
+            cls.get(model_name)
+
+    @classmethod
+    def get(cls, model_name: str) -> StoryEmbedder:
+        with cls._lock:
+            if model_name in cls._embedders:
+                cls._embedders.move_to_end(model_name)
+                cls.stats['hits'] += 1
+                return cls._embedders[model_name]
+            loading = cls._loading.setdefault(model_name, threading.Lock())
+
+        with loading:
+            with cls._lock:
+                if model_name in cls._embedders:
+                    cls._embedders.move_to_end(model_name)
+                    cls.stats['hits'] += 1
+                    return cls._embedders[model_name]
+
+            embedder = StoryEmbedder(model_name=model_name)
+
+            with cls._lock:
+                cls._embedders[model_name] = embedder
+                cls.stats['loads'] += 1
+                cls._loading.pop(model_name, None)
+                cls._evict()
+            return embedder
+
+    @classmethod
+    def _evict(cls) -> None:
+        while len(cls._embedders) > cls.max_size:
+            model_name, _ = cls._embedders.popitem(last=False)
+            cls.stats['evicted'] += 1
+            print(f'[INFO] unloaded {model_name}')
+
+    @classmethod
+    def loaded(cls) -> List[str]:
+        """names of loaded models, least recently used first"""
+        with cls._lock:
+            return list(cls._embedders.keys())
+
+    @classmethod
+    def clear(cls) -> None:
+        with cls._lock:
+            cls._embedders.clear()
 
 class Tokenizer:
-    def __init__(self):
+    # max number of distinct words with memoized stems
+    STEM_CACHE_SIZE = 200000
+
+    def __init__(self, stem_cache_size: Optional[int] = STEM_CACHE_SIZE):
+        from nltk.stem import PorterStemmer
         self.porter = PorterStemmer()
-        self.punct_pattern = re.compile('[\W_]+', re.UNICODE)
+        self.punct_pattern = re.compile(r'[\W_]+', re.UNICODE)
         self.space_pattern = re.compile(' +', re.UNICODE)
+        self.word_pattern = re.compile(r'[^\W_]+', re.UNICODE)
         self.frequencies = defaultdict(int)
-        self.stop_words = set(stopwords.words('english'))
+        self.stop_words = set(ENGLISH_STOP_WORDS)
         self.trivial_words = set([
             'use', 'go', 'thing', 'would','year', 'day', 'look', 'way',
             'with', 'without', 'take', 'need', 'stuff', 'also', 'much',
@@ -101,54 +280,141 @@ class Tokenizer:
             'work', 'use', 
         ])
         self.blacklist = self.stop_words.union(self.trivial_words)
+        # word -> stem (None for blacklisted words); 
+        # word frequencies are heavily skewed, so most lookups are hits
+        self._stem_word = lru_cache(maxsize=stem_cache_size)(self._stem_uncached)
+
+    def _stem_uncached(self, word: str) -> Optional[str]:
+        return None if word in self.blacklist else self.porter.stem(word)
+
+    @property
+    def stem_cache_stats(self) -> Dict:
+        info = self._stem_word.cache_info()
+        num = info.hits + info.misses
+        return {
+            'hits': info.hits,
+            'misses': info.misses,
+            'size': info.currsize,
+            'hit_rate': info.hits / num if num else 0.
+        }
         
     def remove_punctuation(self, txt: str) -> str:
         txt =  self.punct_pattern.sub(' ', txt)
         return self.space_pattern.sub(' ', txt)
     
-    def get_stems(self, txt: str) -> List[str]:
+    def get_stems(self, txt: Union[str, List[str]]) -> List[str]:
         if isinstance(txt, str):            
             txt = txt.split(' ')
             
-        return [
-            self.porter.stem(word) for word in txt 
-            if word not in self.blacklist
-        ]
+        stems = map(self._stem_word, txt)
+        return [stem for stem in stems if stem is not None]
     
     def tokenize(self, txt: str) -> List[str]:
-        txt = self.remove_punctuation(txt.lower())
-        return self.get_stems(txt)
+        """
+        lowercased words (runs of letters/digits) of `txt`
+        without blacklisted words, stemmed;
+        empty tokens are not produced
+        """
+        return self.get_stems(self.word_pattern.findall(txt.lower()))
+
+def count_thread_tokens(tokenizer: Tokenizer, threads: List[Tuple[str, str]]) -> Dict[str, Counter]:
+    """counts tokens of (label, thread html) pairs per label"""
+    counts = defaultdict(Counter)
+    for label, children in threads:
+        counts[label].update(tokenizer.tokenize(html2text(children)))
+    return dict(counts)
+
+# tokenizer worker state (each worker process builds its own tokenizer)
+_worker_tokenizer = None
+
+def _init_tokenizer_worker() -> None:
+    global _worker_tokenizer
+    _worker_tokenizer = Tokenizer()
+
+def _count_thread_tokens_in_worker(threads: List[Tuple[str, str]]) -> Dict[str, Counter]:
+    return count_thread_tokens(_worker_tokenizer, threads)
 
 class ClusterFrequencyCounter:
-    def __init__(self):
+    def __init__(self, n_workers: int = 0):
         self.tokenizer = Tokenizer()
+        self.n_workers = n_workers # tokenizer processes (0: tokenize in current process)
         self.frequencies = dict()
 
-    def update_cluster_frequencies(self, label: int, tokens: List[str]) -> None:
-        for token in tokens:
-            if not token:
-                continue
-            if label not in self.frequencies.keys():
-                self.frequencies[label] = defaultdict(int)
-            self.frequencies[label][token] += 1
-
-    def count_serialized_cluster_frequencies(self, fname: str) -> Dict:
-        for i,line in enumerate(open(fname)):
-            if not i:
-                field2idx = {field:idx for idx,field in enumerate(line.split('\t'))}
-                continue
-            if not i % 50:
-                print(f'[INFO] processed {i} stories for wordcloud')
-
-            vals = line.split('\t')
-            story_id = vals[field2idx['id']]
-            label = vals[field2idx['label']]
-            
-            story = Story.find_by_id_with_children(story_id)
-            comments = html2text(story.children)
-            tokens = self.tokenizer.tokenize(comments)
+    def update_cluster_frequencies(self, label: str, tokens: Union[List[str], Counter]) -> None:
+        counts = tokens if isinstance(tokens, Counter) else Counter(tokens)
+        counts.pop('', None)
+        if label not in self.frequencies.keys():
+            self.frequencies[label] = Counter()
+        self.frequencies[label].update(counts)
+
+    def _iter_chunk_counts(self, thread_chunks: Generator) -> Generator:
+        for threads in thread_chunks:
+            yield count_thread_tokens(self.tokenizer, threads), len(threads)
+
+    def _iter_chunk_counts_in_workers(self, thread_chunks: Generator) -> Generator:
+        """
+        same as `_iter_chunk_counts`, but chunks are tokenized 
+        in a pool of `self.n_workers` processes;
+        up to `2 * n_workers` chunks are in flight
+        """
+        executor = ProcessPoolExecutor(
+            max_workers=self.n_workers,
+            mp_context=mp.get_context('spawn'), # don't fork sqlite state
+            initializer=_init_tokenizer_worker
+        )
+        try:
+            pending = deque()
+            for threads in thread_chunks:
+                pending.append((executor.submit(_count_thread_tokens_in_worker, threads), len(threads)))
+                if len(pending) >= 2 * self.n_workers:
+                    future, num = pending.popleft()
+                    yield future.result(), num
+
+            while pending:
+                future, num = pending.popleft()
+                yield future.result(), num
+        finally:
+            executor.shutdown()
+
+    def count_serialized_cluster_frequencies(
+        self, 
+        fname: str, 
+        chunk_size: int = 500, 
+        progress: Optional[Callable[[int, int], None]] = None
+    ) -> Dict:
+        """
+        reads story ids and labels from clustering result 
+        (`.npz` or tsv, see `io_utils.ClusteringResult`)
+        and counts token frequencies of story comments per cluster;
+        story threads are fetched in chunks of `chunk_size` ids
+        (one query per chunk), each chunk is tokenized and counted
+        (in a worker process if `n_workers > 0`)
+        before being merged into cluster frequencies;
+        `progress(num_processed, num_total)` is called after each chunk
+        """
+        result = ClusteringResult.read(fname, ['id', 'label'])
+        id2label = dict(zip(result['id'].tolist(), map(str, result['label'].tolist())))
+
+        thread_chunks = (
+            [(id2label[story_id], children) for story_id, children in threads]
+            for threads in StoryThreadList.iter_children_by_ids(list(id2label), chunk_size=chunk_size)
+        )
+        chunk_counts = self._iter_chunk_counts_in_workers(thread_chunks) \
+            if self.n_workers > 0 else self._iter_chunk_counts(thread_chunks)
+        
+        num = 0
+        for counts, num_threads in chunk_counts:
+            for label, label_counts in counts.items():
+                self.update_cluster_frequencies(label, label_counts)
+
+            num += num_threads
+            print(f'[INFO] processed {num}/{len(id2label)} stories for wordcloud')
+            if progress is not None:
+                progress(num, len(id2label))
 
-            self.update_cluster_frequencies(label, tokens)
+        if self.n_workers == 0:
+            stats = self.tokenizer.stem_cache_stats
+            print(f'[INFO] stem cache: {stats["size"]} words, hit rate {stats["hit_rate"]:.1%}')
 
         return self.frequencies
 
@@ -7,15 +7,39 @@ from flaskr import create_app
 from flaskr.db import init_db
 
 #(scope="session"): fixture will be shared by all the tests requesting it
+# (not called `app`, since this name is reserved by pytest-flask)
 @pytest.fixture(scope="session")
-def client():
+def application():
     db_fd, db_path = tempfile.mkstemp()
     app = create_app({'TESTING': True, 'DATABASE': db_path})
 
-    with app.test_client() as client:
-        with app.app_context():
-            init_db()
-        yield client
+    with app.app_context():
+        init_db()
+    yield app
 
     os.close(db_fd)
-    os.unlink(db_path)
\ No newline at end of file
+    os.unlink(db_path)
+
+@pytest.fixture(scope="session")
+def client(application):
+    with application.test_client() as client:
+        yield client
+
+@pytest.fixture
+def empty_db(application):
+    """
+    points the app to a fresh db for the duration of a single test;
+    yields the app with an active app context
+    """
+    db_fd, db_path = tempfile.mkstemp()
+    old_path = application.config['DATABASE']
+    application.config['DATABASE'] = db_path
+
+    try:
+        with application.app_context():
+            init_db()
+            yield application
+    finally:
+        application.config['DATABASE'] = old_path
+        os.close(db_fd)
+        os.unlink(db_path)
@@ -0,0 +1,122 @@
+import os
+import pytest
+import numpy as np
+
+from flaskr.utils.cluster_utils import BatchedGeneratorStandardizer, KMeansForGenerator
+from flaskr.utils.dataset_utils import BatchDataset, SpillDataset, RecordSpill, EmbeddingStore
+
+def get_batches():
+    rng = np.random.default_rng(42)
+    batches = [rng.normal(5, 3, size=(num, 4)) for num in [7, 1, 30, 12]]
+    for batch in batches:
+        batch[:, 3] = 2. # constant feature
+    return batches
+
+def test_standardizer_matches_full_data_statistics():
+    batches = get_batches()
+    data = np.concatenate(batches)
+
+    scaler = BatchedGeneratorStandardizer()
+    standardized = np.concatenate(list(scaler.fit_transform(batch for batch in batches)))
+
+    assert scaler.num == len(data)
+    assert np.allclose(scaler.mean, data.mean(axis=0))
+    assert np.allclose(scaler.var, data.std(axis=0))
+    # constant feature is centered but not scaled
+    assert np.allclose(standardized[:, :3], (data[:, :3] - data[:, :3].mean(axis=0)) / data[:, :3].std(axis=0))
+    assert np.allclose(standardized[:, 3], 0)
+
+def test_standardizer_partial_fit_and_persistence(tmpdir):
+    batches = get_batches()
+    fitted = BatchedGeneratorStandardizer()
+    fitted.fit(batches)
+
+    # fit incrementally, persisting the state in between
+    fname = str(tmpdir.join('scaler.npz'))
+    scaler = BatchedGeneratorStandardizer()
+    for batch in batches[:2]:
+        scaler.partial_fit(batch)
+    scaler.save(fname)
+    scaler = BatchedGeneratorStandardizer.load(fname)
+    for batch in batches[2:]:
+        scaler.partial_fit(batch)
+
+    assert scaler.num == fitted.num
+    assert np.allclose(scaler.mean, fitted.mean)
+    assert np.allclose(scaler.var, fitted.var)
+
+def test_embedding_store(tmpdir):
+    path = str(tmpdir.join('embeddings'))
+    batches = get_batches()
+
+    store = EmbeddingStore.create(path)
+    offset = 0
+    for batch in batches:
+        store.append(list(range(offset, offset + len(batch))), batch)
+        offset += len(batch)
+    store.finalize(model_name='model-a')
+    assert EmbeddingStore.exists(path)
+
+    store = EmbeddingStore.open(path)
+    assert store.meta['model_name'] == 'model-a'
+    assert store.matrix.shape == (offset, 4) and store.matrix.dtype == np.float32
+    assert np.array_equal(store.ids, np.arange(offset))
+    # batches are zero-copy slices of the memory map
+    for stored, batch in zip(store, batches):
+        assert isinstance(stored, np.memmap)
+        assert np.allclose(stored, batch)
+
+def test_spills_are_removed(tmpdir):
+    with pytest.raises(TypeError):
+        BatchDataset()
+    with pytest.raises(TypeError):
+        SpillDataset(str(tmpdir))
+
+    with RecordSpill(str(tmpdir)) as spill:
+        spill.append([{'story_id': 1}])
+        assert list(spill.finalize()) == [[{'story_id': 1}]]
+        assert os.path.exists(spill.fname)
+    assert os.listdir(str(tmpdir)) == []
+
+    # unfinished store is removed with its temporary files
+    store = EmbeddingStore.create(str(tmpdir.join('embeddings')))
+    store.append([0, 1], get_batches()[0][:2])
+    store.remove()
+    assert os.listdir(str(tmpdir)) == []
+
+def get_blobs(num, n_clusters=4, dim=16, seed=0):
+    rng = np.random.default_rng(seed)
+    centers = rng.normal(size=(n_clusters, dim)) * 10
+    labels = rng.integers(0, n_clusters, num)
+    return centers[labels] + rng.normal(size=(num, dim)), labels
+
+def test_kmeans_finds_blobs():
+    X, labels = get_blobs(1000)
+    batches = [X[i:i+128] for i in range(0, len(X), 128)]
+
+    kmeans = KMeansForGenerator(4, chunk_size=50, init_size=200, random_state=0)
+    kmeans.fit(batches)
+    pred = np.concatenate(list(kmeans.predict(batches)))
+    # same partition up to cluster numbering
+    assert len(set(zip(labels, pred))) == 4 and len(set(pred)) == 4
+    assert np.isclose(kmeans.inertia, sum(
+        np.sum((X[pred == c] - X[pred == c].mean(axis=0))**2) for c in range(4)
+    ))
+
+    # one-shot generators of batches or of single samples give the same result
+    centroids = KMeansForGenerator(4, init=kmeans.centroids).fit(batch for batch in batches)
+    assert np.allclose(centroids, kmeans.centroids)
+    assert [int(lbl) for lbl in kmeans.predict(sample for sample in X[:10])] == pred[:10].tolist()
+    dists = np.concatenate(list(kmeans.transform(batches)))
+    assert np.allclose(dists, np.linalg.norm(X[:, None, :] - kmeans.centroids[None, :, :], axis=2))
+
+def test_kmeans_relocates_empty_clusters():
+    X, _ = get_blobs(300, n_clusters=3)
+    # the last centroid is too far to get any samples
+    init = np.concatenate([X[:2], np.full((1, X.shape[1]), 1e6)])
+
+    kmeans = KMeansForGenerator(3, init=init)
+    kmeans.fit([X])
+    pred = next(kmeans.predict(X))
+    assert np.isfinite(kmeans.centroids).all()
+    assert np.bincount(pred, minlength=3).min() > 0
@@ -0,0 +1,317 @@
+import os
+import re
+import time
+import pytest
+import tracemalloc
+import numpy as np
+from collections import Counter
+
+from flaskr.db import get_db
+from flaskr.utils.db_utils import DBHelper
+from flaskr.utils.nlp_utils import StoryEmbedder, ClusterFrequencyCounter, Tokenizer, html2text
+from flaskr.utils import clusterpipe_utils
+from flaskr.utils.clusterpipe_utils import Clusterer
+from flaskr.utils.io_utils import ClustererSerializer, ClusteringResult
+from flaskr.utils.cluster_utils import TSNEer
+from flaskr.utils.model_utils import ClusteringModel
+from flaskr.utils.job_utils import Job, JobCancelled
+from flaskr.models.story import Story, StoryList
+from flaskr.models.comment import Comment
+
+class CountingEmbedder:
+    """stands in for `StoryEmbedder`: embeds each story as its number of sentences"""
+    def __init__(self):
+        self.calls = 0
+
+    def embed_stories(self, stories, batch_size=64):
+        self.calls += len(stories)
+        return np.array([[len(sentences)] * 3 for sentences in stories], dtype=np.float32)
+
+class SentenceModel:
+    """stands in for `SentenceTransformer`: embeds sentence as (length, 1), records batches"""
+    def __init__(self):
+        self.batches = []
+
+    def encode(self, sentences, batch_size=32):
+        self.batches.append(list(sentences))
+        return np.array([[len(sentence), 1] for sentence in sentences], dtype=np.float32)
+
+def get_stories(ids):
+    return [story.json() for story in StoryList.find_by_ids_with_children(ids)]
+
+def test_only_changed_stories_are_embedded(empty_db):
+    Story(story_id=1, title='Story one.', unix_time=1626110314).add()
+    Story(story_id=2, title='Story two.', unix_time=1626110314).add()
+
+    clusterer = Clusterer()
+    clusterer.embedder = CountingEmbedder()
+    first = clusterer._read_or_generate_story_embeddings(get_stories([1, 2]))
+    assert clusterer.embedder.calls == 2
+
+    # new comment invalidates the embedding of story 2 only
+    Comment(comment_id=3, body='First comment. Second sentence.', parent_id=2).add()
+    second = clusterer._read_or_generate_story_embeddings(get_stories([1, 2]))
+    assert clusterer.embedder.calls == 3
+    assert np.array_equal(first[0], second[0])
+    assert not np.array_equal(first[1], second[1])
+    assert clusterer.cache.stats == {'hits': 1, 'misses': 3, 'evicted': 0}
+
+    # embeddings of the default model are also stored with the stories
+    ids, embeddings = StoryList.find_embeddings_by_ids([1, 2])
+    assert ids == [1, 2] and np.array_equal(embeddings[1], second[1])
+
+    # other models don't reuse these embeddings
+    other = Clusterer().set.model_name('sentence-transformers/all-MiniLM-L6-v2').build()
+    other.embedder = CountingEmbedder()
+    other._read_or_generate_story_embeddings(get_stories([1, 2]))
+    assert other.embedder.calls == 2
+
+def test_embed_stories_matches_per_story_averages():
+    embedder = StoryEmbedder.__new__(StoryEmbedder)
+    embedder.model = SentenceModel()
+    stories = [['a', 'bbb'], [], ['cc'], ['dddd', 'e', 'ff']]
+
+    embeddings = embedder.embed_stories(stories, batch_size=2)
+
+    expected = [embedder.embed_and_average_sentences(sentences) for sentences in stories if sentences]
+    assert embeddings.shape == (4, 2) and embeddings.dtype == np.float32
+    assert np.allclose(embeddings[[0, 2, 3]], expected)
+    assert np.array_equal(embeddings[1], [0, 0])
+
+    # sentences of all stories are encoded in fixed-size, length-sorted batches
+    assert embedder.model.batches[:3] == [['dddd', 'bbb'], ['cc', 'ff'], ['a', 'e']]
+
+class BatchEmbedder:
+    """
+    stands in for `StoryEmbedder` in embedding workers: 
+    embeds each story as (story number from its title, number of stories in the call);
+    the call with story 1 is the slowest, so the first batch finishes last
+    """
+    def embed_stories(self, stories, batch_size=64):
+        numbers = [int(re.search(r'\d+', ' '.join(sentences)).group()) for sentences in stories]
+        if 1 in numbers:
+            time.sleep(1)
+        return np.array([[number, len(stories)] for number in numbers], dtype=np.float32)
+
+def init_batch_embedding_worker(model_name, num_threads):
+    """replaces `_init_embedding_worker`: runs in spawned worker, doesn't need torch"""
+    clusterpipe_utils._worker_embedder = BatchEmbedder()
+
+def test_embedding_workers_keep_batch_order(empty_db, monkeypatch):
+    # spawned workers import the initializer by name, so the stub is module-level
+    monkeypatch.setattr(clusterpipe_utils, '_init_embedding_worker', init_batch_embedding_worker)
+    for i in range(1, 8):
+        Story(story_id=i, title=f'Story {i}.', unix_time=1626110314).add()
+
+    clusterer = Clusterer().set.n_workers(2).build()
+    # story 7 is cached, so it's not sent to workers
+    list(clusterer._read_or_generate_story_embeddings_in_workers(iter([get_stories([7])])))
+    batches = [get_stories([1, 2]), get_stories([3, 7]), get_stories([4, 5, 6])]
+    embedded = list(clusterer._read_or_generate_story_embeddings_in_workers(iter(batches)))
+
+    # embeddings are yielded in batch order, each story is embedded with its own batch
+    assert [[list(embedding) for embedding in embeddings] for embeddings in embedded] == [
+        [[1, 2], [2, 2]],
+        [[3, 1], [7, 1]],
+        [[4, 3], [5, 3], [6, 3]],
+    ]
+    assert sum(num for num, _ in clusterer._throughput.values()) == 7
+
+    # embeddings are written to cache and to stories (default model)
+    cached = clusterer.cache.get_many(
+        list(range(1, 8)), 
+        [clusterer.cache.hash_content(story['children']) for story in get_stories(list(range(1, 8)))]
+    )
+    assert {story_id: list(embedding) for story_id, embedding in cached.items()} == {
+        1: [1, 2], 2: [2, 2], 3: [3, 1], 4: [4, 3], 5: [5, 3], 6: [6, 3], 7: [7, 1]
+    }
+    ids, embeddings = StoryList.find_embeddings_by_ids(list(range(1, 8)))
+    assert ids == list(range(1, 8)) and np.array_equal(embeddings[:, 0], ids)
+
+class RandomEmbedder:
+    """stands in for `StoryEmbedder`: random 768-dim embeddings"""
+    def embed_stories(self, stories, batch_size=64):
+        return np.random.rand(len(stories), 768).astype(np.float32)
+
+def get_clustering_peak_memory(num_stories, tmpdir):
+    for table in ['story', 'parent', 'story_thread', 'embedding_cache']:
+        get_db().execute(f'DELETE FROM {table}')
+    get_db().commit()
+    StoryList.add_many([
+        Story(story_id=i, title=f'Story {i}.', unix_time=1626110314 + i, num_comments=5, score=10)
+        for i in range(1, num_stories + 1)
+    ])
+
+    clusterer = Clusterer().set\
+        .n_clusters(5).n_pca_dims(20).min_batch_size(100)\
+        .begin_timestep(1626110314).end_timestep(1626110314 + num_stories + 1)\
+        .begin_comments(0).end_comments(10).begin_score(0).end_score(100)\
+        .spill_dir(str(tmpdir))\
+        .build()
+    clusterer.embedder = RandomEmbedder()
+    serializer = ClustererSerializer(clusterer)
+    fname = os.path.join(str(tmpdir), f'df_{num_stories}.npz')
+    serializer.add(serializer.serialize_clustering_result(fname))
+
+    tracemalloc.start()
+    clusterer.run()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    # low-dim embeddings are memory-mapped from the result
+    tsneer = TSNEer(n_components=2)
+    embeddings = tsneer.read_embedding_from_result(fname, dims=10)
+    assert embeddings.shape == (num_stories, 10)
+    assert isinstance(embeddings.base, np.memmap)
+    assert tsneer.df['id'].tolist() == list(range(1, num_stories + 1))
+    return peak
+
+def test_pipeline_memory_is_bounded_by_batch_size(empty_db, tmpdir):
+    small = get_clustering_peak_memory(500, tmpdir)
+    large = get_clustering_peak_memory(4000, tmpdir)
+
+    # 8x more stories should need about as much memory
+    # (all intermediate embeddings of 4000 stories would take ~25MB)
+    assert large < 2 * small, (small, large)
+
+@pytest.mark.parametrize('n_workers', [0, 2])
+def test_cluster_frequencies_are_counted_in_bulk(empty_db, tmpdir, monkeypatch, n_workers):
+    StoryList.add_many([
+        Story(story_id=i, title=f'Story {i} about databases', unix_time=1626110314 + i)
+        for i in range(1, 8)
+    ])
+    for i in range(1, 8):
+        Comment(comment_id=100 + i, body=f'<p>Indexed queries {i}</p>', parent_id=i).add()
+    Comment(comment_id=200, body='<p>Nested <i>reply</i> about queries</p>', parent_id=101).add()
+
+    labels = [0, 1, 0, 2, 1, 0, 2]
+    stories = [story.json() for story in StoryList.find_by_ids(list(range(1, 8)))]
+    fname = str(tmpdir.join('df.npz'))
+    result = ClusteringResult.create(fname, len(stories))
+    result.append(stories, labels, np.zeros((len(stories), 2)))
+    result.close()
+
+    # expected: tokens of each story thread counted one story at a time
+    tokenizer = Tokenizer()
+    expected = dict()
+    for story, label in zip(stories, labels):
+        tokens = tokenizer.tokenize(html2text(Story.find_by_id_with_children(story['story_id']).children))
+        expected.setdefault(str(label), Counter()).update(token for token in tokens if token)
+
+    num_queries = {'num': 0}
+    get_query = DBHelper.get_query
+    def counting_get_query(*args, **kwargs):
+        num_queries['num'] += 1
+        return get_query(*args, **kwargs)
+    monkeypatch.setattr(DBHelper, 'get_query', counting_get_query)
+
+    counter = ClusterFrequencyCounter(n_workers=n_workers)
+    frequencies = counter.count_serialized_cluster_frequencies(fname, chunk_size=3)
+    assert frequencies == expected
+    assert num_queries['num'] == 3
+
+@pytest.mark.parametrize('partial_fit', [False, True])
+def test_incremental_run_assigns_only_new_stories(empty_db, tmpdir, partial_fit):
+    def add_stories(ids):
+        StoryList.add_many([
+            Story(story_id=i, title=f'Story {i}.', unix_time=1626110314 + i, num_comments=5, score=10)
+            for i in ids
+        ])
+
+    add_stories(range(1, 201))
+    fname, model_dir = str(tmpdir.join('df.npz')), str(tmpdir.join('models', 'default'))
+    clusterer = Clusterer().set\
+        .n_clusters(5).n_pca_dims(20).min_batch_size(50)\
+        .begin_timestep(1626110314).end_timestep(1626110314 + 201)\
+        .begin_comments(0).end_comments(10).begin_score(0).end_score(100)\
+        .spill_dir(str(tmpdir))\
+        .build()
+    clusterer.embedder = RandomEmbedder()
+    serializer = ClustererSerializer(clusterer)
+    serializer.add(serializer.serialize_clustering_result(fname))
+    clusterer.run()
+    ClusteringModel.from_clusterer(clusterer, result_fname=fname).save(model_dir)
+    before = ClusteringResult.read(fname)
+
+    add_stories(range(201, 231))
+    model = ClusteringModel.load(model_dir)
+    assert model.meta['num_stories'] == 200 and model.meta['reduced']
+    centers = model.kmeans.cluster_centers_.copy()
+
+    clusterer = Clusterer().set\
+        .fitted_model(model)\
+        .end_timestep(1626110314 + 231)\
+        .exclude_ids(before['id'])\
+        .partial_fit(partial_fit)\
+        .min_batch_size(50)\
+        .spill_dir(str(tmpdir))\
+        .build()
+    clusterer.embedder = RandomEmbedder()
+    serializer = ClustererSerializer(clusterer)
+    serializer.add(serializer.serialize_clustering_result(fname, append=True))
+    job = Job('update')
+    clusterer.change.append(job.track)
+    clusterer.run_incremental()
+    assert clusterer._num_stories == 30
+    assert (job.stage, job.done, job.total) == ('assigning', 30, 30)
+    assert np.allclose(clusterer.kmeans.cluster_centers_, centers) != partial_fit
+
+    after = ClusteringResult.read(fname)
+    assert after['id'].tolist() == list(range(1, 231))
+    assert after['label'][:200].tolist() == before['label'].tolist()
+    assert set(after['label'][200:].tolist()) <= set(range(5))
+    assert after['embedding'].shape == (230, 20)
+
+    # nothing left to assign: result is not rewritten
+    clusterer = Clusterer().set.fitted_model(model).exclude_ids(after['id']).build()
+    clusterer.embedder = RandomEmbedder()
+    assert clusterer.run_incremental().labels is None
+
+@pytest.mark.parametrize('append', [False, True])
+def test_cancelled_job_keeps_previous_result(empty_db, tmpdir, append):
+    StoryList.add_many([
+        Story(story_id=i, title=f'Story {i}.', unix_time=1626110314 + i, num_comments=5, score=10)
+        for i in range(1, 201)
+    ])
+    fname = str(tmpdir.join('df.npz'))
+
+    def get_clusterer(model=None):
+        builder = Clusterer().set.min_batch_size(50).spill_dir(str(tmpdir))
+        if model is not None:
+            builder = builder.fitted_model(model).end_timestep(1626110314 + 201)
+        else:
+            builder = builder\
+                .n_clusters(5).n_pca_dims(20)\
+                .begin_timestep(1626110314).end_timestep(1626110314 + 150)\
+                .begin_comments(0).end_comments(10).begin_score(0).end_score(100)
+        clusterer = builder.build()
+        clusterer.embedder = RandomEmbedder()
+        return clusterer
+
+    clusterer = get_clusterer()
+    serializer = ClustererSerializer(clusterer)
+    serializer.add(serializer.serialize_clustering_result(fname, meta={'model': 'default'}))
+    clusterer.run()
+    model = ClusteringModel.from_clusterer(clusterer, result_fname=fname)
+    before = ClusteringResult.read(fname)
+    clusterer.close()
+
+    # job is cancelled once stories are assigned to clusters (while result is written)
+    clusterer = get_clusterer(model if append else None)
+    if append:
+        clusterer.set.exclude_ids(before['id'])
+    serializer = ClustererSerializer(clusterer)
+    serializer.add(serializer.serialize_clustering_result(fname, append=append))
+    job = Job('cluster')
+    clusterer.change.append(job.track)
+    clusterer.change.append(lambda name, val: job.cancel() if name == 'stage' and val[0] == 'assigning' else None)
+    with pytest.raises(JobCancelled):
+        clusterer.run_incremental() if append else clusterer.run()
+
+    after = ClusteringResult.read(fname)
+    for col in ClusteringResult.COLUMNS:
+        assert np.array_equal(after[col], before[col])
+    assert ClusteringResult.read_meta(fname) == {'model': 'default'}
+    assert not os.path.exists(f'{fname}.tmp')
+    # spills and temporary embedding store are removed with the failed run
+    assert os.listdir(str(tmpdir)) == ['df.npz']
@@ -0,0 +1,99 @@
+import os, datetime
+import numpy as np
+import pandas as pd
+import pytest
+
+from flaskr.utils.io_utils import ClusteringResult
+from flaskr.utils.dash_utils import DataHelper
+
+def write_result(num, seed=0):
+    rng = np.random.default_rng(seed)
+    stories = [
+        {'story_id': i, 'title': f'title {i}', 'url': f'https://{i}', 
+         'unix_time': int(ts)}
+        for i,ts in enumerate(rng.integers(1600000000, 1600000000 + 10 * 86400, num), 1)
+    ]
+    labels = rng.integers(0, 5, num)
+    embeddings = rng.normal(size=(num, 4)).astype(np.float32)
+
+    result = ClusteringResult.create('data/df.npz', num)
+    result.append(stories, labels, embeddings)
+    result.close()
+    return stories, labels, embeddings
+
+@pytest.fixture
+def data_dir(tmpdir, monkeypatch):
+    monkeypatch.chdir(tmpdir)
+    os.mkdir('data')
+    DataHelper.clear_cache()
+    yield tmpdir
+    DataHelper.clear_cache()
+
+def test_dash_frames(data_dir):
+    stories, labels, embeddings = write_result(500)
+
+    df_bar = DataHelper.get_cluster_barplot_df()
+    assert df_bar['Cluster'].tolist() == sorted(set(labels))
+    assert df_bar['Number of Posts'].tolist() == [int((labels == lbl).sum()) for lbl in sorted(set(labels))]
+
+    # same as the former per-row conversion to local dates
+    df = pd.DataFrame({
+        'id': [st['story_id'] for st in stories],
+        'unix_time': [datetime.datetime.fromtimestamp(st['unix_time']).date() for st in stories],
+        'label': labels
+    })
+    expected = df.groupby(['unix_time', 'label']).count()
+    df_daily = DataHelper.get_daily_barplot_df()
+    assert df_daily['Date'].tolist() == [str(t[0]) for t in expected.index]
+    assert df_daily['Cluster'].tolist() == [t[1] for t in expected.index]
+    assert df_daily['Number of Posts'].tolist() == expected['id'].tolist()
+
+    df_pca = DataHelper.get_pca_embedding_df()
+    assert df_pca['Id'].tolist() == [st['story_id'] for st in stories]
+    assert df_pca['Title'].tolist() == [st['title'] for st in stories]
+    assert np.allclose(df_pca['Axis-A'], embeddings[:,0])
+    assert np.allclose(df_pca['Axis-B'], embeddings[:,1])
+
+def test_dash_frames_cached(data_dir, monkeypatch):
+    write_result(100)
+
+    num_reads = {'num': 0}
+    read = ClusteringResult.read
+    def counting_read(*args, **kwargs):
+        num_reads['num'] += 1
+        return read(*args, **kwargs)
+    monkeypatch.setattr(ClusteringResult, 'read', counting_read)
+
+    frames = [
+        DataHelper.get_cluster_barplot_df(),
+        DataHelper.get_daily_barplot_df(),
+        DataHelper.get_pca_embedding_df(),
+    ]
+    for _ in range(3):
+        assert DataHelper.get_cluster_barplot_df() is frames[0]
+        assert DataHelper.get_daily_barplot_df() is frames[1]
+        assert DataHelper.get_pca_embedding_df() is frames[2]
+    assert num_reads['num'] == 1
+
+    # rewritten result invalidates all derived frames
+    _, labels, _ = write_result(200, seed=1)
+    st = os.stat('data/df.npz')
+    os.utime('data/df.npz', ns=(st.st_atime_ns, st.st_mtime_ns + 1))
+    assert DataHelper.get_cluster_barplot_df()['Number of Posts'].sum() == 200
+    assert len(DataHelper.get_pca_embedding_df()) == 200
+    assert num_reads['num'] == 2
+
+    os.remove('data/df.npz')
+    assert DataHelper.get_cluster_barplot_df().empty
+
+def test_tsne_frame(data_dir):
+    with open('data/df_tsne.csv', 'w') as f:
+        f.write('\tid\ttitle\tlabel\tembedding_tsne\n')
+        f.write('0\t1\ta\t0\t0.5,-1.5\n')
+        f.write('1\t2\tb\t1\t2.0,3.25\n')
+
+    df = DataHelper.get_tsne_embedding_df()
+    assert df['Id'].tolist() == [1, 2]
+    assert df['Axis-A'].tolist() == [0.5, 2.0]
+    assert df['Axis-B'].tolist() == [-1.5, 3.25]
+    assert DataHelper.get_tsne_embedding_df() is df
@@ -0,0 +1,220 @@
+import numpy as np
+
+from flaskr.db import get_db
+from flaskr.utils.db_utils import DBHelper
+from flaskr.utils.embedding_utils import blob2embedding
+from flaskr.models.story import Story, StoryList
+from flaskr.models.comment import Comment, CommentList
+from flaskr.models.thread import StoryThread, StoryThreadList
+from flaskr.models.embedding_cache import EmbeddingCache
+
+def test_connection_pragmas(empty_db):
+    db = get_db()
+    assert db.execute('PRAGMA journal_mode;').fetchone()[0] == 'wal'
+    assert db.execute('PRAGMA synchronous;').fetchone()[0] == 1 # NORMAL
+    assert db.execute('PRAGMA cache_size;').fetchone()[0] == empty_db.config['SQLITE_CACHE_SIZE']
+
+def test_connection_reused_within_app_context(empty_db):
+    db = get_db()
+    Story(story_id=1, title='story 1', unix_time=1626110314).add()
+    assert StoryList.stats() == {'num': 1, 'min': 1, 'max': 1}
+    assert get_db() is db
+
+def get_query_plan(query, params):
+    return [row['detail'] for row in get_db().execute(f'EXPLAIN QUERY PLAN {query}', params)]
+
+def test_clustering_query_uses_indices(empty_db):
+    # story ids are filtered with the covering index
+    ids_query = f"""
+        SELECT s.story_id FROM story AS s
+        {Story.FILTER_WHERE}
+    """
+    plan = get_query_plan(ids_query, [1, 2, 3, 4, 5, 6])
+    assert any('COVERING INDEX story_filter_idx' in detail for detail in plan), plan
+
+    # stories with comments are then read by ids
+    query = f"""
+        {Story.SELECT_WITH_CHILDREN}
+        WHERE s.story_id IN (?, ?, ?)
+    """
+    plan = get_query_plan(query, [1, 2, 3])
+    assert not [detail for detail in plan if detail.startswith(('SCAN s', 'SCAN t'))], plan
+
+def test_thread_rebuild_query_uses_indices(empty_db):
+    plan = get_query_plan(StoryThreadList.REBUILD_QUERY, [1])
+
+    # neither stories nor comments are fully scanned
+    assert not [detail for detail in plan if detail.startswith(('SCAN s', 'SCAN c'))], plan
+    assert any('comment_parent_idx' in detail for detail in plan), plan
+
+def test_story_pages_are_read_by_key(empty_db):
+    # deep pages are a range scan of the primary key, not an offset scan
+    plan = get_query_plan(*StoryList._page_query(after_id=10, limit=5, begin_ts=1, end_ts=2))
+    assert any('INTEGER PRIMARY KEY (rowid>?)' in detail for detail in plan), plan
+    assert not any('TEMP B-TREE' in detail for detail in plan), plan
+
+    StoryList.add_many([Story(story_id=i, title=f'story {i}', unix_time=100 + i) for i in range(1, 8)])
+
+    assert [story.story_id for story in StoryList.find_page(after_id=2, limit=3)] == [3, 4, 5]
+    assert [story.story_id for story in StoryList.find_page(after_id=5, limit=3)] == [6, 7]
+    assert [story.story_id for story in StoryList.iter_page(begin_ts=102, end_ts=105)] == [2, 3, 4, 5]
+    assert [story.story_id for story in StoryList.iter_page(after_id=3, limit=2)] == [4, 5]
+
+# ----------------------------------
+# ------------ THREADS -------------
+# ----------------------------------
+def get_thread(story_id):
+    thread = StoryThread.find_by_id(story_id)
+    return sorted(thread.children.split(StoryThread.SEPARATOR)), thread.num_comments
+
+def test_thread_is_maintained(empty_db):
+    Story(story_id=1, title='story 1', unix_time=1626110314).add()
+    Story(story_id=2, title='story 2', unix_time=1626110314).add()
+    assert get_thread(1) == (['story 1'], 0)
+
+    # replies to story, to comments in db and to comments within the same batch
+    Comment(comment_id=3, body='c3', parent_id=1).add()
+    CommentList.add_many([
+        Comment(comment_id=5, body='c5', parent_id=4),
+        Comment(comment_id=4, body='c4', parent_id=3),
+        Comment(comment_id=6, body=None, parent_id=3),
+        Comment(comment_id=7, body='c7', parent_id=2),
+        Comment(comment_id=8, body='c8', parent_id=999), # orphan
+    ])
+    assert get_thread(1) == (['c3', 'c4', 'c5', 'story 1'], 4)
+    assert get_thread(2) == (['c7', 'story 2'], 1)
+
+    # move comment with its reply to another story
+    Comment(comment_id=4, body='c4*', parent_id=7).update()
+    assert get_thread(1) == (['c3', 'story 1'], 2)
+    assert get_thread(2) == (['c4*', 'c5', 'c7', 'story 2'], 3)
+
+    Comment.find_by_id(7).delete()
+    assert get_thread(2) == (['story 2'], 0)
+
+    Story(story_id=1, title='story 1*', unix_time=1626110314).update()
+    assert get_thread(1) == (['c3', 'story 1*'], 2)
+    assert 'story 1*' in Story.find_by_id_with_children(1).children
+
+    Story.find_by_id(2).delete()
+    assert StoryThread.find_by_id(2) is None
+
+def test_thread_picks_up_replies_added_before_parent(empty_db):
+    Story(story_id=1, title='s', unix_time=1626110314).add()
+
+    # reply arrives in an earlier batch than its parent
+    Comment(comment_id=3, body='reply', parent_id=2).add()
+    assert get_thread(1) == (['s'], 0)
+    CommentList.add_many([
+        Comment(comment_id=2, body='parent', parent_id=1),
+        Comment(comment_id=4, body='sibling', parent_id=1),
+    ])
+    assert get_thread(1) == (['parent', 'reply', 's', 'sibling'], 3)
+
+    # replies of the replies are picked up as well
+    Comment(comment_id=7, body='deep reply', parent_id=6).add()
+    Comment(comment_id=6, body='reply 2', parent_id=5).add()
+    Comment(comment_id=5, body='parent 2', parent_id=4).add()
+    assert get_thread(1) == (['deep reply', 'parent', 'parent 2', 'reply', 'reply 2', 's', 'sibling'], 6)
+
+def test_thread_backfill(empty_db):
+    Story(story_id=1, title='story 1', unix_time=1626110314).add()
+    Comment(comment_id=2, body='c2', parent_id=1).add()
+    Comment(comment_id=3, body='c3', parent_id=2).add()
+    expected = get_thread(1)
+
+    get_db().execute('DELETE FROM story_thread')
+    get_db().commit()
+    assert StoryThread.find_by_id(1) is None
+
+    assert StoryThreadList.backfill(chunk_size=1) == 1
+    assert get_thread(1) == expected == (['c2', 'c3', 'story 1'], 2)
+
+# ----------------------------------
+# ----------- EMBEDDINGS -----------
+# ----------------------------------
+def test_embeddings_stored_as_float32_blobs(empty_db):
+    embedding = np.arange(4, dtype=np.float32) / 3
+    Story(story_id=1, title='story 1', comment_embedding=embedding).add()
+
+    row = get_db().execute('SELECT comment_embedding FROM story WHERE story_id = 1').fetchone()
+    assert isinstance(row[0], bytes) and len(row[0]) == 4 * 4
+
+    story = Story.find_by_id(1)
+    assert np.array_equal(blob2embedding(story.comment_embedding), embedding)
+    assert story.json()['comment_embedding'] == ','.join(str(val) for val in embedding)
+
+def test_migrate_text_embeddings(empty_db):
+    Story(story_id=1, title='story 1').add()
+    Story(story_id=2, title='story 2').add()
+    Story(story_id=3, title='story 3').add()
+    get_db().executemany(
+        'UPDATE story SET comment_embedding = ? WHERE story_id = ?',
+        [('0.5,1.5,2.5', 1), ('3.5,4.5,5.5', 2)]
+    )
+    get_db().commit()
+
+    assert StoryList.migrate_text_embeddings(chunk_size=1) == 2
+
+    ids, embeddings = StoryList.find_embeddings_by_ids([3, 2, 1])
+    assert ids == [2, 1]
+    assert embeddings.dtype == np.float32 and embeddings.flags['C_CONTIGUOUS']
+    assert np.array_equal(embeddings, [[3.5, 4.5, 5.5], [0.5, 1.5, 2.5]])
+
+# ----------------------------------
+# -------- EMBEDDING CACHE ---------
+# ----------------------------------
+def test_embedding_cache_is_keyed_by_model_and_content(empty_db):
+    cache = EmbeddingCache('model-a')
+    other = EmbeddingCache('model-b')
+    hashes = [EmbeddingCache.hash_content('thread 1'), EmbeddingCache.hash_content('thread 2')]
+    embeddings = [np.ones(3, dtype=np.float32), np.zeros(3, dtype=np.float32)]
+
+    assert cache.get_many([1, 2], hashes) == {}
+    cache.put_many([1, 2], hashes, embeddings)
+
+    found = cache.get_many([1, 2], hashes)
+    assert sorted(found) == [1, 2] and np.array_equal(found[1], embeddings[0])
+    assert other.get_many([1, 2], hashes) == {}
+
+    # thread of story 2 got new comments
+    changed = [hashes[0], EmbeddingCache.hash_content('thread 2<br><br>new comment')]
+    assert sorted(cache.get_many([1, 2], changed)) == [1]
+    assert cache.stats == {'hits': 3, 'misses': 3, 'evicted': 0}
+    assert cache.hit_rate == 0.5
+
+def test_embedding_cache_evicts_least_recently_used(empty_db):
+    cache = EmbeddingCache('model-a', max_entries=2)
+    hashes = [EmbeddingCache.hash_content(f'thread {i}') for i in range(3)]
+    embeddings = [np.full(3, i, dtype=np.float32) for i in range(3)]
+
+    cache.put_many([0, 1], hashes[:2], embeddings[:2])
+    cache.get_many([0], hashes[:1]) # 1 is now least recently used
+    cache.put_many([2], hashes[2:], embeddings[2:])
+
+    assert cache.stats['evicted'] == 1
+    assert sorted(cache.get_many([0, 1, 2], hashes)) == [0, 2]
+
+def test_embedding_cache_counts_entries_only_when_full(empty_db, monkeypatch):
+    cache = EmbeddingCache('model-a', max_entries=10)
+    hashes = [EmbeddingCache.hash_content(f'thread {i}') for i in range(12)]
+    embeddings = [np.full(3, i, dtype=np.float32) for i in range(12)]
+
+    counts = []
+    get_query = DBHelper.get_query
+    def counting_get_query(query, params):
+        if 'COUNT(*)' in query:
+            counts.append(query)
+        return get_query(query, params)
+    monkeypatch.setattr(DBHelper, 'get_query', counting_get_query)
+
+    for i in range(0, 8, 2):
+        cache.put_many([i, i + 1], hashes[i:i+2], embeddings[i:i+2])
+    assert len(counts) == 1 # first put only
+
+    # overwrites make the tracked number an upper bound, table is recounted once it's over the limit
+    cache.put_many([0, 1, 2], hashes[:3], embeddings[:3])
+    assert len(counts) == 2 and cache.stats['evicted'] == 0
+    cache.put_many([8, 9, 10, 11], hashes[8:], embeddings[8:])
+    assert len(counts) == 3 and cache.stats['evicted'] == 2
+    assert get_db().execute('SELECT COUNT(*) FROM embedding_cache').fetchone()[0] == 10
@@ -5,7 +5,13 @@ or
 $ pytest
 (the latter requires `__init__.py` file to be present in `tests`)
 """
-import os, json
+import os, sys, json, time
+import numpy as np
+from flask import current_app
+
+from flaskr.utils.io_utils import ClusteringResult
+from flaskr.utils.model_utils import ClusteringModel
+from flaskr.utils.nlp_utils import EmbedderRegistry
 
 def check_get(client, url, code):
     rv = client.get(url)
@@ -147,6 +153,60 @@ def test_get_stories_fail(client):
     rv = client.get('/api/stories?ids=abc,def')
     assert rv.status_code == 404
 
+def test_list_stories(client):
+    # ids above all the other test stories
+    stories = [
+        {
+            "story_id": 90000000 + i, "author": "a", "unix_time": 1626110000 + i, "body": None, 
+            "score": 1, "title": f"story {i}", "num_comments": 0,
+        }
+        for i in range(5)
+    ]
+    check_post(client, '/api/stories/', stories, 201)
+
+    # keyset pagination
+    rv = check_get(client, '/api/stories?after_id=89999999&limit=2', 200)
+    assert [story['story_id'] for story in rv.json['data']] == [90000000, 90000001]
+    rv = check_get(client, f'/api/stories?limit=2&after_id={rv.json["next_after_id"]}', 200)
+    assert [story['story_id'] for story in rv.json['data']] == [90000002, 90000003]
+    rv = check_get(client, f'/api/stories?limit=2&after_id={rv.json["next_after_id"]}', 200)
+    assert [story['story_id'] for story in rv.json['data']] == [90000004]
+    assert rv.json['next_after_id'] is None
+
+    rv = check_get(client, '/api/stories?after_id=89999999&ts_from=1626110001&ts_to=1626110002', 200)
+    assert [story['story_id'] for story in rv.json['data']] == [90000001, 90000002]
+
+    # ndjson stream (not limited by default)
+    rv = check_get(client, '/api/stories?after_id=90000001&format=ndjson', 200)
+    assert rv.mimetype == 'application/x-ndjson'
+    lines = rv.data.decode().strip().split('\n')
+    rv.close() # streamed response holds request context until closed
+    assert [json.loads(line)['story_id'] for line in lines] == [90000002, 90000003, 90000004]
+
+    rv = client.get('/api/stories?limit=1', headers={'Accept': 'application/x-ndjson'})
+    assert rv.status_code == 200 and len(rv.data.decode().strip().split('\n')) == 1
+    rv.close()
+
+    check_get(client, '/api/stories?limit=abc', 400)
+    check_get(client, '/api/stories?limit=0', 400)
+    check_get(client, '/api/stories?format=csv', 400)
+
+def test_list_comments(client):
+    comments = [
+        {"comment_id": 90000010 + i, "author": "a", "unix_time": 1626110000 + i, "body": f"c{i}", "parent_id": 90000000}
+        for i in range(3)
+    ]
+    check_post(client, '/api/comments/', comments, 201)
+
+    rv = check_get(client, '/api/comments?after_id=90000010&limit=1', 200)
+    assert [comment['comment_id'] for comment in rv.json['data']] == [90000011]
+    assert rv.json['next_after_id'] == 90000011
+
+    rv = check_get(client, '/api/comments?after_id=90000009&format=ndjson', 200)
+    lines = rv.data.decode().strip().split('\n')
+    rv.close()
+    assert [json.loads(line)['comment_id'] for line in lines] == [90000010, 90000011, 90000012]
+
 def test_put_story_to_db_ok(client):
     # put already existing story to db
     data = {
@@ -225,6 +285,40 @@ def test_del_story_from_db_ok(client):
     check_del(client, '/api/stories/27812656/', 200)
 
 
+def test_post_story_list_to_db_ok(client):
+    stories = [
+        {
+            "author": "a",
+            "body": None,
+            "num_comments": 1,
+            "score": 1,
+            "story_id": story_id,
+            "title": f"story {story_id}",
+            "unix_time": 1626110314,
+        } for story_id in [1001, 1002, 1001]
+    ]
+    rv = check_post(client, '/api/stories/', stories, 201)
+    assert [story['story_id'] for story in rv.json['data']] == [1001, 1002]
+
+    # already in db -> skipped
+    rv = check_post(client, '/api/stories/', stories[:1], 201)
+    assert not rv.json['data'] and rv.json['skipped'] == [1001]
+
+    rv = check_get(client, '/api/stories?ids=1001,1002', 200)
+    assert len(rv.json['data']) == 2
+
+def test_post_story_list_to_db_fail(client):
+    # one of the stories is missing required field
+    stories = [
+        {"author": "a", "body": None, "num_comments": 1, "score": 1,
+         "story_id": 1003, "title": "story 1003", "unix_time": 1626110314},
+        {"author": "a", "body": None, "num_comments": 1, "score": 1,
+         "story_id": 1004, "title": "story 1004"},
+    ]
+    check_post(client, '/api/stories/', stories, 400)
+    check_get(client, '/api/stories/1003/', 404)
+
+
 # ----------------------------------
 # ----------- COMMENT --------------
 # ----------------------------------
@@ -370,6 +464,23 @@ def test_del_comment_from_db_ok(client):
     check_del(client, '/api/comments/30063390/', 200)
     
 
+def test_post_comment_list_to_db_ok(client):
+    comments = [
+        {
+            "author": "a",
+            "body": f"comment {comment_id}",
+            "comment_id": comment_id,
+            "parent_id": 1001,
+            "unix_time": 1626110315
+        } for comment_id in [1011, 1012]
+    ]
+    rv = check_post(client, '/api/comments/', comments, 201)
+    assert len(rv.json['data']) == 2
+
+    rv = check_get(client, '/api/items?ids=1011,1012', 200)
+    assert [item['type'] for item in rv.json['data']] == ['comment', 'comment']
+    
+
 # ----------------------------------
 # -------------- IO ----------------
 # ----------------------------------
@@ -400,6 +511,26 @@ def test_read_file_ok(client):
         os.remove('data/test.csv')
         os.remove('data/test.json')
 
+def test_read_npz_file_columns(client):
+    result = ClusteringResult.create('data/test.npz', 2)
+    result.append(
+        [{'story_id': 1, 'title': 'a', 'url': None, 'unix_time': 10},
+         {'story_id': 2, 'title': 'b', 'url': 'c', 'unix_time': 20}],
+        [3, 4],
+        np.array([[0.5, 1.5], [2.5, 3.5]])
+    )
+    result.close()
+
+    try:
+        rv = client.get('/file?fname=data/test.npz&columns=id,label')
+        assert rv.status_code == 200 and rv.json.get('data') == {'id': [1, 2], 'label': [3, 4]}
+
+        rv = client.get('/file?fname=data/test.npz&columns=url,embedding')
+        assert rv.status_code == 200 and \
+            rv.json.get('data') == {'url': ['', 'c'], 'embedding': [[0.5, 1.5], [2.5, 3.5]]}
+    finally:
+        os.remove('data/test.npz')
+
 def test_read_file_fail(client):
     # file does not exist
     rv = client.get('/file?fname=data/this-file-does-not-exist.txt')
@@ -481,3 +612,164 @@ def test_delete_file_fail(client):
         data=json.dumps({'sender': 'deleter', 'fname': 'test.py'})
     )
     assert rv.status_code == 400
+
+def test_get_similar_stories(client):
+    rng = np.random.default_rng(0)
+    embeddings = rng.standard_normal((5, 8)).astype(np.float32)
+    embeddings[1] = embeddings[0] + 0.01 # nearly the same as the first one
+    stories = [
+        {
+            "story_id": 27900000 + i, "author": "a", "unix_time": 1626110314, "body": None, 
+            "score": 1, "title": f"similar {i}", "num_comments": 0,
+            "comment_embedding": ",".join(str(val) for val in embedding)
+        }
+        for i, embedding in enumerate(embeddings[:4])
+    ]
+    check_post(client, '/api/stories/', stories, 201)
+
+    rv = check_get(client, '/api/stories/27900000/similar?k=2', 200)
+    data = json.loads(rv.data)['data']
+    assert [story['story_id'] for story in data][0] == 27900001
+    assert len(data) == 2 and data[0]['similarity'] > 0.99
+    assert data[0]['comment_embedding'] is None
+
+    # index is updated on writes
+    stories[3]['comment_embedding'] = ",".join(str(val) for val in embeddings[0] - 0.001)
+    check_put(client, '/api/stories/27900003', stories[3], 200)
+    rv = check_get(client, '/api/stories/27900000/similar?k=1', 200)
+    assert json.loads(rv.data)['data'][0]['story_id'] == 27900003
+
+    check_del(client, '/api/stories/27900003', 200)
+    rv = check_get(client, '/api/stories/27900000/similar?k=1', 200)
+    assert json.loads(rv.data)['data'][0]['story_id'] == 27900001
+
+    # embeddings with other dims are written, but not indexed
+    check_post(client, '/api/stories/', {**stories[3], "comment_embedding": "0.1,0.2,0.3,0.4"}, 201)
+    check_get(client, '/api/stories/27900003/', 200)
+    check_get(client, '/api/stories/27900003/similar', 404)
+    stories[2]['comment_embedding'] = "0.1,0.2,0.3,0.4"
+    check_put(client, '/api/stories/27900002', stories[2], 200)
+    check_get(client, '/api/stories/27900002/similar', 404)
+    rv = check_get(client, '/api/stories/27900000/similar?k=10', 200)
+    assert [story['story_id'] for story in json.loads(rv.data)['data']] == [27900001]
+
+    # stories whose embedding is cleared are removed from the index
+    check_put(client, '/api/stories/27900001', {**stories[1], "comment_embedding": None}, 200)
+    check_get(client, '/api/stories/27900001/similar', 404)
+    rv = check_get(client, '/api/stories/27900000/similar?k=10', 200)
+    assert json.loads(rv.data)['data'] == []
+
+    # story without embedding, bad k
+    check_get(client, '/api/stories/27812656/similar', 404)
+    check_get(client, '/api/stories/27900000/similar?k=many', 400)
+
+
+# ----------------------------------
+# ------------ CLUSTER -------------
+# ----------------------------------
+def test_update_clusters_fail(client):
+    # bad model name
+    check_post(client, '/cluster/update', {
+        'sender': 'updater', 'cluster-model': '../data', 'partial-fit': 0
+    }, 400)
+
+    # missing field
+    check_post(client, '/cluster/update', {'sender': 'updater', 'cluster-model': 'default'}, 400)
+
+    # model does not exist
+    check_post(client, '/cluster/update', {
+        'sender': 'updater', 'cluster-model': 'this-model-does-not-exist', 'partial-fit': 0
+    }, 404)
+
+def wait_for_job(client, job_id):
+    for _ in range(1000):
+        job = json.loads(check_get(client, f'/jobs/{job_id}', 200).data)['data']
+        if job['status'] not in ['queued', 'running']:
+            break
+        time.sleep(0.01)
+    return job
+
+class RandomEmbedder:
+    """stands in for `StoryEmbedder`: random 128-dim embeddings (more than 100 pca dims)"""
+    def embed_stories(self, stories, batch_size=64):
+        return np.random.rand(len(stories), 128).astype(np.float32)
+
+def test_update_named_clusters(client, tmp_path, monkeypatch):
+    # route modules are imported by the app (within app context)
+    cluster_routes = sys.modules['flaskr.routes.cluster_routes']
+    monkeypatch.setattr(EmbedderRegistry, 'get', classmethod(lambda cls, model_name: RandomEmbedder()))
+    for name in ['DF_FNAME', 'PCA_FNAME', 'SCALER_FNAME']:
+        monkeypatch.setattr(cluster_routes, name, str(tmp_path / os.path.basename(getattr(cluster_routes, name))))
+    monkeypatch.setattr(cluster_routes, 'MODEL_DIR', str(tmp_path / 'models'))
+
+    def add_stories(ids):
+        check_post(client, '/api/stories/', [
+            {
+                "story_id": i, "author": "a", "unix_time": 1990000000 + i % 1000, "body": None, 
+                "score": 10, "title": f"Story {i}.", "num_comments": 10,
+            }
+            for i in ids
+        ], 201)
+
+    def cluster(name):
+        rv = check_post(client, '/cluster/new', {
+            'sender': 'clusterer', 
+            'show-ts-begin-range': 1990000000, 'show-ts-end-range': 1999999999,
+            'show-comm-begin-range': 5, 'show-comm-end-range': 300,
+            'show-score-begin-range': 0, 'show-score-end-range': 300,
+            'num-clusters': 3, 'model-name': 'random', 'cluster-model': name
+        }, 202)
+        assert wait_for_job(client, rv.json['data']['job_id'])['status'] == 'done'
+
+    def update(name, code):
+        rv = check_post(client, '/cluster/update', {
+            'sender': 'updater', 'cluster-model': name, 'partial-fit': 0
+        }, code)
+        return wait_for_job(client, rv.json['data']['job_id']) if code == 202 else None
+
+    add_stories(range(80000000, 80000150))
+    cluster('a')
+    cluster('b')
+    ids = ClusteringResult.read(cluster_routes.DF_FNAME, ['id'])['id']
+
+    # result of `a` was overwritten by `b`: new stories can't be assigned to `a` clusters
+    add_stories(range(80000150, 80000160))
+    update('a', 409)
+    assert np.array_equal(ClusteringResult.read(cluster_routes.DF_FNAME, ['id'])['id'], ids)
+
+    job = update('b', 202)
+    assert job['status'] == 'done' and job['result'] == {'num_new': 10, 'num_total': 160}
+    assert ClusteringResult.read_meta(cluster_routes.DF_FNAME)['model'] == 'b'
+
+    # `a` owns the result again once refitted
+    cluster('a')
+    assert update('a', 202)['status'] == 'done'
+
+    # jobs cancelled once the result is written still save their model
+    close = ClusteringResult.close
+    def close_and_cancel(self):
+        close(self)
+        for job in current_app.extensions['job_runner'].list():
+            job.cancel()
+    monkeypatch.setattr(ClusteringResult, 'close', close_and_cancel)
+    cluster('c')
+    assert ClusteringModel.read_meta(str(tmp_path / 'models' / 'c'))['num_stories'] == 160
+    add_stories(range(80000160, 80000170))
+    job = update('c', 202)
+    assert job['status'] == 'done' and job['result'] == {'num_new': 10, 'num_total': 170}
+
+def test_cluster_job_fail(client):
+    # badly formatted request is rejected right away
+    check_post(client, '/cluster/visuals/tsne', {'sender': 'tsneer', 'perplexity': 30}, 400)
+
+    # job is started, but fails since there is no clustering result
+    rv = check_post(client, '/cluster/visuals/tsne', {
+        'sender': 'tsneer', 'perplexity': 30, 'dims': 10
+    }, 202)
+    job_id = json.loads(rv.data)['data']['job_id']
+    job = wait_for_job(client, job_id)
+    assert job['status'] == 'failed' and job['error']
+    assert job_id in [job['job_id'] for job in json.loads(check_get(client, '/jobs', 200).data)['data']]
+
+    check_get(client, '/jobs/this-job-does-not-exist', 404)
+    check_del(client, '/jobs/this-job-does-not-exist', 404)
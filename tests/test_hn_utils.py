@@ -0,0 +1,97 @@
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+import requests as rq
+
+from flaskr.models.story import Story
+from flaskr.models.comment import Comment
+from flaskr.utils.hn_utils import HNClient, HNIngester, RateLimiter
+
+# local stand-in for `https://hacker-news.firebaseio.com/v0/item/<id>.json`
+ITEMS = {
+    101: {"id": 101, "type": "story", "by": "a", "time": 1626110314, "title": "story 101", 
+          "score": 10, "descendants": 2, "kids": [102, 201]},
+    102: {"id": 102, "type": "comment", "by": "b", "time": 1626110315, "text": "comment 102", "parent": 101},
+    103: None, # missing item: api responds with `null`
+    104: {"id": 104, "type": "story", "by": "c", "time": 1626110317, "title": "story 104 (edited)",
+          "score": 20, "descendants": 0},
+    105: {"id": 105, "type": "comment", "by": "d", "time": 1626110318, "text": "changed on hn", "parent": 104},
+    201: {"id": 201, "type": "comment", "by": "e", "time": 1626110400, "text": "comment 201", "parent": 101},
+}
+# items for which api responds with an html error page
+FORBIDDEN = {106}
+
+@pytest.fixture
+def hn_api():
+    requested = []
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1' # keep-alive
+
+        def do_GET(self):
+            item_id = int(self.path.split('/')[-1].split('.')[0])
+            requested.append(item_id)
+            if item_id in FORBIDDEN:
+                body = b'<html><body>Forbidden</body></html>'
+                self.send_response(403)
+                self.send_header('Content-Type', 'text/html')
+            else:
+                body = json.dumps(ITEMS.get(item_id)).encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield f'http://127.0.0.1:{server.server_address[1]}/v0', requested
+    finally:
+        server.shutdown()
+        server.server_close()
+
+def test_ingest_range(empty_db, hn_api):
+    api_url, requested = hn_api
+
+    # story 104 is already in db -> should be updated,
+    # comment 105 is already in db -> should not even be requested
+    Story(story_id=104, title='story 104', score=1, num_comments=0, unix_time=1626110317).add()
+    Comment(comment_id=105, body='old', parent_id=104, unix_time=1626110318).add()
+
+    ingester = HNIngester(client=HNClient(api_url=api_url, max_connections=4), max_workers=4, chunk_size=2, batch_size=2)
+    stats = ingester.ingest_range(101, 105)
+
+    assert 105 not in requested
+    assert sorted(requested) == [101, 102, 103, 104, 201]
+    assert stats == {'fetched': 5, 'added': 3, 'updated': 1, 'skipped': 1, 'failed': 0}
+
+    assert Story.find_by_id(101).title == 'story 101'
+    assert Story.find_by_id(104).title == 'story 104 (edited)'
+    assert Comment.find_by_id(102).body == 'comment 102'
+    assert Comment.find_by_id(103) is None
+    assert Comment.find_by_id(105).body == 'old'
+    assert Comment.find_by_id(201).parent_id == 101
+
+def test_ingest_counts_http_errors(empty_db, hn_api):
+    api_url, requested = hn_api
+    client = HNClient(api_url=api_url, max_connections=4, retries=0)
+    with pytest.raises(rq.HTTPError):
+        client.get_item(106)
+
+    ingester = HNIngester(client=client, max_workers=4, chunk_size=2, batch_size=2)
+    stats = ingester.ingest_range(104, 106)
+    assert stats['failed'] == 1 and stats['fetched'] == 2
+    assert Story.find_by_id(104) is not None
+
+def test_rate_limiter():
+    limiter = RateLimiter(rate=1000, burst=1)
+    for _ in range(10):
+        limiter.acquire()
+    assert limiter.tokens < 1
@@ -0,0 +1,81 @@
+import numpy as np
+
+from flaskr.models.story import Story, StoryList
+from flaskr.utils.index_utils import StoryIndex
+
+def get_clustered_embeddings(num, dim=32, n_clusters=20, seed=0):
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((n_clusters, dim))
+    return (centers[rng.integers(n_clusters, size=num)] + 0.3 * rng.standard_normal((num, dim))).astype(np.float32)
+
+def brute_force(embeddings, query, k):
+    normed = embeddings / np.linalg.norm(embeddings, axis=1, keepdims=True)
+    scores = normed @ (query / np.linalg.norm(query))
+    return np.argsort(-scores, kind='stable')[:k].tolist()
+
+def test_exact_search_matches_brute_force():
+    embeddings = get_clustered_embeddings(1000)
+    index = StoryIndex(block_size=128) # several blocks per search
+    for i in range(0, 1000, 300):
+        index.add(list(range(i, min(i + 300, 1000))), embeddings[i:i+300])
+    assert len(index) == 1000 and not index.is_ivf
+
+    for query in embeddings[:20]:
+        ids = [story_id for story_id, _ in index.search(query, k=7)]
+        assert ids == brute_force(embeddings, query, 7)
+
+    neighbours = index.search_by_id(5, k=3)
+    assert 5 not in [story_id for story_id, _ in neighbours] and len(neighbours) == 3
+    assert neighbours[0][1] >= neighbours[1][1] >= neighbours[2][1]
+    assert index.search_by_id(12345) is None
+
+def test_index_updates_and_removes_stories():
+    embeddings = get_clustered_embeddings(100)
+    index = StoryIndex()
+    index.add(list(range(100)), embeddings)
+
+    # updated story is found by its new embedding
+    index.add([3], embeddings[50:51])
+    assert len(index) == 100
+    assert {story_id for story_id, _ in index.search(embeddings[50], k=2)} == {3, 50}
+
+    index.remove([50, 99, 12345])
+    assert len(index) == 98 and 50 not in index and 99 not in index
+    assert index.search(embeddings[50], k=1)[0][0] == 3
+    assert index.search_by_id(98, k=1) is not None
+
+def test_ivf_search_recall():
+    embeddings = get_clustered_embeddings(5000)
+    index = StoryIndex(min_ivf_size=2000, nprobe=8)
+    index.add(list(range(5000)), embeddings)
+    index.search(embeddings[0], k=1)
+    assert index.is_ivf
+
+    # new stories are assigned to existing lists
+    new = get_clustered_embeddings(100, seed=1)
+    index.add(list(range(5000, 5100)), new)
+    embeddings = np.vstack([embeddings, new])
+
+    hits = 0
+    for query in embeddings[::51]:
+        expected = set(brute_force(embeddings, query, 10))
+        hits += len(expected & {story_id for story_id, _ in index.search(query, k=10)})
+    assert hits / (10 * len(embeddings[::51])) > 0.9
+
+def test_shared_index_skips_embeddings_with_other_dims(empty_db):
+    embeddings = get_clustered_embeddings(3, dim=8)
+    StoryList.add_many([Story(story_id=i, comment_embedding=embeddings[i]) for i in range(3)])
+    index = StoryIndex.get_shared()
+    assert len(index) == 3 and index.dim == 8
+
+    # embeddings are committed first, so index update doesn't raise
+    Story(story_id=3, comment_embedding=np.ones(4)).add()
+    StoryList.update_embeddings([0, 4], [np.ones(4), None])
+    assert Story.find_by_id(3) is not None
+    assert len(index) == 2 and 0 not in index and 3 not in index
+    assert [story_id for story_id, _ in index.search_by_id(1)] == [2]
+
+    # cleared embeddings are removed from the index
+    StoryList.update_embeddings([1], [None])
+    assert len(index) == 1 and 1 not in index
+    assert index.search_by_id(2) == []
@@ -0,0 +1,75 @@
+import os
+import pytest
+import numpy as np
+
+from flaskr.utils.io_utils import ClusteringResult
+
+STORIES = [
+    {'story_id': 1, 'title': 'first', 'url': 'https://a.b', 'unix_time': 1626110314},
+    {'story_id': 2, 'title': 'ütf-8 ✓', 'url': None, 'unix_time': 1626110315},
+    {'story_id': 3, 'title': '', 'url': 'https://c.d', 'unix_time': 1626110316},
+]
+LABELS = [0, 2, 1]
+EMBEDDINGS = np.arange(9, dtype=np.float32).reshape(3, 3) / 7
+
+def write_result(fname, meta=None):
+    result = ClusteringResult.create(fname, len(STORIES), meta=meta)
+    result.append(STORIES[:2], LABELS[:2], EMBEDDINGS[:2])
+    result.append(STORIES[2:], LABELS[2:], EMBEDDINGS[2:])
+    result.close()
+
+def check_result(result):
+    assert result['id'].tolist() == [1, 2, 3]
+    assert result['label'].tolist() == LABELS
+    assert result['unix_time'].tolist() == [1626110314, 1626110315, 1626110316]
+    assert result['title'].tolist() == ['first', 'ütf-8 ✓', '']
+    assert result['url'].tolist() == ['https://a.b', '', 'https://c.d']
+    assert np.allclose(result['embedding'], EMBEDDINGS)
+
+def test_clustering_result_columns(tmpdir):
+    fname = str(tmpdir.join('df.npz'))
+    write_result(fname)
+
+    result = ClusteringResult.read(fname)
+    check_result(result)
+    assert result['id'].dtype == np.int64 and result['label'].dtype == np.int32
+    assert isinstance(result['embedding'], np.memmap) and result['embedding'].dtype == np.float32
+
+    assert list(ClusteringResult.read(fname, ['label', 'id'])) == ['label', 'id']
+
+def test_clustering_result_from_csv(tmpdir):
+    csv_fname, fname = str(tmpdir.join('df.csv')), str(tmpdir.join('df.npz'))
+    with open(csv_fname, 'w') as f:
+        f.write('\t'.join(ClusteringResult.COLUMNS) + '\n')
+        for st, lbl, emb in zip(STORIES, LABELS, EMBEDDINGS):
+            f.write('\t'.join([
+                str(st['story_id']), st['title'], st['url'] or '', str(st['unix_time']), 
+                str(lbl), ','.join(str(val) for val in emb)
+            ]) + '\n')
+
+    check_result(ClusteringResult.read(csv_fname))
+    assert ClusteringResult.from_csv(csv_fname, fname, chunksize=2) == 3
+    check_result(ClusteringResult.read(fname))
+
+def test_clustering_result_extend(tmpdir, monkeypatch):
+    fname = str(tmpdir.join('df.npz'))
+    write_result(fname, meta={'model': 'default', 'created': 1626110000})
+
+    # old rows are copied as raw bytes, not decoded
+    decode = ClusteringResult._decode_strings
+    monkeypatch.setattr(ClusteringResult, '_decode_strings', staticmethod(lambda *args: pytest.fail('decoded')))
+    for story_id, title in [(4, 'new'), (5, 'ñewer')]:
+        result = ClusteringResult.extend(fname, 1)
+        result.append([{'story_id': story_id, 'title': title, 'url': None, 'unix_time': 1626110317}], [1], EMBEDDINGS[:1])
+        result.close()
+    monkeypatch.setattr(ClusteringResult, '_decode_strings', staticmethod(decode))
+
+    extended = ClusteringResult.read(fname)
+    assert extended['id'].tolist() == [1, 2, 3, 4, 5]
+    assert extended['label'].tolist() == LABELS + [1, 1]
+    assert extended['title'].tolist() == ['first', 'ütf-8 ✓', '', 'new', 'ñewer']
+    assert extended['url'].tolist() == ['https://a.b', '', 'https://c.d', '', '']
+    assert extended['id'].dtype == np.int64 and extended['label'].dtype == np.int32
+    assert np.allclose(extended['embedding'], np.vstack([EMBEDDINGS, EMBEDDINGS[:1], EMBEDDINGS[:1]]))
+    assert not os.path.exists(f'{fname}.tmp')
+    assert ClusteringResult.read_meta(fname) == {'model': 'default', 'created': 1626110000}
@@ -0,0 +1,93 @@
+import threading
+
+from flask import current_app
+
+from flaskr.utils.job_utils import Job, JobRunner
+
+def wait(job, timeout=5):
+    for _ in range(int(timeout * 100)):
+        if job.is_finished:
+            return job
+        threading.Event().wait(0.01)
+    raise TimeoutError(job.json())
+
+def test_job_reports_progress_and_result(application):
+    runner = JobRunner(application, max_workers=1)
+
+    def fun(job, num):
+        job.set_stage('counting', num)
+        for _ in range(num):
+            job.advance()
+        # jobs run in app context
+        return {'num': num, 'testing': current_app.config['TESTING']}
+
+    job = wait(runner.submit('count', fun, 3))
+    info = job.json()
+    assert info['status'] == 'done' and info['stage'] == 'counting'
+    assert info['done'] == info['total'] == 3
+    assert info['result'] == {'num': 3, 'testing': True}
+    assert info['eta'] is None
+
+    job = wait(runner.submit('fail', lambda job: 1 / 0))
+    assert job.status == 'failed' and 'division by zero' in job.error
+
+def test_jobs_are_queued_and_cancelled(application):
+    runner = JobRunner(application, max_workers=1, history_size=1)
+    started, release = threading.Event(), threading.Event()
+
+    def blocking(job):
+        job.set_stage('waiting')
+        started.set()
+        release.wait(5)
+        job.advance() # cancelled job stops here
+
+    running = runner.submit('blocking', blocking)
+    started.wait(5)
+    queued = runner.submit('queued', lambda job: 'ran')
+    assert running.status == 'running' and queued.status == 'queued'
+
+    runner.cancel(running.id)
+    runner.cancel(queued.id)
+    release.set()
+    assert wait(running).status == 'cancelled'
+    assert wait(queued).status == 'cancelled' and queued.result is None
+
+    # only the most recent finished jobs are kept
+    wait(runner.submit('last', lambda job: None))
+    assert [job.name for job in runner.list()] == ['last']
+
+def test_exclusive_jobs_run_one_at_a_time(application):
+    runner = JobRunner(application, max_workers=3)
+    started, release = threading.Event(), threading.Event()
+
+    def blocking(job):
+        started.set()
+        release.wait(5)
+
+    first = runner.submit('first', blocking, exclusive=True)
+    started.wait(5)
+    second = runner.submit('second', lambda job: 'ran', exclusive=True)
+    # other jobs still run in parallel
+    assert wait(runner.submit('other', lambda job: 'ran')).result == 'ran'
+    assert first.status == 'running' and second.status == 'queued'
+
+    release.set()
+    assert wait(second).result == 'ran' and second.started >= first.finished
+
+def test_job_tracks_clusterer_events():
+    job = Job('cluster')
+    job.track('stage', ('embedding', 10))
+    job.track('progress', 4)
+    job.track('labels', None) # other events are ignored
+    assert (job.stage, job.done, job.total) == ('embedding', 4, 10)
+
+    job.cancel()
+    try:
+        job.track('progress', 4)
+        assert False, 'cancelled job should stop on progress report'
+    except Exception as e:
+        assert type(e).__name__ == 'JobCancelled'
+
+    # stages that must finish are not interrupted
+    job.set_stage('saving model', cancellable=False)
+    assert job.stage == 'saving model'
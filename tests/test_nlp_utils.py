@@ -0,0 +1,109 @@
+import pytest
+import threading
+
+from flaskr.utils import nlp_utils
+from flaskr.utils.nlp_utils import Tokenizer, EmbedderRegistry, html2text, html2paragraphs, html2sentences
+
+TEXTS = [
+    '',
+    '!!!',
+    'Hello there, running dogs!',
+    '  The databases   are indexed; QUERIES_run faster.\nNew line\ttab',
+    'Show HN: I built a thing with Rust (and WebAssembly) -- https://example.com/a_b?c=1',
+    "It's 2021 and we're still arguing about tabs vs. spaces... lol",
+    'Ünïcödé wörds, naïve café, straße and ĲSSELMEER',
+    'running runs runner ran; running runs runner ran',
+]
+
+def tokenize_reference(tokenizer, txt):
+    """tokenizer pipeline before memoization: punctuation -> split -> per-word stem"""
+    txt = tokenizer.remove_punctuation(txt.lower())
+    return [
+        tokenizer.porter.stem(word) for word in txt.split(' ')
+        if word not in tokenizer.blacklist
+    ]
+
+def test_tokenizer_matches_reference_pipeline():
+    tokenizer = Tokenizer()
+    for txt in TEXTS:
+        # empty tokens (from leading/trailing punctuation) are no longer produced
+        expected = [token for token in tokenize_reference(tokenizer, txt) if token]
+        assert tokenizer.tokenize(txt) == expected, txt
+
+def test_tokenizer_stem_cache():
+    tokenizer = Tokenizer(stem_cache_size=2)
+    assert tokenizer.tokenize('running dogs running dogs running') == ['run', 'dog', 'run', 'dog', 'run']
+    assert tokenizer.stem_cache_stats == {'hits': 3, 'misses': 2, 'size': 2, 'hit_rate': 0.6}
+
+    # least recently used words are evicted
+    tokenizer.tokenize('cats running')
+    assert tokenizer.stem_cache_stats['misses'] == 3
+    tokenizer.tokenize('dogs')
+    assert tokenizer.stem_cache_stats['misses'] == 4
+    assert tokenizer.stem_cache_stats['size'] == 2
+
+THREADS = [
+    '',
+    ' ',
+    'Title only. Nothing else',
+    'Show HN: x.y<br><br>First comment &amp; more.<p>Second &#x27;paragraph&#x27; with <i>italics</i>.',
+    'T<br><br>See <a href="https:&#x2F;&#x2F;example.com&#x2F;a?b=1&amp;c=2" rel="nofollow">https:&#x2F;&#x2F;example.com&#x2F;a...</a> e.g. this',
+    'T<br><br>Code:<p><pre><code>  def f(x):\n      return x.y\n\n  f(1)\n</code></pre><p>After code.',
+    'T<br><br>  \n<p>  <p>&lt;b&gt; isn&#x27;t a tag &gt; &quot;quoted&quot;&nbsp;end!<br><br><i> </i>',
+    'T<br><br>Ünïcödé, (parens) [brackets] {braces} 2.5 dollars...<!-- comment --> after\r\nnext line\tend',
+]
+
+def test_html_extraction_matches_beautifulsoup():
+    bs = pytest.importorskip('bs4')
+    pytest.importorskip('lxml')
+
+    punct = {
+        i: '' for i in 
+        list(range(33, 46)) + list(range(58,64)) + list(range(91,97)) + list(range(123,127))
+    }
+    for html in THREADS:
+        soup = bs.BeautifulSoup(html, 'lxml')
+        text = soup.get_text(separator=' ')
+        assert html2text(html) == text, html
+        assert html2paragraphs(html) == [p.get_text(separator=' ') for p in soup.find_all('p')], html
+        assert html2sentences(html) == [
+            sentence.strip().lower().translate(punct) for sentence in text.split('.')
+        ], html
+
+class SlowEmbedder:
+    """stands in for `StoryEmbedder`: records loads"""
+    loads = []
+    def __init__(self, model_name):
+        threading.Event().wait(0.05)
+        self.loads.append(model_name)
+        self.model_name = model_name
+
+def test_embedder_registry_loads_once_and_evicts_lru(monkeypatch):
+    monkeypatch.setattr(nlp_utils, 'StoryEmbedder', SlowEmbedder)
+    monkeypatch.setattr(SlowEmbedder, 'loads', [])
+    EmbedderRegistry.clear()
+    EmbedderRegistry.configure(max_size=2, preload=['a'])
+    try:
+        # concurrent requests for the same model share a single load
+        embedders = []
+        threads = [
+            threading.Thread(target=lambda: embedders.append(EmbedderRegistry.get('b')))
+            for _ in range(4)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert len({id(embedder) for embedder in embedders}) == 1
+        assert SlowEmbedder.loads == ['a', 'b']
+
+        assert EmbedderRegistry.get('a').model_name == 'a' # `a` is now most recently used
+        EmbedderRegistry.get('c')
+        assert EmbedderRegistry.loaded() == ['a', 'c']
+        assert SlowEmbedder.loads == ['a', 'b', 'c']
+
+        EmbedderRegistry.get('b') # evicted, so loaded again
+        assert SlowEmbedder.loads == ['a', 'b', 'c', 'b']
+        assert EmbedderRegistry.loaded() == ['c', 'b']
+    finally:
+        EmbedderRegistry.clear()
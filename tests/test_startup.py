@@ -0,0 +1,49 @@
+import os
+import sys
+import subprocess
+import tempfile
+
+# dependencies that should only be imported on first use (not on app start)
+HEAVY_MODULES = ['torch', 'sentence_transformers', 'sklearn', 'nltk', 'scipy', 'wordcloud']
+# generous budget for `create_app` of plain api worker (without dashboard)
+STARTUP_BUDGET = 3.0 # seconds
+
+def get_import_times(code):
+    """
+    runs `code` in a fresh interpreter with `python -X importtime`;
+    returns (names of all imported modules, 
+    cumulative import time (s) of each top-level import)
+    """
+    env = {**os.environ, 'PYTHONPATH': os.pathsep.join(filter(None, [
+        os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 
+        os.environ.get('PYTHONPATH')
+    ]))}
+    proc = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', code],
+        capture_output=True, text=True, env=env, cwd=tempfile.gettempdir(), check=True
+    )
+    names, times = set(), dict()
+    for line in proc.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line.split('|')
+        names.add(name.strip())
+        if not name[1:].startswith(' '): # nested imports are indented
+            times[name.strip()] = int(cumulative) / 1e6
+    return names, times
+
+def test_create_app_does_not_import_heavy_dependencies():
+    db_fd, db_path = tempfile.mkstemp()
+    try:
+        names, times = get_import_times(
+            'from flaskr import create_app; ' +\
+            f'create_app({{"TESTING": True, "DATABASE": {db_path!r}, "DASHBOARD": False}})'
+        )
+    finally:
+        os.close(db_fd)
+        os.unlink(db_path)
+
+    imported = {name.split('.')[0] for name in names}
+    assert 'flaskr' in imported
+    assert not imported.intersection(HEAVY_MODULES), imported.intersection(HEAVY_MODULES)
+    assert sum(times.values()) < STARTUP_BUDGET, sorted(times.items(), key=lambda kv: -kv[1])[:10]